@@ -1,6 +1,6 @@
 import logging
 import random, shutil, sqlite3, configparser, hashlib, ipaddress, json, os, secrets, subprocess
-import time, re, uuid, bcrypt, psutil, pyotp, threading
+import time, re, uuid, bcrypt, psutil, pyotp, threading, atexit
 import traceback
 from uuid import uuid4
 from zipfile import ZipFile
@@ -8,7 +8,7 @@ from datetime import datetime, timedelta
 
 import sqlalchemy
 from jinja2 import Template
-from flask import Flask, request, render_template, session, send_file
+from flask import Flask, request, render_template, session, send_file, stream_with_context
 from flask_cors import CORS
 from icmplib import ping, traceroute
 from flask.json.provider import DefaultJSONProvider
@@ -31,6 +31,13 @@ from modules.PeerJobs import PeerJobs
 from modules.DashboardConfig import DashboardConfig
 from modules.WireguardConfiguration import WireguardConfiguration
 from modules.AmneziaWireguardConfiguration import AmneziaWireguardConfiguration
+from modules.ConfigurationPollScheduler import ConfigurationPollScheduler
+from modules.PollCycleMetrics import PollCycleMetrics
+from modules.PrometheusExporter import PrometheusExporter
+from modules.InterfaceState import InterfaceStates
+from modules.TrackingTableExport import TrackingTableExport
+from modules.DatabaseMaintenance import DatabaseMaintenance
+from modules.ConfigurationWatcher import ConfigurationWatcher
 
 from client import createClientBlueprint
 
@@ -69,43 +76,52 @@ def ResponseObject(status=True, message=None, data=None, status_code = 200) -> F
     response.content_type = "application/json"
     return response
 
+def SavedResponseObject(configuration: WireguardConfiguration, status=True, message=None, data=None) -> Flask.response_class:
+    """
+    Response of a request that changed peers, sent once the configuration file has been saved. A change the
+    file did not get would be lost on the next wg-quick up, so it is reported as a failure.
+    """
+    saved, error = configuration.SaveScheduler.flush()
+    if not saved:
+        return ResponseObject(False, f"{message + ' ' if message else ''}Failed to save the configuration file: {error}", data)
+    return ResponseObject(status, message, data)
+
 '''
 Flask App
 '''
 app = Flask("WGDashboard", template_folder=os.path.abspath("./static/dist/WGDashboardAdmin"))
 
+def pollConfiguration(c):
+    try:
+        if c.getStatus():
+            c.pollPeerInformation()
+    finally:
+        c.schedulePoll()
+
+def peerPollingWorkersConfig() -> int:
+    _, workers = DashboardConfig.GetConfig("WireGuardConfiguration", "peer_polling_workers")
+    try:
+        return int(workers)
+    except (TypeError, ValueError):
+        return 4
+
 def peerInformationBackgroundThread():
     global WireguardConfigurations
     app.logger.info("Background Thread #1 Started")
     app.logger.info("Background Thread #1 PID:" + str(threading.get_native_id()))
-    delay = 6
+    app.logger.info(f"Background Thread #1 polling with {PollScheduler.workers} worker(s)")
     time.sleep(10)
     while True:
-        with app.app_context():
-            try:
-                curKeys = list(WireguardConfigurations.keys())
-                for name in curKeys:
-                    if name in WireguardConfigurations.keys() and WireguardConfigurations.get(name) is not None:
-                        c = WireguardConfigurations.get(name)
-                        if c.getStatus():
-                            c.getPeersLatestHandshake()
-                            c.getPeersTransfer()
-                            c.getPeersEndpoint()
-                            c.getPeers()
-                            if delay == 6:
-                                if c.configurationInfo.PeerTrafficTracking:
-                                    c.logPeersTraffic()
-                                if c.configurationInfo.PeerHistoricalEndpointTracking:
-                                    c.logPeersHistoryEndpoint()
-                            c.getRestrictedPeersList()
-            except Exception as e:
-                app.logger.error(f"[WGDashboard] Background Thread #1 Error", e)
-
-        if delay == 6:
-            delay = 1
-        else:
-            delay += 1
-        time.sleep(10)
+        try:
+            curKeys = list(WireguardConfigurations.keys())
+            for name in curKeys:
+                c = WireguardConfigurations.get(name)
+                # A slow configuration keeps running in its worker and is not submitted again until it is done
+                if c is not None and c.isPollDue() and not PollScheduler.isRunning(name):
+                    PollScheduler.submit(name, pollConfiguration, c)
+        except Exception as e:
+            app.logger.error(f"[WGDashboard] Background Thread #1 Error", e)
+        time.sleep(1)
 
 def peerJobScheduleBackgroundThread():
     with app.app_context():
@@ -114,16 +130,92 @@ def peerJobScheduleBackgroundThread():
         time.sleep(10)
         while True:
             try:
-                AllPeerJobs.runJob()
-                time.sleep(180)
+                with JobMetrics.measure("jobs"):
+                    AllPeerJobs.runJob()
             except Exception as e:
+                JobMetrics.recordError("jobs", e)
                 app.logger.error("Background Thread #2 Error", e)
+            time.sleep(180)
+
+def flushPeerStates():
+    global WireguardConfigurations
+    with app.app_context():
+        for name in list(WireguardConfigurations.keys()):
+            c = WireguardConfigurations.get(name)
+            if c is not None:
+                c.flushPeerStates()
+
+def flushConfigurationSaves():
+    for name in list(WireguardConfigurations.keys()):
+        c = WireguardConfigurations.get(name)
+        if c is not None:
+            c.SaveScheduler.flush()
+
+def peerStateFlushBackgroundThread():
+    with app.app_context():
+        app.logger.info(f"Background Thread #3 Started")
+        app.logger.info(f"Background Thread #3 PID:" + str(threading.get_native_id()))
+    while True:
+        _, interval = DashboardConfig.GetConfig("WireGuardConfiguration", "peer_state_flush_interval")
+        try:
+            interval = max(1, int(interval))
+        except (TypeError, ValueError):
+            interval = 30
+        time.sleep(interval)
+        try:
+            flushPeerStates()
+        except Exception as e:
+            app.logger.error("Background Thread #3 Error", e)
+
+def dashboardIsIdle() -> bool:
+    # Idle until a second before the next configuration is due to be polled
+    now = time.time()
+    return all(c.NextPollTime - now > 1 for c in list(WireguardConfigurations.values()))
+
+def trackingMaintenanceBackgroundThread():
+    with app.app_context():
+        app.logger.info(f"Background Thread #4 Started")
+        app.logger.info(f"Background Thread #4 PID:" + str(threading.get_native_id()))
+    nextRun = time.monotonic() + 60
+    while True:
+        with app.app_context():
+            Maintenance.runTasks()
+            if time.monotonic() >= nextRun:
+                for name in list(WireguardConfigurations.keys()):
+                    c = WireguardConfigurations.get(name)
+                    if c is None:
+                        continue
+                    try:
+                        written = c.TransferRollups.rollup()
+                        deleted = c.TransferRollups.applyRetention()
+                        if sum(written.values()) > 0 or sum(deleted.values()) > 0:
+                            app.logger.info(f"[WGDashboard] {name} rolled up {written} and deleted {deleted} transfer rows")
+                    except Exception as e:
+                        app.logger.error(f"[WGDashboard] Background Thread #4 Error", e)
+                report = Maintenance.run(isIdle=dashboardIsIdle)
+                for name, r in report.items():
+                    if r["Reclaimed"] > 0:
+                        app.logger.info(f"[WGDashboard] Incremental vacuum reclaimed {r['Reclaimed']} bytes from {name}")
+                _, interval = DashboardConfig.GetConfig("Tracking", "rollup_interval")
+                try:
+                    interval = max(60, int(interval))
+                except (TypeError, ValueError):
+                    interval = 900
+                nextRun = time.monotonic() + interval
+        Maintenance.wait(max(0.0, nextRun - time.monotonic()))
 
 def gunicornConfig():
     _, app_ip = DashboardConfig.GetConfig("Server", "app_ip")
     _, app_port = DashboardConfig.GetConfig("Server", "app_port")
     return app_ip, app_port
 
+def gunicornThreadsConfig():
+    _, value = DashboardConfig.GetConfig("Server", "gunicorn_threads")
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 4
+
 def ProtocolsEnabled() -> list[str]:
     from shutil import which
     protocols = []
@@ -168,11 +260,57 @@ def InitWireguardConfigurationsList(startup: bool = False):
                 except WireguardConfiguration.InvalidConfigurationFileException as e:
                     app.logger.error(f"{i} have an invalid configuration file.")
 
+def configurationDirectories() -> dict[str, str]:
+    directories = {"wg": DashboardConfig.GetConfig("Server", "wg_conf_path")[1]}
+    if "awg" in ProtocolsEnabled():
+        directories["awg"] = DashboardConfig.GetConfig("Server", "awg_conf_path")[1]
+    return directories
+
+def configurationFileChanged(protocol: str, name: str):
+    with app.app_context(), ConfigurationsWatcher.lock:
+        if name in RenamingConfigurations:
+            return
+        try:
+            c = WireguardConfigurations.get(name)
+            if c is not None and c.Protocol == protocol:
+                # Not while a poll of this configuration reads the peers being reloaded
+                with PollScheduler.exclusive(name):
+                    reloaded = c.reloadConfigurationFile()
+                if reloaded:
+                    app.logger.info(f"[WGDashboard] Configuration {name} reloaded after its file changed")
+            elif c is None:
+                WireguardConfigurations[name] = WireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, name) \
+                    if protocol == 'wg' else AmneziaWireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, name)
+                app.logger.info(f"[WGDashboard] Configuration {name} added")
+        except WireguardConfiguration.InvalidConfigurationFileException as e:
+            app.logger.error(f"{name} have an invalid configuration file.")
+        except Exception as e:
+            app.logger.error(f"[WGDashboard] Failed to load configuration {name}", e)
+
+def configurationFileRemoved(protocol: str, name: str):
+    with app.app_context(), ConfigurationsWatcher.lock:
+        if name in RenamingConfigurations:
+            return
+        c = WireguardConfigurations.get(name)
+        if c is not None and c.Protocol == protocol and not os.path.exists(c.configPath):
+            WireguardConfigurations.pop(name, None)
+            app.logger.info(f"[WGDashboard] Configuration {name} removed after its file was deleted")
+
 def startThreads():
+    if not InterfaceStates.startListener():
+        app.logger.info("[WGDashboard] Netlink link events are unavailable, interface status is refreshed every second")
+    ConfigurationsWatcher.start()
     bgThread = threading.Thread(target=peerInformationBackgroundThread, daemon=True)
     bgThread.start()
     scheduleJobThread = threading.Thread(target=peerJobScheduleBackgroundThread, daemon=True)
     scheduleJobThread.start()
+    flushThread = threading.Thread(target=peerStateFlushBackgroundThread, daemon=True)
+    flushThread.start()
+    trackingThread = threading.Thread(target=trackingMaintenanceBackgroundThread, daemon=True)
+    trackingThread.start()
+    atexit.register(flushConfigurationSaves)
+    atexit.register(flushPeerStates)
+    DashboardPlugins.startThreads()
 
 dictConfig({
     'version': 1,
@@ -186,6 +324,9 @@ dictConfig({
 
 
 WireguardConfigurations: dict[str, WireguardConfiguration] = {}
+# Names of configurations being renamed, left alone by the configuration watcher until the rename is done
+RenamingConfigurations: set[str] = set()
+JobMetrics: PollCycleMetrics = PollCycleMetrics()
 CONFIGURATION_PATH = os.getenv('CONFIGURATION_PATH', '.')
 
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 5206928
@@ -197,11 +338,22 @@ with app.app_context():
     EmailSender = EmailSender(DashboardConfig)
     AllPeerShareLinks: PeerShareLinks = PeerShareLinks(DashboardConfig, WireguardConfigurations)
     AllPeerJobs: PeerJobs = PeerJobs(DashboardConfig, WireguardConfigurations, AllPeerShareLinks)
+    MetricsExporter: PrometheusExporter = PrometheusExporter(DashboardConfig)
+    Maintenance: DatabaseMaintenance = DatabaseMaintenance(DashboardConfig)
+    PollScheduler: ConfigurationPollScheduler = ConfigurationPollScheduler(app, peerPollingWorkersConfig())
+    ConfigurationsWatcher: ConfigurationWatcher = ConfigurationWatcher(
+        configurationDirectories, configurationFileChanged, configurationFileRemoved)
     DashboardLogger: DashboardLogger = DashboardLogger()
     DashboardPlugins: DashboardPlugins = DashboardPlugins(app, WireguardConfigurations)
     DashboardWebHooks: DashboardWebHooks = DashboardWebHooks(DashboardConfig)
     NewConfigurationTemplates: NewConfigurationTemplates = NewConfigurationTemplates()
     InitWireguardConfigurationsList(startup=True)
+    outdatedSchemas = [c.Name for c in WireguardConfigurations.values()
+                       if c.SchemaVersion < len(c.schemaMigrations(c.Name))]
+    if outdatedSchemas:
+        app.logger.error(f"[WGDashboard] Database schema migrations are incomplete for: {', '.join(outdatedSchemas)}")
+    else:
+        app.logger.info(f"[WGDashboard] Database schema of {len(WireguardConfigurations)} configuration(s) is up to date")
     DashboardClients: DashboardClients = DashboardClients(WireguardConfigurations)
     app.register_blueprint(createClientBlueprint(WireguardConfigurations, DashboardConfig, DashboardClients))
 
@@ -331,7 +483,6 @@ def API_SignOut():
 
 @app.get(f'{APP_PREFIX}/api/getWireguardConfigurations')
 def API_getWireguardConfigurations():
-    InitWireguardConfigurationsList()
     return ResponseObject(data=[wc for wc in WireguardConfigurations.values()])
 
 @app.get(f'{APP_PREFIX}/api/newConfigurationTemplates')
@@ -375,49 +526,50 @@ def API_addWireguardConfiguration():
     if data.get("Protocol") not in ProtocolsEnabled():
         return ResponseObject(False, "Please provide a valid protocol: wg / awg.")
 
-    # Check duplicate names, ports, address
-    for i in WireguardConfigurations.values():
-        if i.Name == data['ConfigurationName']:
-            return ResponseObject(False,
-                                  f"Already have a configuration with the name \"{data['ConfigurationName']}\"",
-                                  "ConfigurationName")
-
-        if str(i.ListenPort) == str(data["ListenPort"]):
-            return ResponseObject(False,
-                                  f"Already have a configuration with the port \"{data['ListenPort']}\"",
-                                  "ListenPort")
-
-        if i.Address == data["Address"]:
-            return ResponseObject(False,
-                                  f"Already have a configuration with the address \"{data['Address']}\"",
-                                  "Address")
-
-    if "Backup" in data.keys():
-        path = {
-            "wg": DashboardConfig.GetConfig("Server", "wg_conf_path")[1],
-            "awg": DashboardConfig.GetConfig("Server", "awg_conf_path")[1]
-        }
+    with ConfigurationsWatcher.lock:
+        # Check duplicate names, ports, address
+        for i in WireguardConfigurations.values():
+            if i.Name == data['ConfigurationName']:
+                return ResponseObject(False,
+                                      f"Already have a configuration with the name \"{data['ConfigurationName']}\"",
+                                      "ConfigurationName")
+
+            if str(i.ListenPort) == str(data["ListenPort"]):
+                return ResponseObject(False,
+                                      f"Already have a configuration with the port \"{data['ListenPort']}\"",
+                                      "ListenPort")
+
+            if i.Address == data["Address"]:
+                return ResponseObject(False,
+                                      f"Already have a configuration with the address \"{data['Address']}\"",
+                                      "Address")
+
+        if "Backup" in data.keys():
+            path = {
+                "wg": DashboardConfig.GetConfig("Server", "wg_conf_path")[1],
+                "awg": DashboardConfig.GetConfig("Server", "awg_conf_path")[1]
+            }
      
-        if (os.path.exists(os.path.join(path['wg'], 'WGDashboard_Backup', data["Backup"])) and
-                os.path.exists(os.path.join(path['wg'], 'WGDashboard_Backup', data["Backup"].replace('.conf', '.sql')))):
-            protocol = "wg"
-        elif (os.path.exists(os.path.join(path['awg'], 'WGDashboard_Backup', data["Backup"])) and
-              os.path.exists(os.path.join(path['awg'], 'WGDashboard_Backup', data["Backup"].replace('.conf', '.sql')))):
-            protocol = "awg"
-        else:
-            return ResponseObject(False, "Backup does not exist")
+            if (os.path.exists(os.path.join(path['wg'], 'WGDashboard_Backup', data["Backup"])) and
+                    os.path.exists(os.path.join(path['wg'], 'WGDashboard_Backup', data["Backup"].replace('.conf', '.sql')))):
+                protocol = "wg"
+            elif (os.path.exists(os.path.join(path['awg'], 'WGDashboard_Backup', data["Backup"])) and
+                  os.path.exists(os.path.join(path['awg'], 'WGDashboard_Backup', data["Backup"].replace('.conf', '.sql')))):
+                protocol = "awg"
+            else:
+                return ResponseObject(False, "Backup does not exist")
         
-        shutil.copy(
-            os.path.join(path[protocol], 'WGDashboard_Backup', data["Backup"]),
-            os.path.join(path[protocol], f'{data["ConfigurationName"]}.conf')
-        )
-        WireguardConfigurations[data['ConfigurationName']] = (
-            WireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, data=data, name=data['ConfigurationName'])) if protocol == 'wg' else (
-            AmneziaWireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, data=data, name=data['ConfigurationName']))
-    else:
-        WireguardConfigurations[data['ConfigurationName']] = (
-            WireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, data=data)) if data.get('Protocol') == 'wg' else (
-            AmneziaWireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, data=data))
+            shutil.copy(
+                os.path.join(path[protocol], 'WGDashboard_Backup', data["Backup"]),
+                os.path.join(path[protocol], f'{data["ConfigurationName"]}.conf')
+            )
+            WireguardConfigurations[data['ConfigurationName']] = (
+                WireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, data=data, name=data['ConfigurationName'])) if protocol == 'wg' else (
+                AmneziaWireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, data=data, name=data['ConfigurationName']))
+        else:
+            WireguardConfigurations[data['ConfigurationName']] = (
+                WireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, data=data)) if data.get('Protocol') == 'wg' else (
+                AmneziaWireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, data=data))
     return ResponseObject()
 
 @app.get(f'{APP_PREFIX}/api/toggleWireguardConfiguration')
@@ -491,11 +643,12 @@ def API_deleteWireguardConfiguration():
     data = request.get_json()
     if "ConfigurationName" not in data.keys() or data.get("ConfigurationName") is None or data.get("ConfigurationName") not in WireguardConfigurations.keys():
         return ResponseObject(False, "Please provide the configuration name you want to delete", status_code=404)
-    rp =  WireguardConfigurations.pop(data.get("ConfigurationName"))
-    
-    status = rp.deleteConfiguration()
-    if not status:
-        WireguardConfigurations[data.get("ConfigurationName")] = rp
+    with ConfigurationsWatcher.lock:
+        rp =  WireguardConfigurations.pop(data.get("ConfigurationName"))
+
+        status = rp.deleteConfiguration()
+        if not status:
+            WireguardConfigurations[data.get("ConfigurationName")] = rp
     return ResponseObject(status)
 
 @app.post(f'{APP_PREFIX}/api/renameWireguardConfiguration')
@@ -507,16 +660,29 @@ def API_renameWireguardConfiguration():
                 (k == "ConfigurationName" and data.get(k) not in WireguardConfigurations.keys())): 
             return ResponseObject(False, "Please provide the configuration name you want to rename", status_code=404)
     
-    if data.get("NewConfigurationName") in WireguardConfigurations.keys():
-        return ResponseObject(False, "Configuration name already exist", status_code=400)
-    
-    rc = WireguardConfigurations.pop(data.get("ConfigurationName"))
-    
-    status, message = rc.renameConfiguration(data.get("NewConfigurationName"))
-    if status:
-        WireguardConfigurations[data.get("NewConfigurationName")] = (WireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, data.get("NewConfigurationName")) if rc.Protocol == 'wg' else AmneziaWireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, data.get("NewConfigurationName")))
-    else:
-        WireguardConfigurations[data.get("ConfigurationName")] = rc
+    name, newName = data.get("ConfigurationName"), data.get("NewConfigurationName")
+    # Only the registry swap holds the watcher lock, both names are reserved while the files and tables are copied
+    with ConfigurationsWatcher.lock:
+        if newName in WireguardConfigurations.keys() or newName in RenamingConfigurations:
+            return ResponseObject(False, "Configuration name already exist", status_code=400)
+        rc = WireguardConfigurations.pop(name, None)
+        if rc is None or name in RenamingConfigurations:
+            return ResponseObject(False, "Please provide the configuration name you want to rename", status_code=404)
+        RenamingConfigurations.update((name, newName))
+
+    status, message, nc = False, None, None
+    try:
+        with PollScheduler.exclusive(name):
+            status, message = rc.renameConfiguration(newName)
+        if status:
+            nc = (WireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, newName) if rc.Protocol == 'wg' else AmneziaWireguardConfiguration(DashboardConfig, AllPeerJobs, AllPeerShareLinks, DashboardWebHooks, newName))
+    finally:
+        with ConfigurationsWatcher.lock:
+            RenamingConfigurations.difference_update((name, newName))
+            if not status:
+                WireguardConfigurations.setdefault(name, rc)
+            elif nc is not None:
+                WireguardConfigurations.setdefault(newName, nc)
     return ResponseObject(status, message)
 
 @app.get(f'{APP_PREFIX}/api/getWireguardConfigurationRealtimeTraffic')
@@ -640,9 +806,11 @@ def API_updateDashboardConfigurationItem():
         return ResponseObject(False, msg)
     if data['section'] == "Server":
         if data['key'] == 'wg_conf_path':
-            WireguardConfigurations.clear()
-            WireguardConfigurations.clear()
-            InitWireguardConfigurationsList()
+            with ConfigurationsWatcher.lock:
+                WireguardConfigurations.clear()
+                WireguardConfigurations.clear()
+                InitWireguardConfigurationsList()
+            ConfigurationsWatcher.refresh()
     return ResponseObject(True, data=DashboardConfig.GetConfig(data["section"], data["key"])[1])
 
 @app.get(f'{APP_PREFIX}/api/getDashboardAPIKeys')
@@ -704,7 +872,7 @@ def API_updatePeerSettings(configName):
                 "configuration": wireguardConfig.Name,
                 "peers": [id]
             })
-            return ResponseObject(status, msg)
+            return SavedResponseObject(wireguardConfig, status, msg)
             
     return ResponseObject(False, "Peer does not exist")
 
@@ -725,7 +893,7 @@ def API_resetPeerData(configName):
         wgc.restrictPeers([id])
         wgc.allowAccessPeers([id])
     
-    return ResponseObject(status=resetStatus)
+    return SavedResponseObject(wgc, resetStatus)
 
 @app.post(f'{APP_PREFIX}/api/deletePeers/<configName>')
 def API_deletePeers(configName: str) -> ResponseObject:
@@ -744,7 +912,7 @@ def API_deletePeers(configName: str) -> ResponseObject:
             for c in assignments:
                 DashboardClients.DashboardClientsPeerAssignment.UnassignClients(c.AssignmentID)
         
-        return ResponseObject(status, msg)
+        return SavedResponseObject(configuration, status, msg)
 
     return ResponseObject(False, "Configuration does not exist", status_code=404)
 
@@ -757,7 +925,7 @@ def API_restrictPeers(configName: str) -> ResponseObject:
             return ResponseObject(False, "Please specify one or more peers")
         configuration = WireguardConfigurations.get(configName)
         status, msg = configuration.restrictPeers(peers)
-        return ResponseObject(status, msg)
+        return SavedResponseObject(configuration, status, msg)
     return ResponseObject(False, "Configuration does not exist", status_code=404)
 
 @app.post(f'{APP_PREFIX}/api/sharePeer/create')
@@ -824,7 +992,7 @@ def API_allowAccessPeers(configName: str) -> ResponseObject:
             return ResponseObject(False, "Please specify one or more peers")
         configuration = WireguardConfigurations.get(configName)
         status, msg = configuration.allowAccessPeers(peers)
-        return ResponseObject(status, msg)
+        return SavedResponseObject(configuration, status, msg)
     return ResponseObject(False, "Configuration does not exist")
 
 @app.post(f'{APP_PREFIX}/api/addPeers/<configName>')
@@ -912,7 +1080,7 @@ def API_addPeers(configName):
                 if len(keyPairs) == 0 or (bulkAdd and len(keyPairs) != bulkAddAmount):
                     return ResponseObject(False, "Generating key pairs by bulk failed")
                 status, addedPeers, message = config.addPeers(keyPairs)
-                return ResponseObject(status=status, message=message, data=addedPeers)
+                return SavedResponseObject(config, status, message, addedPeers)
     
             else:
                 if config.searchPeer(public_key)[0] is True:
@@ -968,7 +1136,7 @@ def API_addPeers(configName):
                         "advanced_security": "off"
                     }]
                 )
-                return ResponseObject(status=status, message=message, data=addedPeers)
+                return SavedResponseObject(config, status, message, addedPeers)
         except Exception as e:
             app.logger.error("Add peers failed", e)
             return ResponseObject(False,
@@ -1021,12 +1189,38 @@ def API_getConfigurationInfo():
     configurationName = request.args.get("configurationName")
     if not configurationName or configurationName not in WireguardConfigurations.keys():
         return ResponseObject(False, "Please provide configuration name")
+    WireguardConfigurations[configurationName].markViewed()
     return ResponseObject(data={
         "configurationInfo": WireguardConfigurations[configurationName],
         "configurationPeers": WireguardConfigurations[configurationName].getPeersList(),
-        "configurationRestrictedPeers": WireguardConfigurations[configurationName].getRestrictedPeersList()
+        "configurationRestrictedPeers": WireguardConfigurations[configurationName].RestrictedPeers
+    })
+
+@app.get(f'{APP_PREFIX}/api/metrics/pollCycle')
+def API_getPollCycleMetrics():
+    last = request.args.get("last", "20")
+    if not last.isdigit():
+        return ResponseObject(False, "Please provide a valid number of cycles")
+    configurationName = request.args.get("configurationName")
+    if configurationName and configurationName not in WireguardConfigurations.keys():
+        return ResponseObject(False, "Configuration does not exist")
+    configurations = [configurationName] if configurationName else list(WireguardConfigurations.keys())
+    return ResponseObject(data={
+        "Configurations": {
+            name: WireguardConfigurations[name].PollMetrics.toJson(int(last))
+            for name in configurations if name in WireguardConfigurations.keys()
+        },
+        "Jobs": JobMetrics.toJson(int(last), "jobs")
     })
 
+@app.get(f'{APP_PREFIX}/metrics')
+def metrics():
+    if not MetricsExporter.isEnabled():
+        return ResponseObject(False, "Metrics are disabled", status_code=404)
+    response = Flask.make_response(app, MetricsExporter.render(WireguardConfigurations))
+    response.content_type = PrometheusExporter.ContentType
+    return response
+
 @app.get(f'{APP_PREFIX}/api/getPeerHistoricalEndpoints')
 def API_GetPeerHistoricalEndpoints():
     configurationName = request.args.get("configurationName")
@@ -1085,10 +1279,20 @@ def API_GetPeerTraffics():
         interval = request.args.get('interval', 30)
         startDate = request.args.get('startDate', None)
         endDate = request.args.get('endDate', None)
+        points = request.args.get('points', None)
+        bucket = request.args.get('bucket', None)
         if type(interval) is str:
             if not interval.isdigit():
                 return ResponseObject(False, "Interval must be integers in minutes")
             interval = int(interval)
+        if points is not None:
+            if not points.isdigit() or int(points) < 3:
+                return ResponseObject(False, "Points must be an integer of at least 3")
+            points = int(points)
+        if bucket is not None:
+            if not bucket.isdigit() or int(bucket) < 1:
+                return ResponseObject(False, "Bucket must be a positive integer in seconds")
+            bucket = int(bucket)
         if startDate is None:
             endDate = None
         else:
@@ -1103,7 +1307,7 @@ def API_GetPeerTraffics():
         return ResponseObject(False, "Please provide configurationName and id")
     fp, p = WireguardConfigurations.get(configurationName).searchPeer(id)
     if fp:
-        return ResponseObject(data=p.getTraffics(interval, startDate, endDate))
+        return ResponseObject(data=p.getTraffics(interval, startDate, endDate, points, bucket))
     return ResponseObject(False, "Peer does not exist")
 
 @app.get(f'{APP_PREFIX}/api/getPeerTrackingTableCounts')
@@ -1117,6 +1321,44 @@ def API_GetPeerTrackingTableCounts():
         "HistoricalTrackingTableSize": c.getHistoricalEndpointTableSize()
     })
 
+@app.get(f'{APP_PREFIX}/api/getTopTalkers')
+def API_GetTopTalkers():
+    configurationName = request.args.get("configurationName", None)
+    if configurationName is not None and configurationName not in WireguardConfigurations.keys():
+        return ResponseObject(False, "Configuration does not exist")
+    limit = request.args.get('limit', '10')
+    hours = request.args.get('hours', '24')
+    if not limit.isdigit() or not 0 < int(limit) <= 1000:
+        return ResponseObject(False, "Limit must be an integer between 1 and 1000")
+    limit = int(limit)
+    try:
+        startDate = request.args.get('startDate', None)
+        endDate = request.args.get('endDate', None)
+        if startDate is not None:
+            startDate = datetime.strptime(startDate, "%Y-%m-%d")
+            endDate = datetime.strptime(endDate, "%Y-%m-%d") if endDate else startDate
+            endDate = endDate.replace(hour=23, minute=59, second=59, microsecond=999999)
+            if startDate > endDate:
+                return ResponseObject(False, "startDate must be smaller than endDate")
+        else:
+            if not hours.isdigit() or int(hours) <= 0:
+                return ResponseObject(False, "Hours must be a positive integer")
+            # Whole minutes, so repeated requests share the cached result
+            endDate = datetime.now().replace(second=0, microsecond=0)
+            startDate = endDate - timedelta(hours=int(hours))
+    except ValueError:
+        return ResponseObject(False, "Dates are invalid")
+    configurations = [WireguardConfigurations.get(configurationName)] if configurationName is not None \
+        else list(WireguardConfigurations.values())
+    result = {"Peers": [], "Receive": 0, "Sent": 0, "Total": 0, "PeerCount": 0}
+    for c in configurations:
+        topTalkers = c.getTopTalkers(startDate, endDate, limit)
+        result["Peers"] += topTalkers["Peers"]
+        for key in ["Receive", "Sent", "Total", "PeerCount"]:
+            result[key] += topTalkers[key]
+    result["Peers"] = sorted(result["Peers"], key=lambda p: p["total"], reverse=True)[:limit]
+    return ResponseObject(data=result)
+
 @app.get(f'{APP_PREFIX}/api/downloadPeerTrackingTable')
 def API_DownloadPeerTackingTable():
     configurationName = request.args.get("configurationName")
@@ -1126,9 +1368,28 @@ def API_DownloadPeerTackingTable():
     if table not in ['TrafficTrackingTable', 'HistoricalTrackingTable']:
         return ResponseObject(False, "Table does not exist")
     c = WireguardConfigurations.get(configurationName)
-    return ResponseObject(
-        data=c.downloadTransferTable() if table == 'TrafficTrackingTable' 
-        else c.downloadHistoricalEndpointTable())
+    exportFormat = request.args.get('format', 'json')
+    if exportFormat == 'json':
+        return ResponseObject(
+            data=c.downloadTransferTable() if table == 'TrafficTrackingTable' 
+            else c.downloadHistoricalEndpointTable())
+    if exportFormat not in TrackingTableExport.Formats.keys():
+        return ResponseObject(False, "Format must be json, ndjson or csv")
+    try:
+        startDate = request.args.get('startDate', None)
+        endDate = request.args.get('endDate', None)
+        if startDate is not None:
+            startDate = datetime.strptime(startDate, "%Y-%m-%d")
+        if endDate is not None:
+            endDate = datetime.strptime(endDate, "%Y-%m-%d").replace(hour=23, minute=59, second=59, microsecond=999999)
+    except ValueError:
+        return ResponseObject(False, "Dates are invalid")
+    export = TrackingTableExport(exportFormat, request.args.get('gzip', 'false').lower() == 'true')
+    rows = c.streamTrackingTable(table, request.args.get('id', None), startDate, endDate)
+    response = app.response_class(stream_with_context(export.stream(rows)), mimetype=export.mimetype())
+    response.headers["Content-Disposition"] = \
+        f'attachment; filename="{export.filename(f"{configurationName}_{table}")}"'
+    return response
 
 @app.post(f'{APP_PREFIX}/api/deletePeerTrackingTable')
 def API_DeletePeerTrackingTable():
@@ -1140,9 +1401,18 @@ def API_DeletePeerTrackingTable():
     if not table or table not in ['TrafficTrackingTable', 'HistoricalTrackingTable']:
         return ResponseObject(False, "Table does not exist")
     c = WireguardConfigurations.get(configurationName)
-    return ResponseObject(
-        status=c.deleteTransferTable() if table == 'TrafficTrackingTable'
-        else c.deleteHistoryEndpointTable())
+    # Deleted in batches by the maintenance thread, the request does not wait for it
+    Maintenance.schedule(
+        f"{configurationName}/{table}",
+        c.deleteTransferTable if table == 'TrafficTrackingTable' else c.deleteHistoryEndpointTable)
+    return ResponseObject(message="The table will be cleared shortly")
+
+@app.post(f'{APP_PREFIX}/api/enableIncrementalVacuum')
+def API_EnableIncrementalVacuum():
+    if DashboardConfig.GetConfig("Database", "type")[1] != 'sqlite':
+        return ResponseObject(False, "Only SQLite databases need to be switched to incremental vacuum")
+    Maintenance.requestConversion()
+    return ResponseObject(message="The databases will be switched to incremental vacuum shortly")
 
 @app.get(f'{APP_PREFIX}/api/getDashboardTheme')
 def API_getDashboardTheme():
@@ -1702,5 +1972,4 @@ def index():
 
 if __name__ == "__main__":
     startThreads()
-    DashboardPlugins.startThreads()
     app.run(host=app_ip, debug=False, port=app_port)
\ No newline at end of file
@@ -2,15 +2,20 @@ import dashboard
 from datetime import datetime
 global sqldb, cursor, DashboardConfig, WireguardConfigurations, AllPeerJobs, JobLogger, Dash
 app_host, app_port = dashboard.gunicornConfig()
+app_threads = dashboard.gunicornThreadsConfig()
 date = datetime.today().strftime('%Y_%m_%d_%H_%M_%S')
 
 def post_worker_init(worker):
     dashboard.startThreads()
-    dashboard.DashboardPlugins.startThreads()
+
+def worker_exit(server, worker):
+    dashboard.flushConfigurationSaves()
+    dashboard.flushPeerStates()
 
 worker_class = 'gthread'
+# A single worker: the dashboard configuration, API keys, peer states and poll metrics live in its memory
 workers = 1
-threads = 2
+threads = app_threads
 bind = f"{app_host}:{app_port}"
 daemon = True
 pidfile = './gunicorn.pid'
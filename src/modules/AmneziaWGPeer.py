@@ -10,9 +10,12 @@ from .Utilities import ValidateIPAddressesWithRange, ValidateDNSAddress, Generat
 
 class AmneziaWGPeer(Peer):
     def __init__(self, tableData, configuration):
-        self.advanced_security = tableData["advanced_security"]
         super().__init__(tableData, configuration)
 
+    def updateTableData(self, tableData):
+        self.advanced_security = tableData["advanced_security"]
+        super().updateTableData(tableData)
+
 
     def updatePeer(self, name: str, private_key: str,
                    preshared_key: str,
@@ -66,16 +69,13 @@ class AmneziaWGPeer(Peer):
 
             if len(updateAllowedIp.decode().strip("\n")) != 0:
                 return False, "Update peer failed when updating Allowed IPs"
-            saveConfig = subprocess.check_output(f"{self.configuration.Protocol}-quick save {self.configuration.Name}",
-                                                 shell=True, stderr=subprocess.STDOUT)
-            if f"wg showconf {self.configuration.Name}" not in saveConfig.decode().strip('\n'):
-                return False, "Update peer failed when saving the configuration"
 
             with self.configuration.engine.begin() as conn:
                 conn.execute(
                     self.configuration.peersTable.update().values({
                         "name": name,
                         "private_key": private_key,
+                        "allowed_ip": newAllowedIPs,
                         "DNS": dns_addresses,
                         "endpoint_allowed_ip": endpoint_allowed_ip,
                         "mtu": mtu,
@@ -86,7 +86,8 @@ class AmneziaWGPeer(Peer):
                         self.configuration.peersTable.c.id == self.id
                     )
                 )
-            self.configuration.getPeers()
+            self.configuration.SaveScheduler.schedule()
+            self.configuration.loadPeersFromDatabase()
             return True, None
         except subprocess.CalledProcessError as exc:
             return False, exc.output.decode("UTF-8").strip()
\ No newline at end of file
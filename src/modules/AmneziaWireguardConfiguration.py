@@ -6,8 +6,8 @@ from flask import current_app
 from .PeerJobs import PeerJobs
 from .AmneziaWGPeer import AmneziaWGPeer
 from .PeerShareLinks import PeerShareLinks
-from .Utilities import RegexMatch
 from .WireguardConfiguration import WireguardConfiguration
+from .WireguardPeerBatch import WireguardPeerBatch
 from .DashboardWebHooks import DashboardWebHooks
 
 
@@ -53,6 +53,8 @@ class AmneziaWireguardConfiguration(WireguardConfiguration):
             "TotalPeers": len(self.Peers),
             "Protocol": self.Protocol,
             "Table": self.Table,
+            "PollStatementCount": self.PollStatementCount,
+            "SaveError": self.SaveScheduler.LastResult[1],
             "Jc": self.Jc,
             "Jmin": self.Jmin,
             "Jmax": self.Jmax,
@@ -169,88 +171,18 @@ class AmneziaWireguardConfiguration(WireguardConfiguration):
                               (sqlalchemy.DATETIME if self.DashboardConfig.GetConfig("Database", "type")[1] == 'sqlite' else sqlalchemy.TIMESTAMP)),
             extend_existing=True
         )
+        self.TransferRollups.createTables(dbName)
 
         self.metadata.create_all(self.engine)
+        self.migrateDatabase(dbName)
 
-    def getPeers(self):
-        self.Peers.clear()        
-        if self.configurationFileChanged():
-            with open(self.configPath, 'r') as configFile:
-                p = []
-                pCounter = -1
-                content = configFile.read().split('\n')
-                try:
-                    if "[Peer]" not in content:
-                        current_app.logger.info(f"{self.Name} config has no [Peer] section")
-                        return
+    def createPeerObject(self, tableData) -> AmneziaWGPeer:
+        return AmneziaWGPeer(tableData, self)
 
-                    peerStarts = content.index("[Peer]")
-                    content = content[peerStarts:]
-                    for i in content:
-                        if not RegexMatch("#(.*)", i) and not RegexMatch(";(.*)", i):
-                            if i == "[Peer]":
-                                pCounter += 1
-                                p.append({})
-                                p[pCounter]["name"] = ""
-                            else:
-                                if len(i) > 0:
-                                    split = re.split(r'\s*=\s*', i, 1)
-                                    if len(split) == 2:
-                                        p[pCounter][split[0]] = split[1]
-
-                        if RegexMatch("#Name# = (.*)", i):
-                            split = re.split(r'\s*=\s*', i, 1)
-                            if len(split) == 2:
-                                p[pCounter]["name"] = split[1]
-                    with self.engine.begin() as conn:
-                        for i in p:
-                            if "PublicKey" in i.keys():
-                                tempPeer = conn.execute(self.peersTable.select().where(
-                                    self.peersTable.columns.id == i['PublicKey']
-                                )).mappings().fetchone()
-                                if tempPeer is None:
-                                    tempPeer = {
-                                        "id": i['PublicKey'],
-                                        "advanced_security": i.get('AdvancedSecurity', 'off'),
-                                        "private_key": "",
-                                        "DNS": self.DashboardConfig.GetConfig("Peers", "peer_global_DNS")[1],
-                                        "endpoint_allowed_ip": self.DashboardConfig.GetConfig("Peers", "peer_endpoint_allowed_ip")[
-                                            1],
-                                        "name": i.get("name"),
-                                        "total_receive": 0,
-                                        "total_sent": 0,
-                                        "total_data": 0,
-                                        "endpoint": "N/A",
-                                        "status": "stopped",
-                                        "latest_handshake": "N/A",
-                                        "allowed_ip": i.get("AllowedIPs", "N/A"),
-                                        "cumu_receive": 0,
-                                        "cumu_sent": 0,
-                                        "cumu_data": 0,
-                                        "mtu": self.DashboardConfig.GetConfig("Peers", "peer_mtu")[1],
-                                        "keepalive": self.DashboardConfig.GetConfig("Peers", "peer_keep_alive")[1],
-                                        "remote_endpoint": self.DashboardConfig.GetConfig("Peers", "remote_endpoint")[1],
-                                        "preshared_key": i["PresharedKey"] if "PresharedKey" in i.keys() else ""
-                                    }
-                                    conn.execute(
-                                        self.peersTable.insert().values(tempPeer)
-                                    )
-                                else:
-                                    conn.execute(
-                                        self.peersTable.update().values({
-                                            "allowed_ip": i.get("AllowedIPs", "N/A")
-                                        }).where(
-                                            self.peersTable.columns.id == i['PublicKey']
-                                        )
-                                    )
-                                self.Peers.append(AmneziaWGPeer(tempPeer, self))
-                except Exception as e:
-                    current_app.logger.error(f"{self.Name} getPeers() Error", e)
-        else:
-            with self.engine.connect() as conn:
-                existingPeers = conn.execute(self.peersTable.select()).mappings().fetchall()
-                for i in existingPeers:
-                    self.Peers.append(AmneziaWGPeer(i, self))
+    def newPeerTableData(self, peerSection: dict) -> dict:
+        tableData = super().newPeerTableData(peerSection)
+        tableData["advanced_security"] = peerSection.get('AdvancedSecurity', 'off')
+        return tableData
 
     def addPeers(self, peers: list) -> tuple[bool, list, str]:
         result = {
@@ -258,57 +190,47 @@ class AmneziaWireguardConfiguration(WireguardConfiguration):
             "peers": []
         }
         try:
-            with self.engine.begin() as conn:
-                for i in peers:
-                    newPeer = {
-                        "id": i['id'],
-                        "private_key": i['private_key'],
-                        "DNS": i['DNS'],
-                        "endpoint_allowed_ip": i['endpoint_allowed_ip'],
-                        "name": i['name'],
-                        "total_receive": 0,
-                        "total_sent": 0,
-                        "total_data": 0,
-                        "endpoint": "N/A",
-                        "status": "stopped",
-                        "latest_handshake": "N/A",
-                        "allowed_ip": i.get("allowed_ip", "N/A"),
-                        "cumu_receive": 0,
-                        "cumu_sent": 0,
-                        "cumu_data": 0,
-                        "mtu": i['mtu'],
-                        "keepalive": i['keepalive'],
-                        "remote_endpoint": self.DashboardConfig.GetConfig("Peers", "remote_endpoint")[1],
-                        "preshared_key": i["preshared_key"],
-                        "advanced_security": i['advanced_security']
-                    }
-                    conn.execute(
-                        self.peersTable.insert().values(newPeer)
-                    )
-            for p in peers:
-                presharedKeyExist = len(p['preshared_key']) > 0
-                rd = random.Random()
-                uid = str(uuid.UUID(int=rd.getrandbits(128), version=4))
-                if presharedKeyExist:
-                    with open(uid, "w+") as f:
-                        f.write(p['preshared_key'])
-
-                subprocess.check_output(
-                    f"{self.Protocol} set {self.Name} peer {p['id']} allowed-ips {p['allowed_ip'].replace(' ', '')}{f' preshared-key {uid}' if presharedKeyExist else ''}",
-                    shell=True, stderr=subprocess.STDOUT)
-                if presharedKeyExist:
-                    os.remove(uid)
-            subprocess.check_output(
-                f"{self.Protocol}-quick save {self.Name}", shell=True, stderr=subprocess.STDOUT)
-            self.getPeers()
-            for p in peers:
-                p = self.searchPeer(p['id'])
+            rows = []
+            for i in peers:
+                rows.append({
+                    "id": i['id'],
+                    "private_key": i['private_key'],
+                    "DNS": i['DNS'],
+                    "endpoint_allowed_ip": i['endpoint_allowed_ip'],
+                    "name": i['name'],
+                    "total_receive": 0,
+                    "total_sent": 0,
+                    "total_data": 0,
+                    "endpoint": "N/A",
+                    "status": "stopped",
+                    "latest_handshake": "N/A",
+                    "allowed_ip": i.get("allowed_ip", "N/A"),
+                    "cumu_receive": 0,
+                    "cumu_sent": 0,
+                    "cumu_data": 0,
+                    "mtu": i['mtu'],
+                    "keepalive": i['keepalive'],
+                    "remote_endpoint": self.DashboardConfig.GetConfig("Peers", "remote_endpoint")[1],
+                    "preshared_key": i["preshared_key"],
+                    "advanced_security": i['advanced_security']
+                })
+            failed = self.insertPeers(rows)
+            if len(failed) < len(rows):
+                self.SaveScheduler.schedule()
+            self.loadPeersFromDatabase()
+            added = [p['id'] for p in peers if p['id'] not in failed]
+            for p in added:
+                p = self.searchPeer(p)
                 if p[0]:
                     result['peers'].append(p[1])
-            self.DashboardWebHooks.RunWebHook("peer_created", {
-                "configuration": self.Name,
-                "peers": list(map(lambda k : k['id'], peers))
-            })
+            if len(added) > 0:
+                self.DashboardWebHooks.RunWebHook("peer_created", {
+                    "configuration": self.Name,
+                    "peers": added
+                })
+            if len(failed) > 0:
+                return False, result['peers'], \
+                    f"Failed to add {len(failed)} peer(s): {WireguardPeerBatch.summary(failed)}"
         except Exception as e:
             current_app.logger.error("Add peers error", e)
             return False, [], str(e)
@@ -0,0 +1,69 @@
+"""
+Configuration Poll Scheduler
+"""
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+
+
+class ConfigurationPollScheduler:
+    """
+    Runs the poll of every configuration as its own task in a bounded thread pool.
+    A configuration whose previous poll is still running is skipped instead of queued twice.
+    """
+    def __init__(self, app, workers: int = 4):
+        self.app = app
+        self.workers = max(1, workers)
+        self.__executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="WGDashboardPoll")
+        self.__locks: dict[str, threading.Lock] = {}
+        self.__locksLock = threading.Lock()
+
+    def __getLock(self, name: str) -> threading.Lock:
+        with self.__locksLock:
+            if name not in self.__locks.keys():
+                self.__locks[name] = threading.Lock()
+            return self.__locks[name]
+
+    def isRunning(self, name: str) -> bool:
+        return self.__getLock(name).locked()
+
+    @contextmanager
+    def exclusive(self, name: str):
+        """
+        Hold the overlap lock of a configuration, waiting for its running poll, no poll starts until it is released
+        @param name: Configuration name
+        """
+        lock = self.__getLock(name)
+        lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def submit(self, name: str, task, *args) -> Future | None:
+        """
+        Schedule a poll of a configuration
+        @param name: Configuration name, used as the key of the overlap lock
+        @param task: Callable to run inside the application context
+        @return: Future of the task, or None if a poll of this configuration is still running
+        """
+        lock = self.__getLock(name)
+        if not lock.acquire(blocking=False):
+            return None
+        try:
+            return self.__executor.submit(self.__run, name, lock, task, *args)
+        except Exception:
+            lock.release()
+            raise
+
+    def __run(self, name: str, lock: threading.Lock, task, *args):
+        try:
+            with self.app.app_context():
+                task(*args)
+        except Exception as e:
+            self.app.logger.error(f"[WGDashboard] Polling {name} failed", e)
+        finally:
+            lock.release()
+
+    def shutdown(self, wait: bool = True):
+        self.__executor.shutdown(wait=wait)
@@ -0,0 +1,76 @@
+"""
+Configuration Save Scheduler
+"""
+import threading, time
+
+
+class ConfigurationSaveScheduler:
+    """
+    Coalesces the saves of one configuration. A save requested while another one is waiting only
+    pushes it back, by delay seconds and never more than maxDelay seconds after the first request,
+    so a burst of changes ends with a single save.
+    """
+    def __init__(self, save, delay: float = 1.0, maxDelay: float = 5.0):
+        """
+        @param save: Callable writing the configuration, returning a tuple of status and error message
+        @param delay: Seconds without a new request before saving
+        @param maxDelay: Seconds after the first request of a burst by which the save runs anyway
+        """
+        self.save = save
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self.__condition = threading.Condition()
+        self.__saveLock = threading.Lock()
+        self.__timer: threading.Timer | None = None
+        self.__firstRequestTime: float = 0
+        self.__requested: int = 0
+        self.__saved: int = 0
+        self.LastResult: tuple[bool, str] | tuple[bool, None] = (True, None)
+
+    def isPending(self) -> bool:
+        with self.__condition:
+            return self.__saved < self.__requested
+
+    def schedule(self):
+        """
+        Request a save, it runs once the requests stop for delay seconds
+        """
+        with self.__condition:
+            now = time.monotonic()
+            self.__requested += 1
+            if self.__timer is None:
+                self.__firstRequestTime = now
+            else:
+                self.__timer.cancel()
+            wait = max(0.0, min(self.delay, self.__firstRequestTime + self.maxDelay - now))
+            self.__timer = threading.Timer(wait, self.__run)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def __run(self) -> tuple[bool, str] | tuple[bool, None]:
+        with self.__condition:
+            if self.__timer is not None and self.__timer is not threading.current_thread():
+                self.__timer.cancel()
+            self.__timer = None
+            target = self.__requested
+        with self.__saveLock:
+            with self.__condition:
+                if self.__saved >= target:
+                    return self.LastResult
+            result = self.save()
+            with self.__condition:
+                self.__saved = max(self.__saved, target)
+                self.LastResult = result
+                self.__condition.notify_all()
+            return result
+
+    def flush(self) -> tuple[bool, str] | tuple[bool, None]:
+        """
+        Run the pending save now, or wait for the one in progress. Used where the file has to be
+        up to date before going on.
+        @return: Result of the last save
+        """
+        with self.__condition:
+            if self.__saved >= self.__requested:
+                return self.LastResult
+        return self.__run()
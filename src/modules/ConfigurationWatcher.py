@@ -0,0 +1,198 @@
+"""
+Configuration Watcher
+"""
+import ctypes, ctypes.util, errno, os, select, struct, threading, time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WatchMask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+            IN_DELETE_SELF | IN_MOVE_SELF
+EventHeader = struct.Struct("iIII")
+
+
+class ConfigurationWatcher:
+    """
+    Keeps a registry of the .conf files in the configuration directories and reports the ones that were
+    added, changed or removed. Directories are watched with inotify when the kernel supports it; every
+    event rescans its directory after a short quiet period. Without inotify, or when it drops events,
+    the directories are rescanned every pollInterval seconds.
+    """
+    # Seconds without events before a changed directory is rescanned, so a file being written is read once
+    Debounce = 0.5
+
+    def __init__(self, directories, onChanged, onRemoved, pollInterval: float = 5, rescanInterval: float = 300):
+        """
+        @param directories: Callable returning a dictionary of protocol to directory to watch
+        @param onChanged: Called with the protocol and name of a configuration that was added or changed,
+        from the watcher thread, it has to handle its own errors
+        @param onRemoved: Called with the protocol and name of a configuration whose file was removed
+        @param pollInterval: Seconds between two rescans without inotify
+        @param rescanInterval: Seconds between two rescans with inotify, in case an event was missed
+        """
+        self.directories = directories
+        self.onChanged = onChanged
+        self.onRemoved = onRemoved
+        self.pollInterval = pollInterval
+        self.rescanInterval = rescanInterval
+        # Held while a rescan compares the registry and reports the changes, code adding or removing
+        # configurations takes it too so the watcher never sees a configuration half added
+        self.lock = threading.RLock()
+        self.__files: dict[str, tuple[str, str, tuple]] = {}
+        self.__watches: dict[int, str] = {}
+        self.__fd: int | None = None
+        self.__refresh = threading.Event()
+        self.__running = False
+
+    def isUsingInotify(self) -> bool:
+        return self.__fd is not None
+
+    @staticmethod
+    def __initInotify() -> tuple[ctypes.CDLL, int] | tuple[None, None]:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None, None
+        if fd < 0:
+            return None, None
+        return libc, fd
+
+    def __addWatches(self, libc):
+        directories = {d: p for p, d in self.directories().items()}
+        for wd, directory in list(self.__watches.items()):
+            if directory not in directories:
+                libc.inotify_rm_watch(self.__fd, wd)
+                del self.__watches[wd]
+        for directory in directories:
+            if directory in self.__watches.values() or not os.path.isdir(directory):
+                continue
+            wd = libc.inotify_add_watch(self.__fd, os.fsencode(directory), WatchMask)
+            if wd >= 0:
+                self.__watches[wd] = directory
+
+    def scan(self, directories: list[str] = None) -> tuple[list, list]:
+        """
+        Compare the .conf files on disk with the registry and report the differences
+        @param directories: Only rescan these directories, all of them if None
+        @return: Added or changed and removed configurations, as tuples of protocol and name
+        """
+        protocols = self.directories()
+        scanned = {d: p for p, d in protocols.items() if directories is None or d in directories}
+        found = {}
+        for directory, protocol in scanned.items():
+            try:
+                entries = os.listdir(directory)
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.endswith(".conf") or len(entry) <= len(".conf"):
+                    continue
+                path = os.path.join(directory, entry)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = (protocol, entry[:-len(".conf")], (stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        changed, removed = [], []
+        with self.lock:
+            for path, (protocol, name, key) in found.items():
+                previous = self.__files.get(path)
+                if previous is None or previous[2] != key:
+                    changed.append((protocol, name))
+                self.__files[path] = (protocol, name, key)
+            for path in list(self.__files.keys()):
+                directory = os.path.dirname(path)
+                if path not in found and (directory in scanned or directory not in protocols.values()):
+                    removed.append(self.__files[path][:2])
+                    del self.__files[path]
+        return changed, removed
+
+    def refresh(self):
+        """
+        Pick up a change of the directories to watch
+        """
+        self.__refresh.set()
+
+    def __apply(self, directories: list[str] = None):
+        with self.lock:
+            changed, removed = self.scan(directories)
+            for protocol, name in sorted(changed):
+                self.onChanged(protocol, name)
+            for protocol, name in sorted(removed):
+                self.onRemoved(protocol, name)
+
+    def __readEvents(self) -> tuple[set[str], bool]:
+        """
+        @return: Directories with events, and whether every directory has to be rescanned
+        """
+        directories, everything = set(), False
+        while True:
+            try:
+                data = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                return directories, everything
+            offset = 0
+            while offset + EventHeader.size <= len(data):
+                wd, mask, _, length = EventHeader.unpack_from(data, offset)
+                offset += EventHeader.size + length
+                if mask & IN_Q_OVERFLOW:
+                    everything = True
+                elif mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # The directory itself is gone, watch it again once it is back
+                    self.__watches.pop(wd, None)
+                    everything = True
+                elif wd in self.__watches:
+                    directories.add(self.__watches[wd])
+
+    def start(self):
+        if self.__running:
+            return
+        self.__running = True
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        libc, self.__fd = self.__initInotify()
+        if self.__fd is None:
+            while True:
+                self.__apply()
+                self.__refresh.wait(self.pollInterval)
+                self.__refresh.clear()
+        # Watch before the first scan so nothing changed in between goes unnoticed
+        self.__addWatches(libc)
+        self.__apply()
+        lastScan = time.monotonic()
+        pending, everything = set(), False
+        while True:
+            timeout = ConfigurationWatcher.Debounce if pending or everything else 1.0
+            try:
+                readable, _, _ = select.select([self.__fd], [], [], timeout)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                directories, overflow = self.__readEvents()
+                pending |= directories
+                everything = everything or overflow
+                continue
+            if self.__refresh.is_set() or time.monotonic() - lastScan >= self.rescanInterval:
+                self.__refresh.clear()
+                everything = True
+            if everything:
+                self.__addWatches(libc)
+                self.__apply()
+                lastScan = time.monotonic()
+            elif pending:
+                self.__apply(list(pending))
+            pending, everything = set(), False
@@ -47,7 +47,8 @@ class DashboardConfig:
                 "dashboard_sort": "status",
                 "dashboard_theme": "dark",
                 "dashboard_api_key": "false",
-                "dashboard_language": "en-US"
+                "dashboard_language": "en-US",
+                "gunicorn_threads": "4"
             },
             "Peers": {
                 "peer_global_DNS": "1.1.1.1",
@@ -85,7 +86,25 @@ class DashboardConfig:
                 "enable": "true",
             },
             "WireGuardConfiguration": {
-                "autostart": ""
+                "autostart": "",
+                "stats_backend": "auto",
+                "stats_backend_fixture_path": "",
+                "peer_state_flush_interval": "30",
+                "peer_polling_workers": "4",
+                "peer_polling_fast_interval": "10",
+                "peer_polling_idle_interval": "60",
+                "save_delay": "1"
+            },
+            "Tracking": {
+                "rollup_interval": "900",
+                "raw_retention_days": "0",
+                "hourly_retention_days": "365",
+                "daily_retention_days": "0"
+            },
+            "Metrics": {
+                "enable": "true",
+                "configurations": "",
+                "max_peer_series": "1000"
             }
         }
 
@@ -262,7 +281,7 @@ class DashboardConfig:
         if section == "Email" and key == "email_template":
             return True, self.__config[section][key].encode('utf-8').decode('unicode_escape')
 
-        if section == "WireGuardConfiguration" and key == "autostart":
+        if (section == "WireGuardConfiguration" and key == "autostart") or (section == "Metrics" and key == "configurations"):
             return True, list(filter(lambda x: len(x) > 0, self.__config[section][key].split("||")))
 
         if self.__config[section][key] in ["1", "yes", "true", "on"]:
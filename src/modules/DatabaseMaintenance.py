@@ -0,0 +1,194 @@
+"""
+Database Maintenance
+"""
+import threading, time
+import sqlalchemy
+from flask import current_app
+
+from .ConnectionString import ConnectionString
+from .DashboardConfig import DashboardConfig
+
+
+class DatabaseMaintenance:
+    """
+    Prunes tables in bounded batches and gives the space back to the file system a few pages at a time,
+    so neither ever holds the database lock for long. SQLite databases are switched to auto_vacuum=INCREMENTAL
+    once, while the dashboard is idle; the other databases reclaim space on their own. Slow work requested
+    by the API, like clearing a tracking table, is queued here and run by the maintenance thread.
+    """
+    Databases = ["wgdashboard", "wgdashboard_job", "wgdashboard_log"]
+    # Rows deleted per transaction by deleteInBatches
+    BatchSize = 5000
+    # Pages released per transaction by the incremental vacuum, and the pause between two of them
+    VacuumPages = 256
+    VacuumPause = 0.05
+    # Free pages left in a database before it is worth vacuuming
+    VacuumThreshold = 1024
+    # Larger SQLite databases are only switched to incremental vacuum on request, since the VACUUM it takes
+    # rewrites the whole file
+    ConversionSizeLimit = 256 * 1024 * 1024
+
+    def __init__(self, DashboardConfig: DashboardConfig):
+        self.DashboardConfig = DashboardConfig
+        self.__engines: dict[str, sqlalchemy.Engine] = {}
+        self.LastReport: dict[str, dict] = {}
+        self.__tasksLock = threading.Lock()
+        self.__tasks: dict = {}
+        self.__wakeUp = threading.Event()
+        self.__tooLarge: set[str] = set()
+
+    def schedule(self, key: str, task):
+        """
+        Run a task on the maintenance thread as soon as it is free
+        @param key: Tasks scheduled again under the same key before they ran only run once
+        @param task: Callable without arguments
+        """
+        with self.__tasksLock:
+            self.__tasks[key] = task
+        self.__wakeUp.set()
+
+    def wait(self, timeout: float):
+        """
+        Sleep until the timeout or until a task is scheduled
+        """
+        self.__wakeUp.wait(timeout)
+        self.__wakeUp.clear()
+
+    def runTasks(self) -> int:
+        """
+        @return: Number of tasks run
+        """
+        with self.__tasksLock:
+            tasks, self.__tasks = self.__tasks, {}
+        for key, task in tasks.items():
+            try:
+                if task() is False:
+                    current_app.logger.error(f"[WGDashboard] Maintenance task {key} failed")
+            except Exception as e:
+                current_app.logger.error(f"[WGDashboard] Maintenance task {key} failed", e)
+        return len(tasks)
+
+    def requestConversion(self):
+        """
+        Switch every SQLite database to incremental vacuum on the maintenance thread, whatever its size
+        """
+        self.schedule("IncrementalVacuum", lambda: self.run(force=True))
+
+    def __getEngines(self) -> dict[str, sqlalchemy.Engine]:
+        if self.DashboardConfig.GetConfig("Database", "type")[1] != 'sqlite':
+            return {}
+        if not self.__engines:
+            for name in DatabaseMaintenance.Databases:
+                self.__engines[name] = sqlalchemy.create_engine(ConnectionString(name))
+        return self.__engines
+
+    @staticmethod
+    def deleteInBatches(engine: sqlalchemy.Engine, table: sqlalchemy.Table, cutoff=None, condition=None,
+                        batchSize: int = None) -> int:
+        """
+        Delete the rows of a table older than a cutoff, oldest first, in transactions of about batchSize rows
+        @param table: Table with a time column
+        @param cutoff: Delete rows with a time before this, every row if None
+        @param condition: Extra condition the deleted rows must match
+        @return: Number of rows deleted
+        """
+        batchSize = batchSize if batchSize is not None else DatabaseMaintenance.BatchSize
+        conditions = [] if condition is None else [condition]
+        if cutoff is not None:
+            conditions.append(table.c.time < cutoff)
+        deleted = 0
+        while True:
+            with engine.begin() as conn:
+                # Time of the row batchSize rows in, every row up to it goes in this batch
+                boundary = conn.execute(
+                    sqlalchemy.select(table.c.time).where(
+                        sqlalchemy.and_(table.c.time.is_not(None), *conditions)
+                    ).order_by(table.c.time).offset(batchSize - 1).limit(1)
+                ).scalar()
+                if boundary is None:
+                    statement = table.delete()
+                    if conditions:
+                        statement = statement.where(sqlalchemy.and_(*conditions))
+                    deleted += conn.execute(statement).rowcount
+                    return deleted
+                deleted += conn.execute(
+                    table.delete().where(sqlalchemy.and_(table.c.time <= boundary, *conditions))
+                ).rowcount
+
+    @staticmethod
+    def __pragma(conn, name: str) -> int:
+        return conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+    def enableIncrementalVacuum(self, name: str, engine: sqlalchemy.Engine, isIdle=None, force: bool = False) -> bool:
+        """
+        Switch a SQLite database to auto_vacuum=INCREMENTAL. This needs one full VACUUM, which is only run
+        if the database is not in that mode yet, the dashboard is idle and the database is no larger than
+        ConversionSizeLimit.
+        @param isIdle: Callable telling whether the dashboard is idle, always idle if None
+        @param force: Convert regardless of the size and whether the dashboard is idle
+        @return: True if the database was converted
+        """
+        with engine.connect() as conn:
+            if self.__pragma(conn, "auto_vacuum") == 2:
+                return False
+            size = self.__pragma(conn, "page_count") * self.__pragma(conn, "page_size")
+        if not force:
+            if size > DatabaseMaintenance.ConversionSizeLimit:
+                if name not in self.__tooLarge:
+                    self.__tooLarge.add(name)
+                    current_app.logger.info(
+                        f"[WGDashboard] SQLite database {name} is {size} bytes, too large to switch to incremental "
+                        f"vacuum automatically. Request it through /api/enableIncrementalVacuum when convenient")
+                return False
+            if isIdle is not None and not isIdle():
+                return False
+        current_app.logger.info(f"[WGDashboard] Switching SQLite database {name} to incremental vacuum")
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+        return True
+
+    def incrementalVacuum(self, engine: sqlalchemy.Engine, isIdle=None) -> int:
+        """
+        Release the free pages of a database VacuumPages at a time, stopping as soon as isIdle returns False
+        @param isIdle: Callable telling whether the dashboard is idle, always idle if None
+        @return: Number of bytes reclaimed
+        """
+        with engine.connect() as conn:
+            pageSize = self.__pragma(conn, "page_size")
+            freePages = self.__pragma(conn, "freelist_count")
+        if freePages < DatabaseMaintenance.VacuumThreshold:
+            return 0
+        released = 0
+        while freePages > 0 and (isIdle is None or isIdle()):
+            with engine.connect() as conn:
+                # Every step of the pragma releases one page, executescript steps it until it is done
+                conn.connection.driver_connection.executescript(
+                    f"PRAGMA incremental_vacuum({DatabaseMaintenance.VacuumPages});")
+                remaining = self.__pragma(conn, "freelist_count")
+            if remaining >= freePages:
+                break
+            released += freePages - remaining
+            freePages = remaining
+            time.sleep(DatabaseMaintenance.VacuumPause)
+        return released * pageSize
+
+    def run(self, isIdle=None, force: bool = False) -> dict[str, dict]:
+        """
+        Run the vacuum of every SQLite database of the dashboard
+        @param isIdle: Callable telling whether the dashboard is idle
+        @param force: Switch the databases to incremental vacuum even if they are large or the dashboard is busy
+        @return: Per database, whether it was converted to incremental vacuum and the bytes reclaimed
+        """
+        report = {}
+        for name, engine in self.__getEngines().items():
+            try:
+                converted = self.enableIncrementalVacuum(name, engine, isIdle, force)
+                report[name] = {
+                    "Converted": converted,
+                    "Reclaimed": 0 if converted else self.incrementalVacuum(engine, isIdle)
+                }
+            except Exception as e:
+                current_app.logger.error(f"[WGDashboard] Vacuuming {name} failed", e)
+        self.LastReport = report
+        return report
@@ -0,0 +1,70 @@
+"""
+Database Migrations
+"""
+import sqlalchemy
+from datetime import datetime
+
+
+class DatabaseMigrations:
+    """
+    Versioned schema changes for tables that create_all never alters once they exist.
+    The version reached by every scope (e.g. a configuration name) is kept in DashboardMigrations.
+    """
+    def __init__(self, engine: sqlalchemy.Engine, DashboardConfig):
+        self.engine = engine
+        self.metadata = sqlalchemy.MetaData()
+        self.migrationsTable = sqlalchemy.Table(
+            'DashboardMigrations', self.metadata,
+            sqlalchemy.Column('Scope', sqlalchemy.String(255), nullable=False, primary_key=True),
+            sqlalchemy.Column('Version', sqlalchemy.Integer, nullable=False),
+            sqlalchemy.Column('UpdatedDate',
+                              (sqlalchemy.DATETIME if DashboardConfig.GetConfig("Database", "type")[1] == 'sqlite' else sqlalchemy.TIMESTAMP)),
+            extend_existing=True
+        )
+        self.metadata.create_all(self.engine)
+
+    def getVersion(self, scope: str) -> int:
+        with self.engine.connect() as conn:
+            version = conn.execute(
+                sqlalchemy.select(self.migrationsTable.c.Version).where(self.migrationsTable.c.Scope == scope)
+            ).scalar()
+        return version if version is not None else 0
+
+    def __setVersion(self, conn, scope: str, version: int):
+        updated = conn.execute(
+            self.migrationsTable.update().values({
+                "Version": version,
+                "UpdatedDate": datetime.now()
+            }).where(self.migrationsTable.c.Scope == scope)
+        ).rowcount
+        if updated == 0:
+            conn.execute(
+                self.migrationsTable.insert().values({
+                    "Scope": scope,
+                    "Version": version,
+                    "UpdatedDate": datetime.now()
+                })
+            )
+
+    def migrate(self, scope: str, migrations: list) -> tuple[int, int]:
+        """
+        Apply the migrations after the current version of the scope, each in its own transaction
+        @param scope: Name the version is recorded under
+        @param migrations: Callables taking a connection, migration n brings the scope to version n
+        @return: Version before and after migrating
+        """
+        current = self.getVersion(scope)
+        version = current
+        for migration in migrations[current:]:
+            with self.engine.begin() as conn:
+                migration(conn)
+                version += 1
+                self.__setVersion(conn, scope, version)
+        return current, version
+
+    def forget(self, scope: str):
+        """
+        Drop the recorded version, used when the tables of the scope are dropped
+        """
+        with self.engine.begin() as conn:
+            conn.execute(self.migrationsTable.delete().where(self.migrationsTable.c.Scope == scope))
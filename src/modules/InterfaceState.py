@@ -0,0 +1,96 @@
+"""
+Interface State
+"""
+import errno, socket, threading, time
+import psutil
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+
+class InterfaceState:
+    """
+    Snapshot of the network interfaces that have an address, shared by every configuration.
+    Without the netlink listener the snapshot is reused for maxAge seconds. With it, the snapshot is only
+    taken again after the kernel reported a link or address change.
+    """
+    def __init__(self, maxAge: float = 1.0):
+        self.maxAge = maxAge
+        self.__lock = threading.Lock()
+        self.__interfaces: set[str] = set()
+        self.__updated: float = 0
+        self.__changed: bool = True
+        self.__listening: bool = False
+
+    def refresh(self) -> set[str]:
+        # Cleared before taking the snapshot, so a change reported while it is taken marks it stale again
+        with self.__lock:
+            self.__changed = False
+        interfaces = set(psutil.net_if_addrs().keys())
+        with self.__lock:
+            self.__interfaces = interfaces
+            self.__updated = time.monotonic()
+        return interfaces
+
+    def invalidate(self):
+        with self.__lock:
+            self.__changed = True
+
+    def __isStale(self) -> bool:
+        with self.__lock:
+            if self.__changed:
+                return True
+            if self.__listening:
+                return False
+            return time.monotonic() - self.__updated >= self.maxAge
+
+    def exists(self, interface: str, forceRefresh: bool = False) -> bool:
+        """
+        @param interface: Name of the interface
+        @param forceRefresh: Take a new snapshot, used right after bringing an interface up or down
+        """
+        if forceRefresh or self.__isStale():
+            return interface in self.refresh()
+        with self.__lock:
+            return interface in self.__interfaces
+
+    def isListening(self) -> bool:
+        return self.__listening
+
+    def startListener(self) -> bool:
+        """
+        Subscribe to RTM_NEWLINK/RTM_DELLINK and address events
+        @return: False if netlink is unavailable, the snapshot then falls back to maxAge
+        """
+        if self.__listening:
+            return True
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        except (OSError, AttributeError):
+            return False
+        self.__listening = True
+        self.invalidate()
+        threading.Thread(target=self.__listen, args=(sock,), daemon=True).start()
+        return True
+
+    def __listen(self, sock: socket.socket):
+        with sock:
+            while True:
+                try:
+                    sock.recv(65536)
+                except OSError as e:
+                    if e.errno == errno.ENOBUFS:
+                        # Events were dropped, the snapshot can't be trusted
+                        self.invalidate()
+                        continue
+                    break
+                self.invalidate()
+        with self.__lock:
+            self.__listening = False
+            self.__changed = True
+
+
+InterfaceStates = InterfaceState()
@@ -18,6 +18,15 @@ class Peer:
     def __init__(self, tableData, configuration):
         self.configuration = configuration
         self.id = tableData["id"]
+        self.jobs: list[PeerJob] = []
+        self.ShareLink: list[PeerShareLink] = []
+        self.updateTableData(tableData)
+
+    def updateTableData(self, tableData):
+        """
+        Refresh the attributes from a row of the peers table, and the jobs and share links from their indexes,
+        keeping this object
+        """
         self.private_key = tableData["private_key"]
         self.DNS = tableData["DNS"]
         self.endpoint_allowed_ip = tableData["endpoint_allowed_ip"]
@@ -36,14 +45,12 @@ class Peer:
         self.keepalive = tableData["keepalive"]
         self.remote_endpoint = tableData["remote_endpoint"]
         self.preshared_key = tableData["preshared_key"]
-        self.jobs: list[PeerJob] = []
-        self.ShareLink: list[PeerShareLink] = []
         self.getJobs()
         self.getShareLink()
 
     def toJson(self):
-        # self.getJobs()
-        # self.getShareLink()
+        # Read through the index, which drops the links that expired since the peer was last refreshed
+        self.getShareLink()
         return self.__dict__
 
     def __repr__(self):
@@ -101,15 +108,12 @@ class Peer:
             if pskExist: os.remove(uid)
             if len(updateAllowedIp.decode().strip("\n")) != 0:
                 return False, "Update peer failed when updating Allowed IPs"
-            saveConfig = subprocess.check_output(f"{self.configuration.Protocol}-quick save {self.configuration.Name}",
-                                                 shell=True, stderr=subprocess.STDOUT)
-            if f"wg showconf {self.configuration.Name}" not in saveConfig.decode().strip('\n'):
-                return False, "Update peer failed when saving the configuration"
             with self.configuration.engine.begin() as conn:
                 conn.execute(
                     self.configuration.peersTable.update().values({
                         "name": name,
                         "private_key": private_key,
+                        "allowed_ip": newAllowedIPs,
                         "DNS": dns_addresses,
                         "endpoint_allowed_ip": endpoint_allowed_ip,
                         "mtu": mtu,
@@ -119,6 +123,7 @@ class Peer:
                         self.configuration.peersTable.c.id == self.id
                     )
                 )
+            self.configuration.SaveScheduler.schedule()
             return True, None
         except subprocess.CalledProcessError as exc:
             return False, exc.output.decode("UTF-8").strip()
@@ -268,6 +273,14 @@ class Peer:
                     self.total_sent = 0
                 else:
                     return False
+            self.configuration.PeerStates.update(self.id, {
+                "total_receive": self.total_receive,
+                "total_sent": self.total_sent,
+                "total_data": self.total_data,
+                "cumu_receive": self.cumu_receive,
+                "cumu_sent": self.cumu_sent,
+                "cumu_data": self.cumu_data
+            })
         except Exception as e:
             print(e)
             return False
@@ -287,7 +300,12 @@ class Peer:
             ).mappings().fetchall()
         return list(result)
     
-    def getTraffics(self, interval: int = 30, startDate: datetime.datetime = None, endDate: datetime.datetime = None):
+    def getTraffics(self, interval: int = 30, startDate: datetime.datetime = None, endDate: datetime.datetime = None,
+                    points: int = None, bucket: int = None):
+        """
+        @param points: Keep this many samples with Largest-Triangle-Three-Buckets
+        @param bucket: Group the samples into buckets of this many seconds in the database
+        """
         if startDate is None and endDate is None:
             endDate = datetime.datetime.now()
             startDate = endDate - timedelta(minutes=interval)
@@ -295,27 +313,19 @@ class Peer:
             endDate = endDate.replace(hour=23, minute=59, second=59, microsecond=999999)
             startDate = startDate.replace(hour=0, minute=0, second=0, microsecond=0)
 
-        with self.configuration.engine.connect() as conn:
-            result = conn.execute(
-                db.select(
-                    self.configuration.peersTransferTable.c.cumu_data,
-                    self.configuration.peersTransferTable.c.total_data,
-                    self.configuration.peersTransferTable.c.cumu_receive,
-                    self.configuration.peersTransferTable.c.total_receive,
-                    self.configuration.peersTransferTable.c.cumu_sent,
-                    self.configuration.peersTransferTable.c.total_sent,
-                    self.configuration.peersTransferTable.c.time
-                ).where(
-                    db.and_(
-                        self.configuration.peersTransferTable.c.id == self.id,
-                        self.configuration.peersTransferTable.c.time <= endDate,
-                        self.configuration.peersTransferTable.c.time >= startDate,
-                        )
-                ).order_by(
-                    self.configuration.peersTransferTable.c.time
-                )
-            ).mappings().fetchall()
-        return list(result)
+        rollups = self.configuration.TransferRollups
+        if bucket is not None:
+            # Widen the buckets so a long window still returns at most MaxPoints of them
+            span = int((endDate - startDate).total_seconds())
+            bucket = max(bucket, -(-span // rollups.MaxPoints))
+            return rollups.getTrafficBuckets(self.id, startDate, endDate, bucket)
+        traffics = list(rollups.getTraffics(self.id, startDate, endDate))
+        if points is not None:
+            return rollups.largestTriangleThreeBuckets(
+                traffics, min(points, rollups.MaxPoints),
+                lambda r: r["time"].timestamp(),
+                lambda r: (r["cumu_data"] or 0) + (r["total_data"] or 0))
+        return traffics
             
     
     def getSessions(self, startDate: datetime.datetime = None, endDate: datetime.datetime = None):
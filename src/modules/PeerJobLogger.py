@@ -93,9 +93,3 @@ class PeerJobLogger:
                     )
                 )
             )
-    
-    def vacuum(self):
-        with self.engine.begin() as conn:
-            if conn.dialect.name == 'sqlite':
-                print("[WGDashboard] SQLite Vacuuming PeerJobLogs Database")
-                conn.execute(db.text('VACUUM;'))
\ No newline at end of file
@@ -1,7 +1,7 @@
 """
 Peer Jobs
 """
-import sqlalchemy
+import sqlalchemy, threading
 
 from .ConnectionString import ConnectionString
 from .PeerJob import PeerJob
@@ -13,6 +13,9 @@ from flask import current_app
 class PeerJobs:
     def __init__(self, DashboardConfig, WireguardConfigurations, AllPeerShareLinks):
         self.Jobs: list[PeerJob] = []
+        self.__lock = threading.RLock()
+        self.__jobsByPeer: dict[tuple[str, str], dict[str, PeerJob]] = {}
+        self.__jobsByID: dict[str, PeerJob] = {}
         self.engine = db.create_engine(ConnectionString('wgdashboard_job'))
         self.metadata = db.MetaData()
         self.peerJobTable = db.Table('PeerJobs', self.metadata,
@@ -34,16 +37,37 @@ class PeerJobs:
         self.cleanJob(init=True)
 
     def __getJobs(self):
-        self.Jobs.clear()
         with self.engine.connect() as conn:
             jobs = conn.execute(self.peerJobTable.select().where(
                 self.peerJobTable.columns.ExpireDate.is_(None)
             )).mappings().fetchall()
+        with self.__lock:
+            self.Jobs.clear()
+            self.__jobsByPeer.clear()
+            self.__jobsByID.clear()
             for job in jobs:
-                self.Jobs.append(PeerJob(
+                self.__indexJob(PeerJob(
                     job['JobID'], job['Configuration'], job['Peer'], job['Field'], job['Operator'], job['Value'],
                     job['CreationDate'], job['ExpireDate'], job['Action']))
 
+    def __indexJob(self, Job: PeerJob):
+        self.__unindexJob(Job.JobID)
+        self.Jobs.append(Job)
+        self.__jobsByID[Job.JobID] = Job
+        self.__jobsByPeer.setdefault((Job.Configuration, Job.Peer), {})[Job.JobID] = Job
+
+    def __unindexJob(self, JobID: str) -> PeerJob | None:
+        Job = self.__jobsByID.pop(JobID, None)
+        if Job is None:
+            return None
+        self.Jobs.remove(Job)
+        peerJobs = self.__jobsByPeer.get((Job.Configuration, Job.Peer))
+        if peerJobs is not None:
+            peerJobs.pop(JobID, None)
+            if len(peerJobs) == 0:
+                del self.__jobsByPeer[(Job.Configuration, Job.Peer)]
+        return Job
+
     def getAllJobs(self, configuration: str = None):
         if configuration is not None:
             with self.engine.connect() as conn:
@@ -62,10 +86,13 @@ class PeerJobs:
         return [x.toJson() for x in self.Jobs]
 
     def searchJob(self, Configuration: str, Peer: str):
-        return list(filter(lambda x: x.Configuration == Configuration and x.Peer == Peer, self.Jobs))
+        with self.__lock:
+            return list(self.__jobsByPeer.get((Configuration, Peer), {}).values())
 
     def searchJobById(self, JobID):
-        return list(filter(lambda x: x.JobID == JobID, self.Jobs))
+        with self.__lock:
+            Job = self.__jobsByID.get(JobID)
+            return [Job] if Job is not None else []
 
     def saveJob(self, Job: PeerJob) -> tuple[bool, list] | tuple[bool, str]:
         import traceback
@@ -73,6 +100,7 @@ class PeerJobs:
             with self.engine.begin() as conn:
                 currentJob = self.searchJobById(Job.JobID)
                 if len(currentJob) == 0:
+                    creationDate = datetime.now()
                     conn.execute(
                         self.peerJobTable.insert().values(
                             {
@@ -82,13 +110,15 @@ class PeerJobs:
                                 "Field": Job.Field,
                                 "Operator": Job.Operator,
                                 "Value": Job.Value,
-                                "CreationDate": datetime.now(),
+                                "CreationDate": creationDate,
                                 "ExpireDate": None,
                                 "Action": Job.Action
                             }
                         )
                     )
                     self.JobLogger.log(Job.JobID, Message=f"Job is created if {Job.Field} {Job.Operator} {Job.Value} then {Job.Action}")
+                    savedJob = PeerJob(Job.JobID, Job.Configuration, Job.Peer, Job.Field, Job.Operator, Job.Value,
+                                       creationDate, None, Job.Action)
                 else:
                     conn.execute(
                         self.peerJobTable.update().values({
@@ -99,11 +129,14 @@ class PeerJobs:
                         }).where(self.peerJobTable.columns.JobID == Job.JobID)
                     )
                     self.JobLogger.log(Job.JobID, Message=f"Job is updated from if {currentJob[0].Field} {currentJob[0].Operator} {currentJob[0].Value} then {currentJob[0].Action}; to if {Job.Field} {Job.Operator} {Job.Value} then {Job.Action}")
-            self.__getJobs()
+                    savedJob = PeerJob(currentJob[0].JobID, currentJob[0].Configuration, currentJob[0].Peer,
+                                       Job.Field, Job.Operator, Job.Value,
+                                       currentJob[0].CreationDate, currentJob[0].ExpireDate, Job.Action)
+            with self.__lock:
+                self.__indexJob(savedJob)
             self.WireguardConfigurations.get(Job.Configuration).searchPeer(Job.Peer)[1].getJobs()
             return True, list(
-                filter(lambda x: x.Configuration == Job.Configuration and x.Peer == Job.Peer and x.JobID == Job.JobID,
-                       self.Jobs))
+                filter(lambda x: x.JobID == Job.JobID, self.searchJob(Job.Configuration, Job.Peer)))
         except Exception as e:
             traceback.print_exc()
             return False, str(e)
@@ -121,7 +154,8 @@ class PeerJobs:
                     ).where(self.peerJobTable.columns.JobID == Job.JobID)
                 )
                 self.JobLogger.log(Job.JobID, Message=f"Job is removed due to being deleted or finished.")
-            self.__getJobs()
+            with self.__lock:
+                self.__unindexJob(Job.JobID)
             self.WireguardConfigurations.get(Job.Configuration).searchPeer(Job.Peer)[1].getJobs()
             return True, None
         except Exception as e:
@@ -135,7 +169,11 @@ class PeerJobs:
                         "Configuration": NewConfigurationName
                     }).where(self.peerJobTable.columns.Configuration == ConfigurationName)
                 )
-            self.__getJobs()
+            with self.__lock:
+                for Job in list(filter(lambda x: x.Configuration == ConfigurationName, self.Jobs)):
+                    self.__unindexJob(Job.JobID)
+                    Job.Configuration = NewConfigurationName
+                    self.__indexJob(Job)
             return True, None
         except Exception as e:
             return False, str(e)
@@ -147,8 +185,9 @@ class PeerJobs:
     def runJob(self):
         self.cleanJob()
         needToDelete = []
+        # Picks up jobs saved outside of this process
         self.__getJobs()
-        for job in self.Jobs:
+        for job in list(self.Jobs):
             c = self.WireguardConfigurations.get(job.Configuration)
             if c is not None:
                 f, fp = c.searchPeer(job.Peer)
@@ -204,12 +243,8 @@ class PeerJobs:
                 )
                 self.JobLogger.deleteLogs(JobID=job.get('JobID'))
                 self.JobLogger.log(job.get('JobID'), Message=f"Job is removed due to being stale.")
-        
-        with self.engine.connect() as conn:
-            if init and conn.dialect.name == 'sqlite':
-                print("[WGDashboard] SQLite Vacuuming PeerJobs Database")
-                self.JobLogger.vacuum()
-                conn.execute(sqlalchemy.text('VACUUM;'))
+                with self.__lock:
+                    self.__unindexJob(job.get('JobID'))
 
     def __runJob_Compare(self, x: float | datetime, y: float | datetime, operator: str):
         if operator == "eq":
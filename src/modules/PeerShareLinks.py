@@ -2,14 +2,14 @@ from .ConnectionString import ConnectionString
 from .PeerShareLink import PeerShareLink
 import sqlalchemy as db
 from datetime import datetime
-import uuid
+import heapq, threading, uuid
 
 """
 Peer Share Links
 """
 class PeerShareLinks:
     def __init__(self, DashboardConfig, WireguardConfigurations):
-        self.Links: list[PeerShareLink] = []
+        self.Links: dict[str, PeerShareLink] = {}
         self.engine = db.create_engine(ConnectionString("wgdashboard"))
         self.metadata = db.MetaData()
         self.peerShareLinksTable = db.Table(
@@ -22,34 +22,88 @@ class PeerShareLinks:
                       server_default=db.func.now()),
         )
         self.metadata.create_all(self.engine)
+        self.__lock = threading.RLock()
+        self.__linksByPeer: dict[tuple[str, str], dict[str, PeerShareLink]] = {}
+        self.__expireHeap: list[tuple[datetime, str]] = []
         self.__getSharedLinks()
         self.wireguardConfigurations = WireguardConfigurations
+
+    def __activeLinksSelect(self):
+        return self.peerShareLinksTable.select().where(
+            db.or_(self.peerShareLinksTable.columns.ExpireDate.is_(None), self.peerShareLinksTable.columns.ExpireDate > datetime.now())
+        )
+
     def __getSharedLinks(self):
-        self.Links.clear()
         with self.engine.connect() as conn:
-            allLinks = conn.execute(
-                self.peerShareLinksTable.select().where(
-                    db.or_(self.peerShareLinksTable.columns.ExpireDate.is_(None), self.peerShareLinksTable.columns.ExpireDate > datetime.now())
-                )
-            ).mappings().fetchall()
+            allLinks = conn.execute(self.__activeLinksSelect()).mappings().fetchall()
+        with self.__lock:
+            self.Links.clear()
+            self.__linksByPeer.clear()
+            self.__expireHeap.clear()
             for link in allLinks:
-                self.Links.append(PeerShareLink(**link))
+                self.__index(PeerShareLink(**link))
+
+    def __index(self, link: PeerShareLink):
+        self.__unindex(link.ShareID)
+        self.Links[link.ShareID] = link
+        self.__linksByPeer.setdefault((link.Configuration, link.Peer), {})[link.ShareID] = link
+        if link.ExpireDate is not None:
+            heapq.heappush(self.__expireHeap, (link.ExpireDate, link.ShareID))
 
+    def __unindex(self, ShareID: str):
+        link = self.Links.pop(ShareID, None)
+        if link is None:
+            return
+        peerLinks = self.__linksByPeer.get((link.Configuration, link.Peer))
+        if peerLinks is not None:
+            peerLinks.pop(ShareID, None)
+            if len(peerLinks) == 0:
+                del self.__linksByPeer[(link.Configuration, link.Peer)]
 
+    def __expireLinks(self):
+        """
+        Drop the links whose expire date has passed. Heap entries of links whose date changed since are skipped.
+        """
+        now = datetime.now()
+        while len(self.__expireHeap) > 0 and self.__expireHeap[0][0] <= now:
+            expireDate, ShareID = heapq.heappop(self.__expireHeap)
+            link = self.Links.get(ShareID)
+            if link is not None and link.ExpireDate == expireDate:
+                self.__unindex(ShareID)
+
+    def __reloadLink(self, conn, ShareID: str):
+        link = conn.execute(
+            self.__activeLinksSelect().where(self.peerShareLinksTable.columns.ShareID == ShareID)
+        ).mappings().fetchone()
+        with self.__lock:
+            if link is None:
+                self.__unindex(ShareID)
+            else:
+                self.__index(PeerShareLink(**link))
 
     def getLink(self, Configuration: str, Peer: str) -> list[PeerShareLink]:
-        self.__getSharedLinks()
-        return list(filter(lambda x : x.Configuration == Configuration and x.Peer == Peer, self.Links))
+        with self.__lock:
+            self.__expireLinks()
+            return list(self.__linksByPeer.get((Configuration, Peer), {}).values())
 
     def getLinkByID(self, ShareID: str) -> list[PeerShareLink]:
-        self.__getSharedLinks()
-        return list(filter(lambda x : x.ShareID == ShareID, self.Links))
+        with self.__lock:
+            self.__expireLinks()
+            link = self.Links.get(ShareID)
+        if link is None:
+            # The link may have been created outside of this process
+            with self.engine.connect() as conn:
+                self.__reloadLink(conn, ShareID)
+            with self.__lock:
+                link = self.Links.get(ShareID)
+        return [link] if link is not None else []
 
     def addLink(self, Configuration: str, Peer: str, ExpireDate: datetime = None) -> tuple[bool, str]:
         try:
             newShareID = str(uuid.uuid4())
+            existingLinks = self.getLink(Configuration, Peer)
             with self.engine.begin() as conn:
-                if len(self.getLink(Configuration, Peer)) > 0:
+                if len(existingLinks) > 0:
                     conn.execute(
                         self.peerShareLinksTable.update().values(
                             {
@@ -68,7 +122,10 @@ class PeerShareLinks:
                         }
                     )
                 )
-            self.__getSharedLinks()
+                with self.__lock:
+                    for link in existingLinks:
+                        self.__unindex(link.ShareID)
+                self.__reloadLink(conn, newShareID)
             self.wireguardConfigurations.get(Configuration).searchPeer(Peer)[1].getShareLink()
         except Exception as e:
             return False, str(e)
@@ -84,6 +141,6 @@ class PeerShareLinks:
                 ).returning(self.peerShareLinksTable.c.Configuration, self.peerShareLinksTable.c.Peer)
                 .where(self.peerShareLinksTable.columns.ShareID == ShareID)
             ).mappings().fetchone()
-        self.__getSharedLinks()
+            self.__reloadLink(conn, ShareID)
         self.wireguardConfigurations.get(updated.Configuration).searchPeer(updated.Peer)[1].getShareLink()
         return True, ""
\ No newline at end of file
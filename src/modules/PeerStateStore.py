@@ -0,0 +1,109 @@
+"""
+Peer State Store
+"""
+import threading
+
+
+class PeerStateStore:
+    """
+    Authoritative in-memory runtime state of the peers of one configuration, keyed by public key.
+    Changed fields are tracked as dirty until they are persisted by the configuration's flush.
+    """
+    RuntimeFields = ("total_receive", "total_sent", "total_data",
+                     "cumu_receive", "cumu_sent", "cumu_data",
+                     "endpoint", "status", "latest_handshake")
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__states: dict[str, dict] = {}
+        self.__dirty: dict[str, set[str]] = {}
+
+    def __contains__(self, peerId: str) -> bool:
+        return peerId in self.__states
+
+    def merge(self, tableData) -> dict:
+        """
+        Overlay the in-memory state on a row of the peers table, seeding the store if the peer is unknown
+        @param tableData: Row of the peers table
+        @return: Row with the runtime fields taken from memory
+        """
+        with self.__lock:
+            state = self.__states.get(tableData["id"])
+            if state is None:
+                state = {f: tableData[f] for f in PeerStateStore.RuntimeFields}
+                self.__states[tableData["id"]] = state
+            merged = dict(tableData)
+            merged.update(state)
+            return merged
+
+    def get(self, peerId: str) -> dict | None:
+        with self.__lock:
+            state = self.__states.get(peerId)
+            return dict(state) if state is not None else None
+
+    def snapshot(self) -> dict[str, dict]:
+        with self.__lock:
+            return {peerId: dict(state) for peerId, state in self.__states.items()}
+
+    def update(self, peerId: str, values: dict) -> bool:
+        """
+        Update the runtime fields of a peer and mark the changed ones as dirty
+        @return: True if any field changed
+        """
+        with self.__lock:
+            state = self.__states.get(peerId)
+            if state is None:
+                return False
+            changed = False
+            for field, value in values.items():
+                if field in PeerStateStore.RuntimeFields and state.get(field) != value:
+                    state[field] = value
+                    self.__dirty.setdefault(peerId, set()).add(field)
+                    changed = True
+            return changed
+
+    def remove(self, peerId: str):
+        with self.__lock:
+            self.__states.pop(peerId, None)
+            self.__dirty.pop(peerId, None)
+
+    def retain(self, peerIds):
+        """
+        Drop the state of every peer that is not in peerIds
+        """
+        peerIds = set(peerIds)
+        with self.__lock:
+            for peerId in list(self.__states.keys()):
+                if peerId not in peerIds:
+                    self.remove(peerId)
+
+    def popDirty(self) -> list[dict]:
+        """
+        Take the dirty fields out of the store
+        @return: One dictionary of dirty fields per peer, with the public key under "_id"
+        """
+        with self.__lock:
+            changes = []
+            for peerId, fields in self.__dirty.items():
+                state = self.__states.get(peerId)
+                if state is None:
+                    continue
+                change = {field: state[field] for field in fields}
+                change["_id"] = peerId
+                changes.append(change)
+            self.__dirty.clear()
+            return changes
+
+    def restoreDirty(self, changes: list[dict]):
+        """
+        Mark the fields of a failed flush as dirty again
+        """
+        with self.__lock:
+            for change in changes:
+                if change["_id"] in self.__states:
+                    self.__dirty.setdefault(change["_id"], set()).update(
+                        field for field in change.keys() if field != "_id")
+
+    def dirtyCount(self) -> int:
+        with self.__lock:
+            return len(self.__dirty)
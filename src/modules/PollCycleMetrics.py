@@ -0,0 +1,86 @@
+"""
+Poll Cycle Metrics
+"""
+import threading, time, traceback
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class PollCycleMetrics:
+    """
+    Rolling in-memory timings of the stages of a poll cycle, keeping the last `size` samples of every stage
+    """
+    def __init__(self, size: int = 500, errorSize: int = 50):
+        self.size = size
+        self.__lock = threading.Lock()
+        self.__samples: dict[str, deque] = {}
+        self.__errors: deque = deque(maxlen=errorSize)
+        self.__errorCount = 0
+
+    def record(self, stage: str, seconds: float):
+        with self.__lock:
+            if stage not in self.__samples.keys():
+                self.__samples[stage] = deque(maxlen=self.size)
+            self.__samples[stage].append(seconds)
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def recordError(self, stage: str, exception: Exception):
+        with self.__lock:
+            self.__errorCount += 1
+            self.__errors.append({
+                "Stage": stage,
+                "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "Error": str(exception),
+                "Traceback": "".join(traceback.format_exception(exception))
+            })
+
+    def last(self, stage: str) -> float | None:
+        with self.__lock:
+            samples = self.__samples.get(stage)
+            return samples[-1] if samples else None
+
+    def count(self, stage: str) -> int:
+        with self.__lock:
+            samples = self.__samples.get(stage)
+            return len(samples) if samples else 0
+
+    @staticmethod
+    def __percentile(ordered: list[float], percentile: float) -> float:
+        index = min(len(ordered) - 1, max(0, round(percentile / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def summary(self, stage: str) -> dict | None:
+        with self.__lock:
+            samples = list(self.__samples.get(stage, []))
+        if len(samples) == 0:
+            return None
+        ordered = sorted(samples)
+        return {
+            "Count": len(samples),
+            "Mean": sum(samples) / len(samples),
+            "Max": ordered[-1],
+            "P50": self.__percentile(ordered, 50),
+            "P95": self.__percentile(ordered, 95),
+            "P99": self.__percentile(ordered, 99)
+        }
+
+    def toJson(self, last: int = 20, cycleStage: str = "cycle"):
+        with self.__lock:
+            stages = list(self.__samples.keys())
+            cycles = list(self.__samples.get(cycleStage, []))
+            errors = list(self.__errors)
+            errorCount = self.__errorCount
+        return {
+            "Stages": {stage: self.summary(stage) for stage in stages},
+            "LastCycles": cycles[-last:] if last > 0 else [],
+            "ErrorCount": errorCount,
+            "Errors": errors
+        }
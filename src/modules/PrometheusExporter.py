@@ -0,0 +1,136 @@
+"""
+Prometheus Exporter
+"""
+import time
+
+from .DashboardConfig import DashboardConfig
+
+
+class PrometheusExporter:
+    """
+    Renders interface and peer metrics in the Prometheus text exposition format (version 0.0.4)
+    from the state kept in memory by the poller. Nothing here queries the database or runs wg.
+    """
+    ContentType = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, DashboardConfig: DashboardConfig):
+        self.DashboardConfig = DashboardConfig
+
+    def isEnabled(self) -> bool:
+        return self.DashboardConfig.GetConfig("Metrics", "enable")[1] is True
+
+    def __allowedConfigurations(self, configurations: dict) -> list:
+        _, allowList = self.DashboardConfig.GetConfig("Metrics", "configurations")
+        names = sorted(configurations.keys())
+        if allowList:
+            names = [name for name in names if name in allowList]
+        return [configurations[name] for name in names if configurations.get(name) is not None]
+
+    def __maxPeerSeries(self) -> int:
+        _, value = self.DashboardConfig.GetConfig("Metrics", "max_peer_series")
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return 1000
+
+    @staticmethod
+    def __escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def __sample(self, lines: list[str], name: str, labels: dict, value):
+        label = ",".join(f'{k}="{self.__escape(v)}"' for k, v in labels.items())
+        value = str(value) if isinstance(value, int) else repr(float(value))
+        lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+
+    @staticmethod
+    def __family(lines: list[str], name: str, metricType: str, description: str):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metricType}")
+
+    def render(self, configurations: dict) -> str:
+        """
+        @param configurations: WireguardConfigurations of the dashboard, keyed by name
+        @return: Metrics in the text exposition format
+        """
+        now = time.time()
+        allowed = self.__allowedConfigurations(configurations)
+        totalPeers = sum(len(c.Peers) for c in allowed)
+        maxPeerSeries = self.__maxPeerSeries()
+        exportPeers = maxPeerSeries <= 0 or totalPeers <= maxPeerSeries
+        lines = []
+
+        self.__family(lines, "wgdashboard_interface_up", "gauge", "Whether the interface is up")
+        for c in allowed:
+            self.__sample(lines, "wgdashboard_interface_up", {"configuration": c.Name, "protocol": c.Protocol},
+                          1 if c.Status else 0)
+
+        self.__family(lines, "wgdashboard_interface_peers", "gauge", "Number of peers of the interface")
+        for c in allowed:
+            self.__sample(lines, "wgdashboard_interface_peers", {"configuration": c.Name}, len(c.Peers))
+
+        self.__family(lines, "wgdashboard_interface_peers_connected", "gauge",
+                      "Number of peers with a handshake in the last 3 minutes")
+        for c in allowed:
+            self.__sample(lines, "wgdashboard_interface_peers_connected", {"configuration": c.Name},
+                          len([p for p in c.Peers if p.status == "running"]))
+
+        for metric, attribute, description in [
+            ("wgdashboard_interface_receive_bytes", "TransferRx", "Bytes received by the interface from its peers"),
+            ("wgdashboard_interface_transmit_bytes", "TransferTx", "Bytes sent by the interface to its peers")
+        ]:
+            self.__family(lines, metric, "gauge", description)
+            for c in allowed:
+                if c.PeersDump is not None:
+                    self.__sample(lines, metric, {"configuration": c.Name},
+                                  sum(getattr(d, attribute) for d in c.PeersDump.values()))
+
+        self.__family(lines, "wgdashboard_poll_duration_seconds", "gauge",
+                      "Duration of the poll cycles of the interface over the rolling window")
+        for c in allowed:
+            summary = c.PollMetrics.summary("cycle")
+            if summary is not None:
+                for quantile, key in [("0.5", "P50"), ("0.95", "P95"), ("0.99", "P99")]:
+                    self.__sample(lines, "wgdashboard_poll_duration_seconds",
+                                  {"configuration": c.Name, "quantile": quantile}, summary[key])
+
+        self.__family(lines, "wgdashboard_poll_last_duration_seconds", "gauge", "Duration of the last poll cycle")
+        for c in allowed:
+            last = c.PollMetrics.last("cycle")
+            if last is not None:
+                self.__sample(lines, "wgdashboard_poll_last_duration_seconds", {"configuration": c.Name}, last)
+
+        self.__family(lines, "wgdashboard_metrics_peer_series_dropped", "gauge",
+                      "1 if per-peer series were dropped because max_peer_series was exceeded")
+        self.__sample(lines, "wgdashboard_metrics_peer_series_dropped", {}, 0 if exportPeers else 1)
+
+        if exportPeers:
+            peerSamples = {
+                "wgdashboard_peer_up": [],
+                "wgdashboard_peer_receive_bytes_total": [],
+                "wgdashboard_peer_transmit_bytes_total": [],
+                "wgdashboard_peer_last_handshake_seconds": []
+            }
+            for c in allowed:
+                peersDump = c.PeersDump if c.PeersDump is not None else {}
+                for p in c.Peers:
+                    labels = {"configuration": c.Name, "peer": p.id, "name": p.name}
+                    peerSamples["wgdashboard_peer_up"].append((labels, 1 if p.status == "running" else 0))
+                    d = peersDump.get(p.id)
+                    if d is None:
+                        continue
+                    peerSamples["wgdashboard_peer_receive_bytes_total"].append((labels, d.TransferRx))
+                    peerSamples["wgdashboard_peer_transmit_bytes_total"].append((labels, d.TransferTx))
+                    if d.LatestHandshake > 0:
+                        peerSamples["wgdashboard_peer_last_handshake_seconds"].append(
+                            (labels, max(0, now - d.LatestHandshake)))
+            for metric, metricType, description in [
+                ("wgdashboard_peer_up", "gauge", "Whether the peer had a handshake in the last 3 minutes"),
+                ("wgdashboard_peer_receive_bytes_total", "counter", "Bytes received from the peer"),
+                ("wgdashboard_peer_transmit_bytes_total", "counter", "Bytes sent to the peer"),
+                ("wgdashboard_peer_last_handshake_seconds", "gauge", "Seconds since the latest handshake of the peer")
+            ]:
+                self.__family(lines, metric, metricType, description)
+                for labels, value in peerSamples[metric]:
+                    self.__sample(lines, metric, labels, value)
+
+        return "\n".join(lines) + "\n"
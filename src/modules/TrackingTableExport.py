@@ -0,0 +1,76 @@
+"""
+Tracking Table Export
+"""
+import csv, io, json, zlib
+from datetime import datetime
+from typing import Iterable, Iterator
+
+
+class TrackingTableExport:
+    """
+    Encodes rows of a tracking table as NDJSON or CSV while they are read, optionally gzipped,
+    so an export never holds more than one chunk of the table in memory
+    """
+    Formats = {
+        "ndjson": "application/x-ndjson",
+        "csv": "text/csv"
+    }
+    # Encoded rows are sent in chunks of about this many bytes
+    ChunkSize = 64 * 1024
+
+    def __init__(self, exportFormat: str, compress: bool = False):
+        self.exportFormat = exportFormat
+        self.compress = compress
+
+    def mimetype(self) -> str:
+        return "application/gzip" if self.compress else TrackingTableExport.Formats[self.exportFormat]
+
+    def filename(self, name: str) -> str:
+        return f"{name}.{self.exportFormat}" + (".gz" if self.compress else "")
+
+    @staticmethod
+    def __value(value):
+        if isinstance(value, datetime):
+            return value.strftime("%Y-%m-%d %H:%M:%S")
+        return value
+
+    def __encode(self, rows: Iterable[dict]) -> Iterator[str]:
+        if self.exportFormat == "ndjson":
+            for row in rows:
+                yield json.dumps({k: self.__value(v) for k, v in row.items()}) + "\n"
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        header = False
+        for row in rows:
+            if not header:
+                writer.writerow(row.keys())
+                header = True
+            writer.writerow([self.__value(v) for v in row.values()])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    def stream(self, rows: Iterable[dict]) -> Iterator[bytes]:
+        """
+        @param rows: Rows of the table, read lazily
+        @return: Chunks of the encoded, and optionally gzipped, export
+        """
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if self.compress else None
+        pending = []
+        size = 0
+        for line in self.__encode(rows):
+            pending.append(line)
+            size += len(line)
+            if size >= TrackingTableExport.ChunkSize:
+                chunk = "".join(pending).encode()
+                pending, size = [], 0
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+        chunk = "".join(pending).encode()
+        if compressor is not None:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
@@ -0,0 +1,443 @@
+"""
+Transfer Rollup
+"""
+import sqlalchemy, threading, time
+from datetime import datetime, timedelta, timezone
+
+from .DatabaseMaintenance import DatabaseMaintenance
+
+
+class TransferRollup:
+    """
+    Compacts the raw samples of <config>_transfer into <config>_transfer_hourly and <config>_transfer_daily.
+    A sample holds counters that only grow between resets (cumu_x + total_x), so a bucket is stored as its
+    last sample: max(cumu_x + total_x) over the bucket, split back into cumu_x = max(cumu_x) and
+    total_x = max(cumu_x + total_x) - max(cumu_x). Rows keep the shape of the raw table for getTraffics.
+    """
+    Resolutions = {
+        "hourly": 3600,
+        "daily": 86400
+    }
+    # Raw samples are rolled up in chunks so the first run on a large table does not aggregate it all at once
+    ChunkSize = timedelta(days=7)
+    # Upper bound of the rows returned for a chart by getTrafficBuckets and largestTriangleThreeBuckets
+    MaxPoints = 2000
+    # Seconds a getTopTalkers result is served from the cache
+    TopTalkersTTL = 30
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.__topTalkersCache: dict[tuple, tuple[float, dict]] = {}
+        self.__topTalkersLock = threading.Lock()
+
+    def createTables(self, dbName: str):
+        """
+        Define the rollup tables on the configuration, called by createDatabase before create_all
+        """
+        timeType = sqlalchemy.DATETIME if self.configuration.DashboardConfig.GetConfig("Database", "type")[1] == 'sqlite' \
+            else sqlalchemy.TIMESTAMP
+        tables = {}
+        for resolution in TransferRollup.Resolutions.keys():
+            tables[resolution] = sqlalchemy.Table(
+                f'{dbName}_transfer_{resolution}', self.configuration.metadata,
+                sqlalchemy.Column('id', sqlalchemy.String(255), nullable=False),
+                sqlalchemy.Column('total_receive', sqlalchemy.Float),
+                sqlalchemy.Column('total_sent', sqlalchemy.Float),
+                sqlalchemy.Column('total_data', sqlalchemy.Float),
+                sqlalchemy.Column('cumu_receive', sqlalchemy.Float),
+                sqlalchemy.Column('cumu_sent', sqlalchemy.Float),
+                sqlalchemy.Column('cumu_data', sqlalchemy.Float),
+                sqlalchemy.Column('time', timeType),
+                extend_existing=True
+            )
+        self.configuration.peersTransferHourlyTable = tables["hourly"]
+        self.configuration.peersTransferDailyTable = tables["daily"]
+
+    def tables(self) -> dict[str, sqlalchemy.Table]:
+        return {
+            "raw": self.configuration.peersTransferTable,
+            "hourly": self.configuration.peersTransferHourlyTable,
+            "daily": self.configuration.peersTransferDailyTable
+        }
+
+    @staticmethod
+    def epoch(conn, column):
+        """
+        Seconds since 1970-01-01 of a naive timestamp column, in the dialect of the connection
+        """
+        if conn.dialect.name == 'sqlite':
+            return sqlalchemy.cast(sqlalchemy.func.strftime('%s', column), sqlalchemy.Integer)
+        if conn.dialect.name == 'mysql':
+            return sqlalchemy.func.timestampdiff(sqlalchemy.literal_column("SECOND"),
+                                                 sqlalchemy.literal("1970-01-01 00:00:00"), column)
+        return sqlalchemy.cast(sqlalchemy.extract('epoch', column), sqlalchemy.BigInteger)
+
+    @staticmethod
+    def bucket(conn, column, seconds: int):
+        epoch = TransferRollup.epoch(conn, column)
+        return epoch - (epoch % seconds)
+
+    @staticmethod
+    def bucketStart(value: datetime, seconds: int) -> datetime:
+        epoch = int(value.replace(tzinfo=timezone.utc).timestamp())
+        return TransferRollup.fromEpoch(epoch - epoch % seconds)
+
+    @staticmethod
+    def fromEpoch(epoch: int) -> datetime:
+        return datetime.fromtimestamp(int(epoch), timezone.utc).replace(tzinfo=None)
+
+    def watermark(self, conn, resolution: str) -> datetime | None:
+        """
+        @return: End of the last bucket rolled up at this resolution, None if nothing was rolled up yet
+        """
+        table = self.tables()[resolution]
+        last = conn.execute(sqlalchemy.select(sqlalchemy.func.max(table.c.time))).scalar()
+        if last is None:
+            return None
+        if isinstance(last, str):
+            last = datetime.fromisoformat(last)
+        return last + timedelta(seconds=TransferRollup.Resolutions[resolution])
+
+    def __aggregate(self, conn, source: sqlalchemy.Table, target: sqlalchemy.Table, seconds: int,
+                    start: datetime, end: datetime):
+        bucket = self.bucket(conn, source.c.time, seconds).label("bucket")
+        coalesce = lambda c: sqlalchemy.func.coalesce(c, 0)
+        rows = conn.execute(
+            sqlalchemy.select(
+                source.c.id,
+                bucket,
+                sqlalchemy.func.max(coalesce(source.c.cumu_receive) + coalesce(source.c.total_receive)).label("receive"),
+                sqlalchemy.func.max(coalesce(source.c.cumu_receive)).label("cumu_receive"),
+                sqlalchemy.func.max(coalesce(source.c.cumu_sent) + coalesce(source.c.total_sent)).label("sent"),
+                sqlalchemy.func.max(coalesce(source.c.cumu_sent)).label("cumu_sent")
+            ).where(
+                sqlalchemy.and_(source.c.time >= start, source.c.time < end)
+            ).group_by(source.c.id, bucket)
+        ).mappings().fetchall()
+        conn.execute(target.delete().where(sqlalchemy.and_(target.c.time >= start, target.c.time < end)))
+        if len(rows) > 0:
+            conn.execute(target.insert(), [{
+                "id": row["id"],
+                "total_receive": row["receive"] - row["cumu_receive"],
+                "total_sent": row["sent"] - row["cumu_sent"],
+                "total_data": row["receive"] - row["cumu_receive"] + row["sent"] - row["cumu_sent"],
+                "cumu_receive": row["cumu_receive"],
+                "cumu_sent": row["cumu_sent"],
+                "cumu_data": row["cumu_receive"] + row["cumu_sent"],
+                "time": self.fromEpoch(row["bucket"])
+            } for row in rows])
+        return len(rows)
+
+    def rollup(self) -> dict[str, int]:
+        """
+        Roll up every complete hour and day that was not rolled up yet
+        @return: Number of buckets written per resolution
+        """
+        tables = self.tables()
+        written = {}
+        # Samples are stored as naive local times, buckets follow the same clock
+        now = datetime.now()
+        for resolution, source in [("hourly", tables["raw"]), ("daily", tables["hourly"])]:
+            seconds = TransferRollup.Resolutions[resolution]
+            written[resolution] = 0
+            end = self.bucketStart(now, seconds)
+            with self.configuration.engine.connect() as conn:
+                start = self.watermark(conn, resolution)
+                if start is None:
+                    first = conn.execute(sqlalchemy.select(sqlalchemy.func.min(source.c.time))).scalar()
+                    if first is None:
+                        continue
+                    if isinstance(first, str):
+                        first = datetime.fromisoformat(first)
+                    start = self.bucketStart(first, seconds)
+            while start < end:
+                chunkEnd = min(end, start + TransferRollup.ChunkSize)
+                with self.configuration.engine.begin() as conn:
+                    written[resolution] += self.__aggregate(conn, source, tables[resolution], seconds, start, chunkEnd)
+                start = chunkEnd
+        return written
+
+    def applyRetention(self) -> dict[str, int]:
+        """
+        Delete rows older than the retention of their resolution. Rows that are not rolled up yet are kept.
+        @return: Number of rows deleted per resolution
+        """
+        tables = self.tables()
+        deleted = {}
+        for resolution, coarser in [("raw", "hourly"), ("hourly", "daily"), ("daily", None)]:
+            days = self.retentionDays(resolution)
+            deleted[resolution] = 0
+            if days <= 0:
+                continue
+            cutoff = datetime.now() - timedelta(days=days)
+            if coarser is not None:
+                with self.configuration.engine.connect() as conn:
+                    watermark = self.watermark(conn, coarser)
+                if watermark is None:
+                    continue
+                cutoff = min(cutoff, watermark)
+            deleted[resolution] = DatabaseMaintenance.deleteInBatches(
+                self.configuration.engine, tables[resolution], cutoff)
+        return deleted
+
+    def retentionDays(self, resolution: str) -> int:
+        defaults = {"raw": 0, "hourly": 365, "daily": 0}
+        _, value = self.configuration.DashboardConfig.GetConfig("Tracking", f"{resolution}_retention_days")
+        if value is False:
+            return 0
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return defaults[resolution]
+
+    def chooseResolution(self, startDate: datetime, endDate: datetime) -> str:
+        """
+        Coarsest resolution that still gives a useful chart for the window, moved to a coarser one
+        when the window starts before the retention of the finer one
+        """
+        span = endDate - startDate
+        if span <= timedelta(days=2):
+            resolution = "raw"
+        elif span <= timedelta(days=90):
+            resolution = "hourly"
+        else:
+            resolution = "daily"
+        now = datetime.now()
+        for finer, coarser in [("raw", "hourly"), ("hourly", "daily")]:
+            days = self.retentionDays(finer)
+            if resolution == finer and days > 0 and startDate < now - timedelta(days=days):
+                resolution = coarser
+        return resolution
+
+    def __segments(self, conn, startDate: datetime, endDate: datetime):
+        """
+        Split a window between the tables it is read from, from coarse to fine. The part of the window
+        that is not rolled up yet is served from the finer tables.
+        @return: Tuples of table, start and end, both inclusive
+        """
+        tables = self.tables()
+        resolution = self.chooseResolution(startDate, endDate)
+        order = ["daily", "hourly", "raw"]
+        start = startDate
+        for current in order[order.index(resolution):]:
+            end = endDate
+            if current != "raw":
+                watermark = self.watermark(conn, current)
+                if watermark is None:
+                    continue
+                end = min(endDate, watermark - timedelta(microseconds=1))
+            if start > end:
+                continue
+            yield tables[current], start, end
+            start = end + timedelta(microseconds=1)
+
+    def getTraffics(self, peerId: str, startDate: datetime, endDate: datetime) -> list:
+        """
+        Samples of a peer between two dates at the chosen resolution
+        """
+        result = []
+        with self.configuration.engine.connect() as conn:
+            for table, start, end in self.__segments(conn, startDate, endDate):
+                result += conn.execute(
+                    sqlalchemy.select(
+                        table.c.cumu_data,
+                        table.c.total_data,
+                        table.c.cumu_receive,
+                        table.c.total_receive,
+                        table.c.cumu_sent,
+                        table.c.total_sent,
+                        table.c.time
+                    ).where(
+                        sqlalchemy.and_(
+                            table.c.id == peerId,
+                            table.c.time <= end,
+                            table.c.time >= start,
+                        )
+                    ).order_by(
+                        table.c.time
+                    )
+                ).mappings().fetchall()
+        return result
+
+    def getTrafficBuckets(self, peerId: str, startDate: datetime, endDate: datetime, seconds: int) -> list[dict]:
+        """
+        Samples of a peer grouped into buckets of a fixed width by the database. A bucket keeps the shape of a
+        sample (its last counters), with the traffic of the bucket and its average rate, both in GB and GB/s.
+        @param seconds: Width of a bucket
+        """
+        coalesce = lambda c: sqlalchemy.func.coalesce(c, 0)
+        buckets = {}
+        with self.configuration.engine.connect() as conn:
+            for table, start, end in self.__segments(conn, startDate, endDate):
+                bucket = self.bucket(conn, table.c.time, seconds).label("bucket")
+                rows = conn.execute(
+                    sqlalchemy.select(
+                        bucket,
+                        sqlalchemy.func.max(coalesce(table.c.cumu_receive) + coalesce(table.c.total_receive)).label("receive"),
+                        sqlalchemy.func.min(coalesce(table.c.cumu_receive) + coalesce(table.c.total_receive)).label("first_receive"),
+                        sqlalchemy.func.max(coalesce(table.c.cumu_receive)).label("cumu_receive"),
+                        sqlalchemy.func.max(coalesce(table.c.cumu_sent) + coalesce(table.c.total_sent)).label("sent"),
+                        sqlalchemy.func.min(coalesce(table.c.cumu_sent) + coalesce(table.c.total_sent)).label("first_sent"),
+                        sqlalchemy.func.max(coalesce(table.c.cumu_sent)).label("cumu_sent"),
+                        sqlalchemy.func.count().label("samples")
+                    ).where(
+                        sqlalchemy.and_(
+                            table.c.id == peerId,
+                            table.c.time <= end,
+                            table.c.time >= start,
+                        )
+                    ).group_by(bucket)
+                ).mappings().fetchall()
+                for row in rows:
+                    # A bucket across the end of a rolled up table is returned by both tables
+                    existing = buckets.get(row["bucket"])
+                    if existing is None:
+                        buckets[row["bucket"]] = dict(row)
+                    else:
+                        for key in ["receive", "cumu_receive", "sent", "cumu_sent"]:
+                            existing[key] = max(existing[key], row[key])
+                        for key in ["first_receive", "first_sent"]:
+                            existing[key] = min(existing[key], row[key])
+                        existing["samples"] += row["samples"]
+        result = []
+        previous = None
+        for key in sorted(buckets.keys()):
+            row = buckets[key]
+            receive, sent = row["receive"], row["sent"]
+            if previous is None:
+                deltaReceive, deltaSent = receive - row["first_receive"], sent - row["first_sent"]
+            else:
+                # Counters only go down when the data usage was reset
+                deltaReceive = receive - previous["receive"] if receive >= previous["receive"] else receive
+                deltaSent = sent - previous["sent"] if sent >= previous["sent"] else sent
+            result.append({
+                "cumu_data": row["cumu_receive"] + row["cumu_sent"],
+                "total_data": receive - row["cumu_receive"] + sent - row["cumu_sent"],
+                "cumu_receive": row["cumu_receive"],
+                "total_receive": receive - row["cumu_receive"],
+                "cumu_sent": row["cumu_sent"],
+                "total_sent": sent - row["cumu_sent"],
+                "time": self.fromEpoch(key),
+                "samples": row["samples"],
+                "receive": deltaReceive,
+                "sent": deltaSent,
+                "receive_rate": deltaReceive / seconds,
+                "sent_rate": deltaSent / seconds
+            })
+            previous = row
+        return result
+
+    def getTopTalkers(self, startDate: datetime, endDate: datetime, limit: int = 10) -> dict:
+        """
+        Peers that moved the most bytes between two dates, computed by the database from the tables
+        getTraffics reads. The traffic of a peer is the sum of the increases of its counters from one
+        sample to the next; a counter that went down was reset and counts from zero.
+        @param limit: Number of peers to return
+        @return: Top peers with their traffic in GB, and the traffic and number of peers of the whole configuration
+        """
+        key = (startDate, endDate, limit)
+        now = time.monotonic()
+        with self.__topTalkersLock:
+            cached = self.__topTalkersCache.get(key)
+            if cached is not None and now - cached[0] < TransferRollup.TopTalkersTTL:
+                return cached[1]
+            self.__topTalkersCache = {k: v for k, v in self.__topTalkersCache.items()
+                                      if now - v[0] < TransferRollup.TopTalkersTTL}
+
+        coalesce = lambda c: sqlalchemy.func.coalesce(c, 0)
+        result = {"Peers": [], "Receive": 0, "Sent": 0, "Total": 0, "PeerCount": 0}
+        with self.configuration.engine.connect() as conn:
+            parts = [
+                sqlalchemy.select(
+                    table.c.id,
+                    table.c.time,
+                    (coalesce(table.c.cumu_receive) + coalesce(table.c.total_receive)).label("receive"),
+                    (coalesce(table.c.cumu_sent) + coalesce(table.c.total_sent)).label("sent")
+                ).where(
+                    sqlalchemy.and_(table.c.time >= start, table.c.time <= end)
+                ) for table, start, end in self.__segments(conn, startDate, endDate)
+            ]
+            if parts:
+                samples = (sqlalchemy.union_all(*parts) if len(parts) > 1 else parts[0]).subquery()
+                window = {"partition_by": samples.c.id, "order_by": samples.c.time}
+                deltas = sqlalchemy.select(
+                    samples.c.id,
+                    samples.c.receive,
+                    samples.c.sent,
+                    sqlalchemy.func.lag(samples.c.receive).over(**window).label("previous_receive"),
+                    sqlalchemy.func.lag(samples.c.sent).over(**window).label("previous_sent")
+                ).subquery()
+                delta = lambda value, previous: sqlalchemy.case(
+                    (previous.is_(None), 0),
+                    (value >= previous, value - previous),
+                    else_=value
+                )
+                peers = sqlalchemy.select(
+                    deltas.c.id,
+                    sqlalchemy.func.sum(delta(deltas.c.receive, deltas.c.previous_receive)).label("receive"),
+                    sqlalchemy.func.sum(delta(deltas.c.sent, deltas.c.previous_sent)).label("sent")
+                ).group_by(deltas.c.id).subquery()
+                rows = conn.execute(
+                    sqlalchemy.select(
+                        peers.c.id,
+                        peers.c.receive,
+                        peers.c.sent,
+                        sqlalchemy.func.sum(peers.c.receive).over().label("all_receive"),
+                        sqlalchemy.func.sum(peers.c.sent).over().label("all_sent"),
+                        sqlalchemy.func.count().over().label("peer_count")
+                    ).order_by(
+                        (peers.c.receive + peers.c.sent).desc()
+                    ).limit(limit)
+                ).mappings().fetchall()
+                for row in rows:
+                    result["Peers"].append({
+                        "id": row["id"],
+                        "receive": row["receive"],
+                        "sent": row["sent"],
+                        "total": row["receive"] + row["sent"]
+                    })
+                if rows:
+                    result["Receive"] = rows[0]["all_receive"]
+                    result["Sent"] = rows[0]["all_sent"]
+                    result["Total"] = rows[0]["all_receive"] + rows[0]["all_sent"]
+                    result["PeerCount"] = rows[0]["peer_count"]
+        with self.__topTalkersLock:
+            self.__topTalkersCache[key] = (time.monotonic(), result)
+        return result
+
+    @staticmethod
+    def largestTriangleThreeBuckets(rows: list, points: int, x, y) -> list:
+        """
+        Largest-Triangle-Three-Buckets: keep the first and last rows, and from each of points - 2 buckets in
+        between the row forming the largest triangle with the row kept before it and the average of the next bucket
+        @param rows: Rows ordered by x
+        @param points: Number of rows to keep
+        @param x: Function returning the x value of a row
+        @param y: Function returning the y value of a row
+        """
+        if points < 3 or points >= len(rows):
+            return list(rows)
+        xs = [x(r) for r in rows]
+        ys = [y(r) for r in rows]
+        result = [rows[0]]
+        every = (len(rows) - 2) / (points - 2)
+        a = 0
+        for i in range(points - 2):
+            start = int(i * every) + 1
+            end = int((i + 1) * every) + 1
+            nextStart = end
+            nextEnd = min(int((i + 2) * every) + 1, len(rows))
+            if nextStart >= nextEnd:
+                avgX, avgY = xs[-1], ys[-1]
+            else:
+                avgX = sum(xs[nextStart:nextEnd]) / (nextEnd - nextStart)
+                avgY = sum(ys[nextStart:nextEnd]) / (nextEnd - nextStart)
+            maxArea, chosen = -1, start
+            for j in range(start, end):
+                area = abs((xs[a] - avgX) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avgY - ys[a]))
+                if area > maxArea:
+                    maxArea, chosen = area, j
+            result.append(rows[chosen])
+            a = chosen
+        result.append(rows[-1])
+        return result
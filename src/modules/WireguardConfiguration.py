@@ -4,24 +4,38 @@ WireGuard Configuration
 from typing import Any
 
 import jinja2
-import sqlalchemy, random, shutil, configparser, ipaddress, os, subprocess, time, re, uuid, psutil, traceback
+import sqlalchemy, random, shutil, configparser, ipaddress, os, subprocess, time, re, uuid, psutil, traceback, threading
 from zipfile import ZipFile
 from datetime import datetime, timedelta
 from itertools import islice
 from flask import current_app
 
+from .ConfigurationSaveScheduler import ConfigurationSaveScheduler
 from .ConnectionString import ConnectionString
 from .DashboardConfig import DashboardConfig
+from .DatabaseMaintenance import DatabaseMaintenance
+from .DatabaseMigrations import DatabaseMigrations
 from .Peer import Peer
 from .PeerJobs import PeerJobs
 from .PeerShareLinks import PeerShareLinks
+from .PeerStateStore import PeerStateStore
+from .PollCycleMetrics import PollCycleMetrics
+from .TransferRollup import TransferRollup
 from .Utilities import StringToBoolean, GenerateWireguardPublicKey, RegexMatch, ValidateDNSAddress, \
     ValidateEndpointAllowedIPs
 from .WireguardConfigurationInfo import WireguardConfigurationInfo, PeerGroupsClass
+from .WireguardConfigurationParser import WireguardConfigurationParsers
+from .WireguardPeerBatch import WireguardPeerBatch
 from .DashboardWebHooks import DashboardWebHooks
+from .InterfaceState import InterfaceStates
+from .WireguardDump import WireguardPeerDump
+from .WireguardStatsBackend import WireguardStatsBackend, CreateStatsBackend
 
 
 class WireguardConfiguration:
+    # Seconds the dashboard keeps a configuration on the fast polling rate after it was viewed
+    ViewedPollWindow = 30
+
     class InvalidConfigurationFileException(Exception):
         def __init__(self, m):
             self.message = m
@@ -40,6 +54,19 @@ class WireguardConfiguration:
                  wg: bool = True
                  ):
         self.Peers = []
+        self.__peersIndex: dict[str, Peer] = {}
+        self.RestrictedPeers = []
+        self.PeerStates: PeerStateStore = PeerStateStore()
+        self.PollMetrics: PollCycleMetrics = PollCycleMetrics()
+        self.PeersDump: dict[str, WireguardPeerDump] | None = None
+        self.TransferRollups: TransferRollup = TransferRollup(self)
+        self.PeersActive: bool = False
+        self.LastViewedTime: float = 0
+        self.LastPollTime: float = 0
+        self.NextPollTime: float = 0
+        self.__lastTrafficLogTime: float = 0
+        self.__seenEndpoints: set[tuple[str, str]] | None = None
+        self.__seenEndpointsLoadedTime: float = 0
         self.__parser: configparser.ConfigParser = configparser.RawConfigParser(strict=False)
         self.__parser.optionxform = str
         self.__configFileModifiedTime = None
@@ -67,6 +94,20 @@ class WireguardConfiguration:
         self.engine: sqlalchemy.Engine = sqlalchemy.create_engine(ConnectionString("wgdashboard"))
         self.metadata: sqlalchemy.MetaData = sqlalchemy.MetaData()
         self.dbType = self.DashboardConfig.GetConfig("Database", "type")[1]
+        self.Migrations: DatabaseMigrations = DatabaseMigrations(self.engine, self.DashboardConfig)
+        self.SchemaVersion: int = 0
+        # Statements run by the thread polling this configuration, the engine is also used by API requests
+        self.__pollStatements = threading.local()
+        self.PollStatementCount: int = 0
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", self.__countStatement)
+        # Kept for the save scheduler thread, which runs outside of the application context
+        self.__logger = current_app.logger
+        self.SaveScheduler: ConfigurationSaveScheduler = ConfigurationSaveScheduler(
+            self.__saveConfiguration, self.__getSaveDelayConfig())
+        self.statsBackend: WireguardStatsBackend = CreateStatsBackend(
+            self.Protocol,
+            self.DashboardConfig.GetConfig("WireGuardConfiguration", "stats_backend")[1],
+            self.DashboardConfig.GetConfig("WireGuardConfiguration", "stats_backend_fixture_path")[1])
         
         if name is not None:
             if data is not None and "Backup" in data.keys():
@@ -149,6 +190,7 @@ class WireguardConfiguration:
 
     def __initPeersList(self):
         self.Peers: list[Peer] = []
+        self.__peersIndex = {}
         self.getPeers()
         self.getRestrictedPeersList()
 
@@ -175,49 +217,37 @@ class WireguardConfiguration:
         return True, None
 
     def __parseConfigurationFile(self):
-        with open(self.configPath, 'r') as f:
-            original = [l.rstrip("\n") for l in f.readlines()]
-            try:
-                start = original.index("[Interface]")
-
-                # Clean
-                for i in range(start, len(original)):
-                    if original[i] == "[Peer]":
-                        break
-                    split = re.split(r'\s*=\s*', original[i], 1)
-                    if len(split) == 2:
-                        key = split[0]
-                        if key in dir(self):
-                            if isinstance(getattr(self, key), bool):
-                                setattr(self, key, False)
-                            else:
-                                setattr(self, key, "")
-
-                # Set
-                for i in range(start, len(original)):
-                    if original[i] == "[Peer]":
-                        break
-                    split = re.split(r'\s*=\s*', original[i], 1)
-                    if len(split) == 2:
-                        key = split[0]
-                        value = split[1]
-                        if key in dir(self):
-                            if isinstance(getattr(self, key), bool):
-                                setattr(self, key, StringToBoolean(value))
-                            else:
-                                if len(getattr(self, key)) > 0:
-                                    setattr(self, key, f"{getattr(self, key)}, {value}")
-                                else:
-                                    setattr(self, key, value)
-            except ValueError as e:
-                raise self.InvalidConfigurationFileException(
-                    "[Interface] section not found in " + self.configPath)
-            if self.PrivateKey:
-                self.PublicKey = self.__getPublicKey()
-            self.Status = self.getStatus()
+        parsed = WireguardConfigurationParsers.parse(self.configPath)
+        if not parsed.hasInterface:
+            raise self.InvalidConfigurationFileException(
+                "[Interface] section not found in " + self.configPath)
+        attributes = set(dir(self))
+        keys = [key for key, _ in parsed.interface if key in attributes]
+
+        # Clean
+        for key in keys:
+            if isinstance(getattr(self, key), bool):
+                setattr(self, key, False)
+            else:
+                setattr(self, key, "")
+
+        # Set
+        for key, value in parsed.interface:
+            if key in attributes:
+                if isinstance(getattr(self, key), bool):
+                    setattr(self, key, StringToBoolean(value))
+                else:
+                    if len(getattr(self, key)) > 0:
+                        setattr(self, key, f"{getattr(self, key)}, {value}")
+                    else:
+                        setattr(self, key, value)
+        if self.PrivateKey:
+            self.PublicKey = self.__getPublicKey()
+        self.Status = self.getStatus()
 
     def __dropDatabase(self):
-        existingTables = [self.Name, f'{self.Name}_restrict_access', f'{self.Name}_transfer', f'{self.Name}_deleted']
+        existingTables = [self.Name, f'{self.Name}_restrict_access', f'{self.Name}_transfer', f'{self.Name}_deleted',
+                          f'{self.Name}_transfer_hourly', f'{self.Name}_transfer_daily']
         try:
             with self.engine.begin() as conn:
                 for t in existingTables:
@@ -226,6 +256,7 @@ class WireguardConfiguration:
                             f'DROP TABLE "{t}"'
                         )
                     )
+            self.Migrations.forget(self.Name)
         except Exception as e:
             current_app.logger.error("Dropping table failed")
             return False
@@ -332,12 +363,56 @@ class WireguardConfiguration:
             sqlalchemy.Column('Info', sqlalchemy.Text),
             extend_existing=True
         )
+        self.TransferRollups.createTables(dbName)
 
         self.metadata.create_all(self.engine)
+        self.migrateDatabase(dbName)
+
+    def __createIndex(self, conn, tableName: str, *columns: str):
+        table = self.metadata.tables[tableName]
+        sqlalchemy.Index(f'ix_{tableName}_{"_".join(columns)}', *[table.c[c] for c in columns]) \
+            .create(conn, checkfirst=True)
+
+    def schemaMigrations(self, dbName: str) -> list:
+        """
+        Schema changes of the tables of a configuration, in order. Only append to this list.
+        @param dbName: Name of the configuration the tables belong to
+        @return: Callables taking a connection
+        """
+        return [
+            lambda conn: self.__createIndex(conn, f'{dbName}_transfer', 'id', 'time'),
+            lambda conn: self.__createIndex(conn, f'{dbName}_history_endpoint', 'id', 'endpoint'),
+            lambda conn: self.__createIndex(conn, f'{dbName}_transfer', 'time'),
+            lambda conn: [self.__createIndex(conn, f'{dbName}_transfer_{resolution}', 'id', 'time')
+                          for resolution in TransferRollup.Resolutions.keys()],
+            lambda conn: self.__createIndex(conn, f'{dbName}_history_endpoint', 'time')
+        ]
+
+    def migrateDatabase(self, dbName: str = None) -> tuple[bool, str]:
+        """
+        Bring the tables of the configuration to the latest schema version, called by createDatabase
+        """
+        if dbName is None:
+            dbName = self.Name
+        migrations = self.schemaMigrations(dbName)
+        try:
+            before, after = self.Migrations.migrate(dbName, migrations)
+        except Exception as e:
+            self.SchemaVersion = self.Migrations.getVersion(dbName)
+            current_app.logger.error(
+                f"Database schema of {dbName} failed to migrate at version {self.SchemaVersion + 1} of {len(migrations)}", e)
+            return False, str(e)
+        self.SchemaVersion = after
+        if before != after:
+            current_app.logger.info(f"Database schema of {dbName} migrated from version {before} to {after}")
+        else:
+            current_app.logger.info(f"Database schema of {dbName} is up to date at version {after}")
+        return True, None
 
     def __dumpDatabase(self):
         with self.engine.connect() as conn:
-            tables = [self.peersTable, self.peersRestrictedTable, self.peersTransferTable, self.peersDeletedTable]
+            tables = [self.peersTable, self.peersRestrictedTable, self.peersTransferTable, self.peersDeletedTable,
+                      self.peersTransferHourlyTable, self.peersTransferDailyTable]
             for i in tables:
                 rows = conn.execute(i.select()).mappings().fetchall()
                 for row in rows:
@@ -361,8 +436,8 @@ class WireguardConfiguration:
     def __getPublicKey(self) -> str:
         return GenerateWireguardPublicKey(self.PrivateKey)[1]
 
-    def getStatus(self) -> bool:
-        self.Status = self.Name in psutil.net_if_addrs().keys()
+    def getStatus(self, forceRefresh: bool = False) -> bool:
+        self.Status = InterfaceStates.exists(self.Name, forceRefresh)
         return self.Status
 
     def getAutostartStatus(self):
@@ -388,322 +463,408 @@ class WireguardConfiguration:
             for i in restricted:
                 self.RestrictedPeers.append(Peer(i, self))
 
-    def configurationFileChanged(self) :
-        mt = os.path.getmtime(self.configPath)
-        changed = self.__configFileModifiedTime is None or self.__configFileModifiedTime != mt
-        self.__configFileModifiedTime = mt
+    def configurationFileChanged(self, update: bool = True) -> bool:
+        key = WireguardConfigurationParsers.fileKey(self.configPath)
+        changed = self.__configFileModifiedTime is None or self.__configFileModifiedTime != key
+        if update:
+            self.__configFileModifiedTime = key
         return changed
 
+    def reloadConfigurationFile(self) -> bool:
+        """
+        Read the interface and the peers again if the file changed on disk
+        @return: True if the file had changed
+        """
+        if not self.configurationFileChanged(update=False):
+            return False
+        self.__parseConfigurationFile()
+        self.getPeers()
+        return True
+
+    def createPeerObject(self, tableData) -> Peer:
+        return Peer(tableData, self)
+
+    def newPeerTableData(self, peerSection: dict) -> dict:
+        """
+        Row of the peers table for a peer found in the configuration file but not in the database
+        @param peerSection: Keys of the [Peer] section, with the name taken from #Name#
+        """
+        return {
+            "id": peerSection['PublicKey'],
+            "private_key": "",
+            "DNS": self.DashboardConfig.GetConfig("Peers", "peer_global_DNS")[1],
+            "endpoint_allowed_ip": self.DashboardConfig.GetConfig("Peers", "peer_endpoint_allowed_ip")[
+                1],
+            "name": peerSection.get("name"),
+            "total_receive": 0,
+            "total_sent": 0,
+            "total_data": 0,
+            "endpoint": "N/A",
+            "status": "stopped",
+            "latest_handshake": "N/A",
+            "allowed_ip": peerSection.get("AllowedIPs", "N/A"),
+            "cumu_receive": 0,
+            "cumu_sent": 0,
+            "cumu_data": 0,
+            "mtu": self.DashboardConfig.GetConfig("Peers", "peer_mtu")[1] if len(self.DashboardConfig.GetConfig("Peers", "peer_mtu")[1]) > 0 else None,
+            "keepalive": self.DashboardConfig.GetConfig("Peers", "peer_keep_alive")[1] if len(self.DashboardConfig.GetConfig("Peers", "peer_keep_alive")[1]) > 0 else None,
+            "remote_endpoint": self.DashboardConfig.GetConfig("Peers", "remote_endpoint")[1],
+            "preshared_key": peerSection["PresharedKey"] if "PresharedKey" in peerSection.keys() else ""
+        }
+
+    def __reconcilePeers(self, rows):
+        """
+        Update the existing Peer objects in place, construct only the new ones and drop the removed ones
+        @param rows: Rows of the peers table, in display order
+        """
+        existing = self.__peersIndex
+        peers = []
+        for row in rows:
+            tableData = self.PeerStates.merge(row)
+            peer = existing.get(tableData["id"])
+            if peer is None:
+                peer = self.createPeerObject(tableData)
+            else:
+                peer.updateTableData(tableData)
+            peers.append(peer)
+        self.PeerStates.retain(map(lambda x: x.id, peers))
+        self.__peersIndex = {p.id: p for p in peers}
+        self.Peers = peers
+
+    def loadPeersFromDatabase(self):
+        """
+        Refresh the peer list from the peers table without reading the configuration file, used right after
+        changing peers since the file is only saved a moment later
+        """
+        with self.engine.connect() as conn:
+            existingPeers = conn.execute(self.peersTable.select()).mappings().fetchall()
+        self.__reconcilePeers(existingPeers)
+
     def getPeers(self):
-        tmpList = []        
+        if self.SaveScheduler.isPending() and self.configurationFileChanged(update=False):
+            # Save the pending changes first, the file would otherwise be read without them
+            self.SaveScheduler.flush()
         if self.configurationFileChanged():
-            with open(self.configPath, 'r') as configFile:
-                p = []
-                pCounter = -1
-                content = configFile.read().split('\n')
-                try:
-                    if "[Peer]" not in content:
-                        current_app.logger.info(f"{self.Name} config has no [Peer] section")
-                        return
-
-                    peerStarts = content.index("[Peer]")
-                    content = content[peerStarts:]
-                    for i in content:
-                        if not RegexMatch("#(.*)", i) and not RegexMatch(";(.*)", i):
-                            if i == "[Peer]":
-                                pCounter += 1
-                                p.append({})
-                                p[pCounter]["name"] = ""
-                            else:
-                                if len(i) > 0:
-                                    split = re.split(r'\s*=\s*', i, 1)
-                                    if len(split) == 2:
-                                        p[pCounter][split[0]] = split[1]
-
-                        if RegexMatch("#Name# = (.*)", i):
-                            split = re.split(r'\s*=\s*', i, 1)
-                            if len(split) == 2:
-                                p[pCounter]["name"] = split[1]
-                    
-                    for i in p:
+            try:
+                parsed = WireguardConfigurationParsers.parse(self.configPath)
+                if not parsed.hasPeers:
+                    current_app.logger.info(f"{self.Name} config has no [Peer] section")
+                    return
+
+                rows = []
+                with self.engine.begin() as conn:
+                    existingPeers = {
+                        row["id"]: dict(row) for row in conn.execute(self.peersTable.select()).mappings()
+                    }
+                    newPeers = []
+                    allowedIPChanges = {}
+                    for i in parsed.peers:
                         if "PublicKey" in i.keys():
-                            with self.engine.connect() as conn:
-                                tempPeer = conn.execute(
-                                    self.peersTable.select().where(
-                                        self.peersTable.columns.id == i['PublicKey']
-                                    )
-                                ).mappings().fetchone()
-                            
+                            tempPeer = existingPeers.get(i['PublicKey'])
                             if tempPeer is None:
-                                tempPeer = {
-                                    "id": i['PublicKey'],
-                                    "private_key": "",
-                                    "DNS": self.DashboardConfig.GetConfig("Peers", "peer_global_DNS")[1],
-                                    "endpoint_allowed_ip": self.DashboardConfig.GetConfig("Peers", "peer_endpoint_allowed_ip")[
-                                        1],
-                                    "name": i.get("name"),
-                                    "total_receive": 0,
-                                    "total_sent": 0,
-                                    "total_data": 0,
-                                    "endpoint": "N/A",
-                                    "status": "stopped",
-                                    "latest_handshake": "N/A",
-                                    "allowed_ip": i.get("AllowedIPs", "N/A"),
-                                    "cumu_receive": 0,
-                                    "cumu_sent": 0,
-                                    "cumu_data": 0,
-                                    "mtu": self.DashboardConfig.GetConfig("Peers", "peer_mtu")[1] if len(self.DashboardConfig.GetConfig("Peers", "peer_mtu")[1]) > 0 else None,
-                                    "keepalive": self.DashboardConfig.GetConfig("Peers", "peer_keep_alive")[1] if len(self.DashboardConfig.GetConfig("Peers", "peer_keep_alive")[1]) > 0 else None,
-                                    "remote_endpoint": self.DashboardConfig.GetConfig("Peers", "remote_endpoint")[1],
-                                    "preshared_key": i["PresharedKey"] if "PresharedKey" in i.keys() else ""
-                                }
-                                with self.engine.begin() as conn:
-                                    conn.execute(
-                                        self.peersTable.insert().values(tempPeer)
-                                    )                                    
+                                tempPeer = self.newPeerTableData(i)
+                                newPeers.append(tempPeer)
+                                existingPeers[i['PublicKey']] = tempPeer
                             else:
-                                with self.engine.begin() as conn:
-                                    conn.execute(
-                                        self.peersTable.update().values({
-                                            "allowed_ip": i.get("AllowedIPs", "N/A")
-                                        }).where(
-                                            self.peersTable.columns.id == i['PublicKey']
-                                        )
-                                    )
-                            tmpList.append(Peer(tempPeer, self))
-                except Exception as e:
-                    current_app.logger.error(f"{self.Name} getPeers() Error", e)
+                                allowedIP = i.get("AllowedIPs", "N/A")
+                                if tempPeer["allowed_ip"] != allowedIP:
+                                    tempPeer["allowed_ip"] = allowedIP
+                                    allowedIPChanges[i['PublicKey']] = {"_id": i['PublicKey'], "allowed_ip": allowedIP}
+                            rows.append(tempPeer)
+                    if len(newPeers) > 0:
+                        conn.execute(self.peersTable.insert(), newPeers)
+                    self.__bulkUpdatePeers(conn, list(allowedIPChanges.values()))
+                self.__reconcilePeers(rows)
+            except Exception as e:
+                current_app.logger.error(f"{self.Name} getPeers() Error", e)
         else:
-            with self.engine.connect() as conn:
-                existingPeers = conn.execute(self.peersTable.select()).mappings().fetchall()
-                for i in existingPeers:
-                    tmpList.append(Peer(i, self))
-        self.Peers = tmpList
-    
+            self.loadPeersFromDatabase()
+
+    def __bulkInsert(self, conn, table: sqlalchemy.Table, rows: list[dict]):
+        """
+        Insert rows with COPY on PostgreSQL and a single executemany elsewhere
+        @param conn: Connection inside a transaction
+        """
+        if len(rows) == 0:
+            return
+        if conn.dialect.name == 'postgresql':
+            columns = list(rows[0].keys())
+            quotedColumns = ", ".join(f'"{c}"' for c in columns)
+            with conn.connection.driver_connection.cursor() as cursor:
+                with cursor.copy(f'COPY "{table.name}" ({quotedColumns}) FROM STDIN') as copy:
+                    for row in rows:
+                        copy.write_row([row[c] for c in columns])
+        else:
+            conn.execute(table.insert(), rows)
+
     def logPeersTraffic(self):
+        now = datetime.now()
+        rows = [{
+            "id": tempPeer.id,
+            "total_receive": tempPeer.total_receive,
+            "total_sent": tempPeer.total_sent,
+            "total_data": tempPeer.total_data,
+            "cumu_sent": tempPeer.cumu_sent,
+            "cumu_receive": tempPeer.cumu_receive,
+            "cumu_data": tempPeer.cumu_data,
+            "time": now
+        } for tempPeer in self.Peers if tempPeer.status == "running"]
+        if len(rows) > 0:
+            with self.engine.begin() as conn:
+                self.__bulkInsert(conn, self.peersTransferTable, rows)
+
+    def __getSeenEndpoints(self, conn) -> set[tuple[str, str]]:
+        # Reloaded every hour in case the table was cleared outside of this process
+        if self.__seenEndpoints is None or time.time() - self.__seenEndpointsLoadedTime > 3600:
+            self.__seenEndpoints = set(
+                (row[0], row[1]) for row in conn.execute(
+                    sqlalchemy.select(
+                        self.peersHistoryEndpointTable.c.id,
+                        self.peersHistoryEndpointTable.c.endpoint
+                    ).distinct()
+                ).fetchall()
+            )
+            self.__seenEndpointsLoadedTime = time.time()
+        return self.__seenEndpoints
+
+    def logPeersHistoryEndpoint(self):
+        now = datetime.now()
         with self.engine.begin() as conn:
+            seen = self.__getSeenEndpoints(conn)
+            rows = []
             for tempPeer in self.Peers:
                 if tempPeer.status == "running":
-                    conn.execute(
-                        self.peersTransferTable.insert().values({
+                    endpoint = tempPeer.endpoint.rsplit(":", 1)    
+                    if len(endpoint) == 2 and len(endpoint[0]) > 0 and (tempPeer.id, endpoint[0]) not in seen:
+                        rows.append({
                             "id": tempPeer.id,
-                            "total_receive": tempPeer.total_receive,
-                            "total_sent": tempPeer.total_sent,
-                            "total_data": tempPeer.total_data,
-                            "cumu_sent": tempPeer.cumu_sent,
-                            "cumu_receive": tempPeer.cumu_receive,
-                            "cumu_data": tempPeer.cumu_data,
-                            "time": datetime.now()
+                            "endpoint": endpoint[0],
+                            "time": now
                         })
-                    )
-    
-    def logPeersHistoryEndpoint(self):
+            self.__bulkInsert(conn, self.peersHistoryEndpointTable, rows)
+        seen.update((row["id"], row["endpoint"]) for row in rows)
+
+    def peerBatch(self) -> WireguardPeerBatch:
+        return WireguardPeerBatch(self.Protocol, self.Name)
+
+    def insertPeers(self, rows: list[dict]) -> dict[str, str]:
+        """
+        Insert new peers into the peers table, then set them on the interface in one batch with no transaction
+        open. The rows of the peers the interface rejected are deleted in a short second transaction. If that
+        fails, the peers are removed from the interface and their rows deleted, so none of them is added.
+        @param rows: Rows of the peers table
+        @return: Error message of every peer that could not be added, by public key
+        """
+        if len(rows) == 0:
+            return {}
         with self.engine.begin() as conn:
-            for tempPeer in self.Peers:
-                if tempPeer.status == "running":
-                    endpoint = tempPeer.endpoint.rsplit(":", 1)    
-                    if len(endpoint) == 2 and len(endpoint[0]) > 0:
-                        exist = conn.execute(
-                            self.peersHistoryEndpointTable.select().where(
-                                sqlalchemy.and_(
-                                    self.peersHistoryEndpointTable.c.id == tempPeer.id,
-                                    self.peersHistoryEndpointTable.c.endpoint == endpoint[0]
-                                )
-                            )
-                        ).mappings().fetchone()
-                        if not exist:
-                            conn.execute(
-                                self.peersHistoryEndpointTable.insert().values({
-                                    "id": tempPeer.id,
-                                    "endpoint": endpoint[0],
-                                    "time": datetime.now()
-                                })
-                            )
-                          
+            conn.execute(self.peersTable.insert(), rows)
+        try:
+            failed = self.peerBatch().set(rows)
+            if len(failed) > 0:
+                with self.engine.begin() as conn:
+                    conn.execute(
+                        self.peersTable.delete().where(self.peersTable.columns.id.in_(list(failed.keys())))
+                    )
+        except Exception:
+            publicKeys = [r['id'] for r in rows]
+            self.peerBatch().remove(publicKeys)
+            with self.engine.begin() as conn:
+                conn.execute(self.peersTable.delete().where(self.peersTable.columns.id.in_(publicKeys)))
+            raise
+        return failed
+
     def addPeers(self, peers: list) -> tuple[bool, list, str]:
         result = {
             "message": None,
             "peers": []
         }
         try:
-            with self.engine.begin() as conn:
-                for i in peers:
-                    newPeer = {
-                        "id": i['id'],
-                        "private_key": i['private_key'],
-                        "DNS": i['DNS'],
-                        "endpoint_allowed_ip": i['endpoint_allowed_ip'],
-                        "name": i['name'],
-                        "total_receive": 0,
-                        "total_sent": 0,
-                        "total_data": 0,
-                        "endpoint": "N/A",
-                        "status": "stopped",
-                        "latest_handshake": "N/A",
-                        "allowed_ip": i.get("allowed_ip", "N/A"),
-                        "cumu_receive": 0,
-                        "cumu_sent": 0,
-                        "cumu_data": 0,
-                        "mtu": i['mtu'],
-                        "keepalive": i['keepalive'],
-                        "remote_endpoint": self.DashboardConfig.GetConfig("Peers", "remote_endpoint")[1],
-                        "preshared_key": i["preshared_key"]
-                    }
-                    conn.execute(
-                        self.peersTable.insert().values(newPeer)
-                    )
-            for p in peers:
-                presharedKeyExist = len(p['preshared_key']) > 0
-                rd = random.Random()
-                uid = str(uuid.UUID(int=rd.getrandbits(128), version=4))
-                if presharedKeyExist:
-                    with open(uid, "w+") as f:
-                        f.write(p['preshared_key'])
-
-                subprocess.check_output(f"{self.Protocol} set {self.Name} peer {p['id']} allowed-ips {p['allowed_ip'].replace(' ', '')}{f' preshared-key {uid}' if presharedKeyExist else ''}",
-                                        shell=True, stderr=subprocess.STDOUT)
-                if presharedKeyExist:
-                    os.remove(uid)
-            subprocess.check_output(
-                f"{self.Protocol}-quick save {self.Name}", shell=True, stderr=subprocess.STDOUT)
-            self.getPeers()
-            for p in peers:
-                p = self.searchPeer(p['id'])
+            rows = []
+            for i in peers:
+                rows.append({
+                    "id": i['id'],
+                    "private_key": i['private_key'],
+                    "DNS": i['DNS'],
+                    "endpoint_allowed_ip": i['endpoint_allowed_ip'],
+                    "name": i['name'],
+                    "total_receive": 0,
+                    "total_sent": 0,
+                    "total_data": 0,
+                    "endpoint": "N/A",
+                    "status": "stopped",
+                    "latest_handshake": "N/A",
+                    "allowed_ip": i.get("allowed_ip", "N/A"),
+                    "cumu_receive": 0,
+                    "cumu_sent": 0,
+                    "cumu_data": 0,
+                    "mtu": i['mtu'],
+                    "keepalive": i['keepalive'],
+                    "remote_endpoint": self.DashboardConfig.GetConfig("Peers", "remote_endpoint")[1],
+                    "preshared_key": i["preshared_key"]
+                })
+            failed = self.insertPeers(rows)
+            if len(failed) < len(rows):
+                self.SaveScheduler.schedule()
+            self.loadPeersFromDatabase()
+            added = [p['id'] for p in peers if p['id'] not in failed]
+            for p in added:
+                p = self.searchPeer(p)
                 if p[0]:
                     result['peers'].append(p[1])
-            self.DashboardWebHooks.RunWebHook("peer_created", {
-                "configuration": self.Name,
-                "peers": list(map(lambda k : k['id'], peers))
-            })
+            if len(added) > 0:
+                self.DashboardWebHooks.RunWebHook("peer_created", {
+                    "configuration": self.Name,
+                    "peers": added
+                })
+            if len(failed) > 0:
+                return False, result['peers'], \
+                    f"Failed to add {len(failed)} peer(s): {WireguardPeerBatch.summary(failed)}"
         except Exception as e:
             current_app.logger.error("Add peers error", e)
             return False, [], str(e)
         return True, result['peers'], ""
 
     def searchPeer(self, publicKey):
-        for i in self.Peers:
-            if i.id == publicKey:
-                return True, i
+        peer = self.__peersIndex.get(publicKey)
+        if peer is not None:
+            return True, peer
         return False, None
 
     def allowAccessPeers(self, listOfPublicKeys) -> tuple[bool, str]:
         if not self.getStatus():
             self.toggleConfiguration()
-        with self.engine.begin() as conn:
-            for i in listOfPublicKeys:
-                stmt = self.peersRestrictedTable.select().where(
-                    self.peersRestrictedTable.columns.id == i
+        with self.engine.connect() as conn:
+            restricted = conn.execute(
+                self.peersRestrictedTable.select().where(
+                    self.peersRestrictedTable.columns.id.in_(listOfPublicKeys)
                 )
-                restrictedPeer = conn.execute(stmt).mappings().fetchone()
-                if restrictedPeer is not None:
-                    conn.execute(
-                        self.peersTable.insert().from_select(
-                            [c.name for c in self.peersTable.columns],
-                            stmt
+            ).mappings().fetchall()
+        found = set(r['id'] for r in restricted)
+        for i in listOfPublicKeys:
+            if i not in found:
+                return False, "Failed to allow access of peer " + i
+        # The interface is changed with no transaction open, the rows are only moved for the peers it took
+        failed = self.peerBatch().set(restricted)
+        applied = [r['id'] for r in restricted if r['id'] not in failed]
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    self.peersTable.insert().from_select(
+                        [c.name for c in self.peersTable.columns],
+                        self.peersRestrictedTable.select().where(
+                            self.peersRestrictedTable.columns.id.in_(applied)
                         )
                     )
-                    conn.execute(
-                        self.peersRestrictedTable.delete().where(
-                            self.peersRestrictedTable.columns.id == i
-                        )
+                )
+                conn.execute(
+                    self.peersRestrictedTable.delete().where(
+                        self.peersRestrictedTable.columns.id.in_(applied)
                     )
-
-                    presharedKeyExist = len(restrictedPeer['preshared_key']) > 0
-                    rd = random.Random()
-                    uid = str(uuid.UUID(int=rd.getrandbits(128), version=4))
-                    if presharedKeyExist:
-                        with open(uid, "w+") as f:
-                            f.write(restrictedPeer['preshared_key'])
-
-                    subprocess.check_output(f"{self.Protocol} set {self.Name} peer {restrictedPeer['id']} allowed-ips {restrictedPeer['allowed_ip'].replace(' ', '')}{f' preshared-key {uid}' if presharedKeyExist else ''}",
-                                            shell=True, stderr=subprocess.STDOUT)
-                    if presharedKeyExist: os.remove(uid)
-                else:
-                    return False, "Failed to allow access of peer " + i
-        if not self.__wgSave():
-            return False, "Failed to save configuration through WireGuard"
-        self.getPeers()
+                )
+        except Exception:
+            self.peerBatch().remove(applied)
+            raise
+        if len(applied) > 0:
+            self.SaveScheduler.schedule()
+        self.loadPeersFromDatabase()
+        self.getRestrictedPeers()
+        if len(failed) > 0:
+            return False, f"Failed to allow access of {len(failed)} peer(s): {WireguardPeerBatch.summary(failed)}"
         return True, "Allow access successfully"
 
+    def __removePeers(self, peers: list[Peer], updateDatabase) -> tuple[list[str], dict[str, str]]:
+        """
+        Remove peers from the interface in one batch, then update the database for the ones that were removed.
+        If the transaction fails, the peers are set on the interface again and count as failed.
+        @param updateDatabase: Called with a connection inside a transaction and the removed public keys
+        @return: Removed public keys, and error message of every peer that could not be removed
+        """
+        failed = self.peerBatch().remove([p.id for p in peers])
+        removed = [p for p in peers if p.id not in failed]
+        if len(removed) == 0:
+            return [], failed
+        try:
+            with self.engine.begin() as conn:
+                updateDatabase(conn, [p.id for p in removed])
+        except Exception as e:
+            current_app.logger.error(f"{self.Name} removing peers failed, setting them back", e)
+            self.peerBatch().set([
+                {"id": p.id, "allowed_ip": p.allowed_ip, "preshared_key": p.preshared_key} for p in removed
+            ])
+            failed.update({p.id: str(e) for p in removed})
+            return [], failed
+        return [p.id for p in removed], failed
+
     def restrictPeers(self, listOfPublicKeys) -> tuple[bool, str]:
-        numOfRestrictedPeers = 0
-        numOfFailedToRestrictPeers = 0
         if not self.getStatus():
             self.toggleConfiguration()
+        self.flushPeerStates()
 
-        with self.engine.begin() as conn:
-            for p in listOfPublicKeys:
-                found, pf = self.searchPeer(p)
-                if found:
-                    try:
-                        subprocess.check_output(f"{self.Protocol} set {self.Name} peer {pf.id} remove",
-                                                shell=True, stderr=subprocess.STDOUT)
-                        conn.execute(
-                            self.peersRestrictedTable.insert().from_select(
-                                [c.name for c in self.peersTable.columns],
-                                self.peersTable.select().where(
-                                    self.peersTable.columns.id == pf.id
-                                )
-                            )
-                        )
-                        conn.execute(
-                            self.peersRestrictedTable.update().values({
-                                "status": "stopped"
-                            }).where(
-                                self.peersRestrictedTable.columns.id == pf.id
-                            )
-                        )
-                        conn.execute(
-                            self.peersTable.delete().where(
-                                self.peersTable.columns.id == pf.id
-                            )
-                        )
-                        numOfRestrictedPeers += 1
-                    except Exception as e:
-                        traceback.print_stack()
-                        numOfFailedToRestrictPeers += 1
+        def restrict(conn, publicKeys):
+            conn.execute(
+                self.peersRestrictedTable.insert().from_select(
+                    [c.name for c in self.peersTable.columns],
+                    self.peersTable.select().where(
+                        self.peersTable.columns.id.in_(publicKeys)
+                    )
+                )
+            )
+            conn.execute(
+                self.peersRestrictedTable.update().values({
+                    "status": "stopped"
+                }).where(
+                    self.peersRestrictedTable.columns.id.in_(publicKeys)
+                )
+            )
+            conn.execute(
+                self.peersTable.delete().where(
+                    self.peersTable.columns.id.in_(publicKeys)
+                )
+            )
 
-        if not self.__wgSave():
-            return False, "Failed to save configuration through WireGuard"
+        peers = [pf for found, pf in map(self.searchPeer, listOfPublicKeys) if found]
+        restricted, failed = self.__removePeers(peers, restrict)
+        numOfRestrictedPeers = len(restricted)
+        numOfFailedToRestrictPeers = len(failed)
 
-        self.getPeers()
+        if numOfRestrictedPeers > 0:
+            self.SaveScheduler.schedule()
+        self.loadPeersFromDatabase()
+        self.getRestrictedPeers()
 
         if numOfRestrictedPeers == len(listOfPublicKeys):
             return True, f"Restricted {numOfRestrictedPeers} peer(s)"
+        if numOfFailedToRestrictPeers > 0:
+            current_app.logger.error(f"{self.Name} failed to restrict peers: {WireguardPeerBatch.summary(failed)}")
         return False, f"Restricted {numOfRestrictedPeers} peer(s) successfully. Failed to restrict {numOfFailedToRestrictPeers} peer(s)"
 
 
     def deletePeers(self, listOfPublicKeys, AllPeerJobs: PeerJobs, AllPeerShareLinks: PeerShareLinks) -> tuple[bool, str]:
-        numOfDeletedPeers = 0
-        numOfFailedToDeletePeers = 0
-        deleted = []
         if not self.getStatus():
             self.toggleConfiguration()
-        with self.engine.begin() as conn:
-            for p in listOfPublicKeys:
-                found, pf = self.searchPeer(p)
+
+        def delete(conn, publicKeys):
+            conn.execute(
+                self.peersTable.delete().where(
+                    self.peersTable.columns.id.in_(publicKeys)
+                )
+            )
+
+        peers = [pf for found, pf in map(self.searchPeer, listOfPublicKeys) if found]
+        deleted, failed = self.__removePeers(peers, delete)
+        numOfDeletedPeers = len(deleted)
+        numOfFailedToDeletePeers = len(failed)
+        for pf in peers:
+            if pf.id in deleted:
                 for job in pf.jobs:
                     AllPeerJobs.deleteJob(job)
                 for shareLink in pf.ShareLink:
                     AllPeerShareLinks.updateLinkExpireDate(shareLink.ShareID, datetime.now())
-                if found:
-                    try:
-                        subprocess.check_output(f"{self.Protocol} set {self.Name} peer {pf.id} remove",
-                                                shell=True, stderr=subprocess.STDOUT)
-                        conn.execute(
-                            self.peersTable.delete().where(
-                                self.peersTable.columns.id == pf.id
-                            )
-                        )
-                        deleted.append(pf.id)
-                        numOfDeletedPeers += 1
-                    except Exception as e:
-                        numOfFailedToDeletePeers += 1
-
-        if not self.__wgSave():
-            return False, "Failed to save configuration through WireGuard"
 
-        self.getPeers()
+        if numOfDeletedPeers > 0:
+            self.SaveScheduler.schedule()
+        self.loadPeersFromDatabase()
         
         if numOfDeletedPeers == 0 and numOfFailedToDeletePeers == 0:
             return False, "No peer(s) to delete found"
@@ -717,135 +878,322 @@ class WireguardConfiguration:
         
         return False, f"Deleted {numOfDeletedPeers} peer(s) successfully. Failed to delete {numOfFailedToDeletePeers} peer(s)"
 
-    def __wgSave(self) -> tuple[bool, str] | tuple[bool, None]:
+    def writeConfigurationFile(self) -> tuple[bool, str] | tuple[bool, None]:
+        """
+        Write the configuration file without going through wg-quick save. The lines before the first [Peer]
+        are kept as they are in the file, every peer of the peers table gets a [Peer] section with its name,
+        public key, preshared key and allowed IPs, followed by the other keys its section already had.
+        If the file changed since it was last read, the sections of peers the database does not know yet are
+        kept as they are, and the file is left to be read again so they get imported.
+        Peers keep their order in the file, new ones are added at the end.
+        @return: Status and error message
+        """
         try:
-            subprocess.check_output(f"{self.Protocol}-quick save {self.Name}", shell=True, stderr=subprocess.STDOUT)
+            parsed = WireguardConfigurationParsers.parse(self.configPath)
+            if not parsed.hasInterface:
+                return False, "[Interface] section not found in " + self.configPath
+            # Only mark the written file as read if nothing else changed it since it was last read
+            upToDate = not self.configurationFileChanged(update=False)
+            sections = {i["PublicKey"]: i for i in parsed.peers if "PublicKey" in i.keys()}
+            order = {publicKey: index for index, publicKey in enumerate(sections.keys())}
+            with self.engine.connect() as conn:
+                rows = conn.execute(
+                    sqlalchemy.select(
+                        self.peersTable.c.id, self.peersTable.c.name,
+                        self.peersTable.c.allowed_ip, self.peersTable.c.preshared_key
+                    )
+                ).mappings().fetchall()
+                restricted = set() if upToDate else set(
+                    conn.execute(sqlalchemy.select(self.peersRestrictedTable.c.id)).scalars().all()
+                )
+            peers = []
+            for row in rows:
+                keys = [("PublicKey", row["id"])]
+                if row["preshared_key"]:
+                    keys.append(("PresharedKey", row["preshared_key"]))
+                if row["allowed_ip"] and row["allowed_ip"] != "N/A":
+                    keys.append(("AllowedIPs", row["allowed_ip"]))
+                for key, value in sections.get(row["id"], {}).items():
+                    if key.strip() not in ("name", "PublicKey", "PresharedKey", "AllowedIPs"):
+                        keys.append((key.strip(), value))
+                peers.append((order.get(row["id"], len(order)), row["name"], keys))
+            if not upToDate:
+                # Peers added to the file by hand since it was last read
+                known = set(r["id"] for r in rows) | restricted
+                for publicKey, section in sections.items():
+                    if publicKey not in known:
+                        peers.append((order[publicKey], section.get("name"), [
+                            (key.strip(), value) for key, value in section.items() if key != "name"
+                        ]))
+            peers.sort(key=lambda p: p[0])
+            key, _ = WireguardConfigurationParsers.write(
+                self.configPath, WireguardConfigurationParsers.formatText(parsed.header, [p[1:] for p in peers]))
+            if upToDate:
+                self.__configFileModifiedTime = key
             return True, None
-        except subprocess.CalledProcessError as e:
+        except Exception as e:
             return False, str(e)
 
-    def getPeersLatestHandshake(self):
-        if not self.getStatus():
-            self.toggleConfiguration()
+    def __saveConfiguration(self) -> tuple[bool, str] | tuple[bool, None]:
+        status, message = self.writeConfigurationFile()
+        if not status:
+            self.__logger.error(f"[WGDashboard] Failed to save configuration {self.Name}: {message}")
+        return status, message
+
+    def __getSaveDelayConfig(self) -> float:
+        _, value = self.DashboardConfig.GetConfig("WireGuardConfiguration", "save_delay")
         try:
-            latestHandshake = subprocess.check_output(f"{self.Protocol} show {self.Name} latest-handshakes",
-                                                      shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            return "stopped"
-        latestHandshake = latestHandshake.decode("UTF-8").split()
-        count = 0
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            return 1.0
+
+    def getPeersDump(self) -> dict[str, WireguardPeerDump] | None:
+        try:
+            with self.PollMetrics.measure("fetch"):
+                raw = self.statsBackend.fetch(self.Name)
+        except WireguardStatsBackend.InterfaceNotFoundException:
+            return None
+        with self.PollMetrics.measure("parse"):
+            return self.statsBackend.parse(raw)
+
+    def __countStatement(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self.__pollStatements, "count", None) is not None:
+            self.__pollStatements.count += 1
+
+    def __bulkUpdatePeers(self, conn, changes: list[dict]):
+        """
+        Update peers with one executemany per distinct set of changed columns
+        @param conn: Connection inside a transaction
+        @param changes: Dictionaries of changed columns, each with the peer's public key under "_id"
+        """
+        groups: dict[tuple, list[dict]] = {}
+        for change in changes:
+            groups.setdefault(tuple(sorted(change.keys())), []).append(change)
+        for columns, params in groups.items():
+            conn.execute(
+                self.peersTable.update().where(
+                    self.peersTable.c.id == sqlalchemy.bindparam("_id")
+                ).values({
+                    c: sqlalchemy.bindparam(c) for c in columns if c != "_id"
+                }),
+                params
+            )
+
+    def __peersLatestHandshakeChanges(self, peersDump: dict[str, WireguardPeerDump],
+                                      currentPeers: dict[str, dict]) -> dict[str, dict]:
+        changes = {}
         now = datetime.now()
         time_delta = timedelta(minutes=3)
+        for peerDump in peersDump.values():
+            current = currentPeers.get(peerDump.PublicKey)
+            if current is None:
+                continue
+            minus = now - datetime.fromtimestamp(peerDump.LatestHandshake)
+            if minus < time_delta:
+                status = "running"
+            else:
+                status = "stopped"
+            if peerDump.LatestHandshake > 0:
+                latestHandshake = str(minus).split(".", maxsplit=1)[0]
+            else:
+                latestHandshake = "No Handshake"
+            if current['latest_handshake'] != latestHandshake or current['status'] != status:
+                changes[peerDump.PublicKey] = {
+                    "latest_handshake": latestHandshake,
+                    "status": status
+                }
+        return changes
+
+    def __peersTransferChanges(self, peersDump: dict[str, WireguardPeerDump],
+                               currentPeers: dict[str, dict]) -> dict[str, dict]:
+        changes = {}
+        for peerDump in peersDump.values():
+            cur_i = currentPeers.get(peerDump.PublicKey)
+            if cur_i is None:
+                continue
+            change = {}
+            total_sent = cur_i['total_sent']
+            total_receive = cur_i['total_receive']
+            cur_total_sent = peerDump.TransferTx / (1024 ** 3)
+            cur_total_receive = peerDump.TransferRx / (1024 ** 3)
+            cumulative_receive = cur_i['cumu_receive'] + total_receive
+            cumulative_sent = cur_i['cumu_sent'] + total_sent
+            if total_sent <= cur_total_sent and total_receive <= cur_total_receive:
+                total_sent = cur_total_sent
+                total_receive = cur_total_receive
+            else:
+                change.update({
+                    "cumu_receive": cumulative_receive,
+                    "cumu_sent": cumulative_sent,
+                    "cumu_data": cumulative_sent + cumulative_receive
+                })
+                total_sent = 0
+                total_receive = 0
+            if cur_i['total_receive'] != total_receive or cur_i['total_sent'] != total_sent:
+                change.update({
+                    "total_receive": total_receive,
+                    "total_sent": total_sent,
+                    "total_data": total_receive + total_sent
+                })
+            if change:
+                changes[peerDump.PublicKey] = change
+        return changes
+
+    def __peersEndpointChanges(self, peersDump: dict[str, WireguardPeerDump],
+                               currentPeers: dict[str, dict]) -> dict[str, dict]:
+        changes = {}
+        for peerDump in peersDump.values():
+            current = currentPeers.get(peerDump.PublicKey)
+            if current is not None and current['endpoint'] != peerDump.Endpoint:
+                changes[peerDump.PublicKey] = {
+                    "endpoint": peerDump.Endpoint
+                }
+        return changes
+
+    def __applyPeersRuntimeChanges(self, peersDump: dict[str, WireguardPeerDump], *changeBuilders) -> dict[str, dict]:
+        currentPeers = self.PeerStates.snapshot()
+        changes: dict[str, dict] = {}
+        for changeBuilder in changeBuilders:
+            for peerId, change in changeBuilder(peersDump, currentPeers).items():
+                changes.setdefault(peerId, {}).update(change)
+        for peerId, change in changes.items():
+            self.PeerStates.update(peerId, change)
+        self.__applyPeerStates()
+        return changes
+
+    def __applyPeerStates(self):
+        for peer in self.Peers:
+            state = self.PeerStates.get(peer.id)
+            if state is not None:
+                for field, value in state.items():
+                    setattr(peer, field, value)
+
+    def flushPeerStates(self) -> bool:
+        """
+        Persist the runtime fields changed in memory since the last flush
+        @return: True if all dirty fields were written
+        """
+        changes = self.PeerStates.popDirty()
+        if len(changes) == 0:
+            return True
+        try:
+            with self.PollMetrics.measure("flush"), self.engine.begin() as conn:
+                self.__bulkUpdatePeers(conn, changes)
+        except Exception as e:
+            self.PollMetrics.recordError("flush", e)
+            self.PeerStates.restoreDirty(changes)
+            current_app.logger.error(f"{self.Name} flushing peer states failed", e)
+            return False
+        return True
 
-        with self.engine.begin() as conn:
-            for _ in range(int(len(latestHandshake) / 2)):
-                minus = now - datetime.fromtimestamp(int(latestHandshake[count + 1]))
-                if minus < time_delta:
-                    status = "running"
-                else:
-                    status = "stopped"
-                if int(latestHandshake[count + 1]) > 0:
-                    conn.execute(
-                        self.peersTable.update().values({
-                            "latest_handshake": str(minus).split(".", maxsplit=1)[0],
-                            "status": status
-                        }).where(
-                            self.peersTable.columns.id == latestHandshake[count]
-                        )
-                    )
-                else:
-                    conn.execute(
-                        self.peersTable.update().values({
-                            "latest_handshake": "No Handshake",
-                            "status": status
-                        }).where(
-                            self.peersTable.columns.id == latestHandshake[count]
-                        )
-                    )
-                count += 2
-
-    def getPeersTransfer(self):
+    def updatePeersRuntimeInformation(self):
         if not self.getStatus():
             self.toggleConfiguration()
-        # try:
-        data_usage = subprocess.check_output(f"{self.Protocol} show {self.Name} transfer",
-                                             shell=True, stderr=subprocess.STDOUT)
-        data_usage = data_usage.decode("UTF-8").split("\n")
-        
-        data_usage = [p.split("\t") for p in data_usage]
-        cur_i = None
-        with self.engine.begin() as conn:
-            for i in range(len(data_usage)):
-                if len(data_usage[i]) == 3:
-                    cur_i = conn.execute(
-                        self.peersTable.select().where(
-                            self.peersTable.c.id == data_usage[i][0]
-                        )
-                    ).mappings().fetchone()
-                    if cur_i is not None:
-                        # print(cur_i is None)
-                        total_sent = cur_i['total_sent']
-                        # print(cur_i is None)
-                        total_receive = cur_i['total_receive']
-                        cur_total_sent = float(data_usage[i][2]) / (1024 ** 3)
-                        cur_total_receive = float(data_usage[i][1]) / (1024 ** 3)
-                        cumulative_receive = cur_i['cumu_receive'] + total_receive
-                        cumulative_sent = cur_i['cumu_sent'] + total_sent
-                        if total_sent <= cur_total_sent and total_receive <= cur_total_receive:
-                            total_sent = cur_total_sent
-                            total_receive = cur_total_receive
-                        else:
-                            conn.execute(
-                                self.peersTable.update().values({
-                                    "cumu_receive": cumulative_receive,
-                                    "cumu_sent": cumulative_sent,
-                                    "cumu_data": cumulative_sent + cumulative_receive
-                                }).where(
-                                    self.peersTable.c.id == data_usage[i][0]
-                                )
-                            )
-
-                            total_sent = 0
-                            total_receive = 0
-                        status, p = self.searchPeer(data_usage[i][0])
-                        if status:
-                            if p.total_receive != total_receive or p.total_sent != total_sent:
-                                conn.execute(
-                                    self.peersTable.update().values({
-                                        "total_receive": total_receive,
-                                        "total_sent": total_sent,
-                                        "total_data": total_receive + total_sent
-                                    }).where(
-                                        self.peersTable.c.id == data_usage[i][0]
-                                    )
-                                )
-
-            
+        peersDump = self.getPeersDump()
+        self.PeersDump = peersDump
+        if peersDump is None:
+            self.PeersActive = False
+            return "stopped"
+        changes = self.__applyPeersRuntimeChanges(peersDump,
+                                                  self.__peersLatestHandshakeChanges,
+                                                  self.__peersTransferChanges,
+                                                  self.__peersEndpointChanges)
+        self.PeersActive = any(p.status == "running" for p in self.Peers) or \
+            any("total_receive" in c or "total_sent" in c for c in changes.values())
+
+    def getPeersLatestHandshake(self, peersDump: dict[str, WireguardPeerDump] = None):
+        if peersDump is None:
+            if not self.getStatus():
+                self.toggleConfiguration()
+            peersDump = self.getPeersDump()
+            if peersDump is None:
+                return "stopped"
+        self.__applyPeersRuntimeChanges(peersDump, self.__peersLatestHandshakeChanges)
+
+    def getPeersTransfer(self, peersDump: dict[str, WireguardPeerDump] = None):
+        if peersDump is None:
+            if not self.getStatus():
+                self.toggleConfiguration()
+            peersDump = self.getPeersDump()
+            if peersDump is None:
+                return "stopped"
+        self.__applyPeersRuntimeChanges(peersDump, self.__peersTransferChanges)
+
+    def getPeersEndpoint(self, peersDump: dict[str, WireguardPeerDump] = None):
+        if peersDump is None:
+            if not self.getStatus():
+                self.toggleConfiguration()
+            peersDump = self.getPeersDump()
+            if peersDump is None:
+                return "stopped"
+        self.__applyPeersRuntimeChanges(peersDump, self.__peersEndpointChanges)
 
-    def getPeersEndpoint(self):
-        if not self.getStatus():
-            self.toggleConfiguration()
+    def __getIntervalConfig(self, key: str, default: int) -> int:
+        _, value = self.DashboardConfig.GetConfig("WireGuardConfiguration", key)
         try:
-            data_usage = subprocess.check_output(f"{self.Protocol} show {self.Name} endpoints",
-                                                 shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            return "stopped"
-        data_usage = data_usage.decode("UTF-8").split()
-        count = 0
-        with self.engine.begin() as conn:
-            for _ in range(int(len(data_usage) / 2)):
-                conn.execute(
-                    self.peersTable.update().values({
-                        "endpoint": data_usage[count + 1]
-                    }).where(
-                        self.peersTable.c.id == data_usage[count]
-                    )
-                )
-                count += 2
+            return max(1, int(value))
+        except (TypeError, ValueError):
+            return default
+
+    def getPollInterval(self) -> int:
+        """
+        Poll busy or viewed configurations at the fast rate, idle or stopped ones at the idle rate
+        @return: Seconds until the next poll
+        """
+        fastInterval = self.__getIntervalConfig("peer_polling_fast_interval", 10)
+        if self.Status and (self.PeersActive or self.isViewed()):
+            return fastInterval
+        return max(fastInterval, self.__getIntervalConfig("peer_polling_idle_interval", 60))
+
+    def isViewed(self) -> bool:
+        return time.time() - self.LastViewedTime < WireguardConfiguration.ViewedPollWindow
+
+    def markViewed(self):
+        """
+        Called when the dashboard displays this configuration, brings it back to the fast polling rate
+        """
+        self.LastViewedTime = time.time()
+        self.NextPollTime = min(self.NextPollTime,
+                                self.LastPollTime + self.__getIntervalConfig("peer_polling_fast_interval", 10))
+
+    def isPollDue(self) -> bool:
+        return time.time() >= self.NextPollTime
+
+    def schedulePoll(self):
+        self.LastPollTime = time.time()
+        self.NextPollTime = self.LastPollTime + self.getPollInterval()
+
+    def pollPeerInformation(self, logInterval: int = 60):
+        """
+        Refresh the runtime information of all peers once, as done by the background thread every cycle
+        @param logInterval: Minimum seconds between two records of traffic and endpoint history
+        """
+        self.__pollStatements.count = 0
+        try:
+            with self.PollMetrics.measure("cycle"):
+                self.updatePeersRuntimeInformation()
+                if self.configurationFileChanged(update=False):
+                    with self.PollMetrics.measure("getPeers"):
+                        self.getPeers()
+                if time.time() - self.__lastTrafficLogTime >= logInterval:
+                    self.__lastTrafficLogTime = time.time()
+                    with self.PollMetrics.measure("db"):
+                        if self.configurationInfo.PeerTrafficTracking:
+                            self.logPeersTraffic()
+                        if self.configurationInfo.PeerHistoricalEndpointTracking:
+                            self.logPeersHistoryEndpoint()
+        except Exception as e:
+            self.PollMetrics.recordError("cycle", e)
+            raise
+        else:
+            self.PollStatementCount = self.__pollStatements.count
+        finally:
+            self.__pollStatements.count = None
 
     def toggleConfiguration(self) -> tuple[bool, str] | tuple[bool, None]:
-        self.getStatus()
+        self.getStatus(forceRefresh=True)
         if self.Status:
+            self.SaveScheduler.flush()
             try:
                 check = subprocess.check_output(f"{self.Protocol}-quick down {self.Name}",
                                                 shell=True, stderr=subprocess.STDOUT)
@@ -859,7 +1207,7 @@ class WireguardConfiguration:
             except subprocess.CalledProcessError as exc:
                 return False, str(exc.output.strip().decode("utf-8"))
         self.__parseConfigurationFile()
-        self.getStatus()
+        self.getStatus(forceRefresh=True)
         return True, None
 
     def getPeersList(self):
@@ -892,10 +1240,14 @@ class WireguardConfiguration:
             "TotalPeers": len(self.Peers),
             "Protocol": self.Protocol,
             "Table": self.Table,
-            "Info": self.configurationInfo.model_dump()
+            "Info": self.configurationInfo.model_dump(),
+            "PollStatementCount": self.PollStatementCount,
+            "SaveError": self.SaveScheduler.LastResult[1]
         }
 
     def backupConfigurationFile(self) -> tuple[bool, dict[str, str]]:
+        self.flushPeerStates()
+        self.SaveScheduler.flush()
         if not os.path.exists(os.path.join(self.__getProtocolPath(), 'WGDashboard_Backup')):
             os.mkdir(os.path.join(self.__getProtocolPath(), 'WGDashboard_Backup'))
         time = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -1036,6 +1388,7 @@ class WireguardConfiguration:
         try:
             if self.getStatus():
                 self.toggleConfiguration()
+            self.flushPeerStates()
             self.createDatabase(newConfigurationName)
             with self.engine.begin() as conn:
                 conn.execute(
@@ -1058,6 +1411,12 @@ class WireguardConfiguration:
                         f'INSERT INTO "{newConfigurationName}_transfer" SELECT * FROM "{self.Name}_transfer"'
                     )
                 )
+                for resolution in TransferRollup.Resolutions.keys():
+                    conn.execute(
+                        sqlalchemy.text(
+                            f'INSERT INTO "{newConfigurationName}_transfer_{resolution}" SELECT * FROM "{self.Name}_transfer_{resolution}"'
+                        )
+                    )
             self.AllPeerJobs.updateJobConfigurationName(self.Name, newConfigurationName)
             shutil.copy(
                 self.configPath,
@@ -1237,6 +1596,17 @@ class WireguardConfiguration:
                 msg = "Listen Port must be >= 1 and <= 65535"        
         return status, msg
         
+    def getTopTalkers(self, startDate: datetime, endDate: datetime, limit: int = 10) -> dict:
+        """
+        Peers that moved the most bytes between two dates, with their names
+        """
+        topTalkers = self.TransferRollups.getTopTalkers(startDate, endDate, limit)
+        peers = []
+        for p in topTalkers["Peers"]:
+            found, peer = self.searchPeer(p["id"])
+            peers.append(p | {"name": peer.name if found else "", "configuration": self.Name})
+        return topTalkers | {"Peers": peers}
+
     def getTransferTableSize(self):
         with self.engine.connect() as db:
             row_count = db.execute(
@@ -1264,31 +1634,61 @@ class WireguardConfiguration:
                 self.peersHistoryEndpointTable.select()
             ).mappings().fetchall()
             return data
-    
+
+    def streamTrackingTable(self, table: str, peerId: str = None, startDate: datetime = None, endDate: datetime = None,
+                            chunkSize: int = 1000):
+        """
+        Read a tracking table chunkSize rows at a time, paging on time and peer. Every page is read in its own
+        short transaction, so a slow download does not hold a read lock on the database.
+        @param table: TrafficTrackingTable or HistoricalTrackingTable
+        @param peerId: Only the rows of this peer
+        @param startDate: Only the rows at or after this time
+        @param endDate: Only the rows at or before this time
+        @return: Generator of rows, ordered by time and peer
+        """
+        t = self.peersTransferTable if table == 'TrafficTrackingTable' else self.peersHistoryEndpointTable
+        conditions = [t.c.time.is_not(None)]
+        if peerId is not None:
+            conditions.append(t.c.id == peerId)
+        if startDate is not None:
+            conditions.append(t.c.time >= startDate)
+        if endDate is not None:
+            conditions.append(t.c.time <= endDate)
+        statement = t.select().where(sqlalchemy.and_(*conditions)).order_by(t.c.time, t.c.id)
+        last = None
+        while True:
+            page = statement
+            if last is not None:
+                page = page.where(sqlalchemy.or_(
+                    t.c.time > last[0], sqlalchemy.and_(t.c.time == last[0], t.c.id > last[1])
+                ))
+            with self.engine.connect() as conn:
+                rows = conn.execute(page.limit(chunkSize)).mappings().fetchall()
+                full = len(rows) == chunkSize
+                if full:
+                    # Time and peer are not unique, the rows sharing the last pair of the page are all read
+                    # here since the next page starts after it
+                    last = (rows[-1]['time'], rows[-1]['id'])
+                    rows = [r for r in rows if (r['time'], r['id']) != last] + conn.execute(
+                        statement.where(t.c.time == last[0], t.c.id == last[1])
+                    ).mappings().fetchall()
+            for row in rows:
+                yield row
+            if not full:
+                return
+
     def deleteTransferTable(self):
         try:
-            with self.engine.begin() as db:
-                db.execute(
-                    self.peersTransferTable.delete()
-            )
-            with self.engine.connect() as conn:
-                if conn.dialect.name == 'sqlite':
-                    print("[WGDashboard] SQLite Vacuuming Database")
-                    conn.execute(sqlalchemy.text('VACUUM;'))
+            for table in [self.peersTransferTable, self.peersTransferHourlyTable, self.peersTransferDailyTable]:
+                DatabaseMaintenance.deleteInBatches(self.engine, table)
         except Exception as e:
             return False
         return True
 
     def deleteHistoryEndpointTable(self):
         try:
-            with self.engine.begin() as db:
-                db.execute(
-                    self.peersHistoryEndpointTable.delete()
-                )
-            with self.engine.connect() as conn:
-                if conn.dialect.name == 'sqlite':
-                    print("[WGDashboard] SQLite Vacuuming Database")
-                    conn.execute(sqlalchemy.text('VACUUM;'))
+            DatabaseMaintenance.deleteInBatches(self.engine, self.peersHistoryEndpointTable)
+            self.__seenEndpoints = None
         except Exception as e:
             return False
         return True
\ No newline at end of file
@@ -0,0 +1,164 @@
+"""
+Wireguard Configuration Parser
+"""
+import os, re, stat, tempfile, threading
+
+
+class ParsedWireguardConfiguration:
+    """
+    Content of a .conf file, as read by WireguardConfiguration
+    """
+    def __init__(self):
+        self.hasInterface: bool = False
+        self.hasPeers: bool = False
+        # Raw lines before the first [Peer], kept as they are when the file is written again
+        self.header: list[str] = []
+        # Key and value of every line from [Interface] to the first [Peer] after it, in order
+        self.interface: list[tuple[str, str]] = []
+        # Keys of every [Peer] section, with the name taken from #Name#
+        self.peers: list[dict[str, str]] = []
+
+
+class WireguardConfigurationParser:
+    """
+    Reads .conf files in a single pass and keeps the result until the file changes, as seen by its
+    inode, size and modification time. Files written through write() go straight into the cache.
+    Comment handling is the one WireguardConfiguration always had:
+    in the peer sections a line with a '#' or ';' anywhere is skipped, except for #Name# lines.
+    """
+    KeyValue = re.compile(r'\s*=\s*')
+    Name = re.compile(r'#Name# = (.*)')
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__cache: dict[str, tuple[tuple[int, int, int], ParsedWireguardConfiguration]] = {}
+
+    @staticmethod
+    def fileKey(path: str) -> tuple[int, int, int]:
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def parse(self, path: str) -> ParsedWireguardConfiguration:
+        """
+        @param path: Path of the .conf file
+        @return: Parsed file, shared between callers and not to be modified
+        """
+        key = self.fileKey(path)
+        with self.__lock:
+            cached = self.__cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with open(path, 'r') as f:
+            content = f.read()
+        parsed = self.parseText(content)
+        # The file may have changed while it was read, keep the key it had before reading
+        with self.__lock:
+            self.__cache[path] = (key, parsed)
+        return parsed
+
+    def write(self, path: str, content: str) -> tuple[tuple[int, int, int], ParsedWireguardConfiguration]:
+        """
+        Replace a .conf file atomically: the content goes to a temporary file in the same directory, which
+        is synced and renamed over the file, so a crash leaves either the old or the new file
+        @param path: Path of the .conf file, a symbolic link is followed and its target replaced
+        @param content: New content of the file
+        @return: Key of the written file and its parsed content, which is also cached
+        """
+        target = os.path.realpath(path)
+        directory = os.path.dirname(target)
+        try:
+            previous = os.stat(target)
+        except FileNotFoundError:
+            previous = None
+        fd, temporaryPath = tempfile.mkstemp(prefix=f".{os.path.basename(target)}.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+                f.flush()
+                if previous is not None:
+                    os.fchmod(f.fileno(), stat.S_IMODE(previous.st_mode))
+                    try:
+                        os.fchown(f.fileno(), previous.st_uid, previous.st_gid)
+                    except PermissionError:
+                        pass
+                os.fsync(f.fileno())
+            os.replace(temporaryPath, target)
+        except BaseException:
+            try:
+                os.remove(temporaryPath)
+            except OSError:
+                pass
+            raise
+        directoryFd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directoryFd)
+        finally:
+            os.close(directoryFd)
+        key = self.fileKey(path)
+        parsed = self.parseText(content)
+        with self.__lock:
+            self.__cache[path] = (key, parsed)
+        return key, parsed
+
+    @staticmethod
+    def formatText(header: list[str], peers: list[tuple[str, list[tuple[str, str]]]]) -> str:
+        """
+        @param header: Lines before the first [Peer], usually the header of a parsed file
+        @param peers: Name and keys of every [Peer] section, in order
+        @return: Content of the .conf file
+        """
+        header = list(header)
+        while len(header) > 0 and len(header[-1].strip()) == 0:
+            header.pop()
+        lines = header
+        for name, keys in peers:
+            lines.append("")
+            lines.append("[Peer]")
+            name = " ".join((name or "").split())
+            if len(name) > 0:
+                lines.append(f"#Name# = {name}")
+            for key, value in keys:
+                lines.append(f"{key} = {value}")
+        return "\n".join(lines) + "\n"
+
+    def invalidate(self, path: str):
+        with self.__lock:
+            self.__cache.pop(path, None)
+
+    @staticmethod
+    def parseText(content: str) -> ParsedWireguardConfiguration:
+        parsed = ParsedWireguardConfiguration()
+        split = WireguardConfigurationParser.KeyValue.split
+        name = WireguardConfigurationParser.Name.search
+        inInterface = False
+        peer = None
+        for line in content.split('\n'):
+            if not parsed.hasPeers and line != "[Peer]":
+                parsed.header.append(line)
+            if line == "[Interface]" and not parsed.hasInterface:
+                parsed.hasInterface = inInterface = True
+            elif line == "[Peer]":
+                inInterface = False
+                parsed.hasPeers = True
+            if inInterface:
+                pair = split(line, 1)
+                if len(pair) == 2:
+                    parsed.interface.append((pair[0], pair[1]))
+            if not parsed.hasPeers:
+                continue
+            if '#' not in line and ';' not in line:
+                if line == "[Peer]":
+                    peer = {"name": ""}
+                    parsed.peers.append(peer)
+                elif len(line) > 0:
+                    pair = split(line, 1)
+                    if len(pair) == 2:
+                        peer[pair[0]] = pair[1]
+            elif name(line):
+                pair = split(line, 1)
+                if len(pair) == 2:
+                    peer["name"] = pair[1]
+        return parsed
+
+
+WireguardConfigurationParsers = WireguardConfigurationParser()
@@ -0,0 +1,53 @@
+"""
+WireGuard Dump
+"""
+
+
+class WireguardPeerDump:
+    def __init__(self, PublicKey: str, PresharedKey: str, Endpoint: str, AllowedIPs: list[str],
+                 LatestHandshake: int, TransferRx: int, TransferTx: int, PersistentKeepalive: int | None):
+        self.PublicKey = PublicKey
+        self.PresharedKey = PresharedKey
+        self.Endpoint = Endpoint
+        self.AllowedIPs = AllowedIPs
+        self.LatestHandshake = LatestHandshake
+        self.TransferRx = TransferRx
+        self.TransferTx = TransferTx
+        self.PersistentKeepalive = PersistentKeepalive
+
+    def toJson(self):
+        return {
+            "PublicKey": self.PublicKey,
+            "Endpoint": self.Endpoint,
+            "AllowedIPs": self.AllowedIPs,
+            "LatestHandshake": self.LatestHandshake,
+            "TransferRx": self.TransferRx,
+            "TransferTx": self.TransferTx,
+            "PersistentKeepalive": self.PersistentKeepalive
+        }
+
+
+def ParseWireguardDump(dump: str) -> dict[str, WireguardPeerDump]:
+    """
+    Parse the output of `wg show <interface> dump` (or `awg show <interface> dump`)
+    @param dump: Output of the dump command. The first line describes the interface, every other line is a peer
+    @return: Peers keyed by their public key
+    """
+    peers = {}
+    lines = dump.split("\n")
+    for line in lines[1:]:
+        fields = line.split("\t")
+        if len(fields) != 8:
+            continue
+        publicKey, presharedKey, endpoint, allowedIPs, latestHandshake, transferRx, transferTx, keepalive = fields
+        peers[publicKey] = WireguardPeerDump(
+            publicKey,
+            "" if presharedKey == "(none)" else presharedKey,
+            endpoint,
+            [] if allowedIPs == "(none)" else allowedIPs.split(","),
+            int(latestHandshake),
+            int(transferRx),
+            int(transferTx),
+            None if keepalive == "off" else int(keepalive)
+        )
+    return peers
@@ -0,0 +1,103 @@
+"""
+Wireguard Peer Batch
+"""
+import os, subprocess, tempfile
+
+
+class WireguardPeerBatch:
+    """
+    Sets and removes many peers of an interface with as few `wg set` as possible. Peers are grouped into
+    invocations of at most MaxArgumentBytes of arguments. When an invocation fails it is split in halves and
+    each half is run again, down to single peers, so every error is attributed to the peer that caused it.
+    Setting and removing a peer are idempotent, running the peers that went through a second time is harmless.
+    """
+    # Bytes of arguments per invocation, well below ARG_MAX
+    MaxArgumentBytes = 128 * 1024
+
+    def __init__(self, protocol: str, interface: str):
+        """
+        @param protocol: wg or awg
+        @param interface: Name of the interface
+        """
+        self.protocol = protocol
+        self.interface = interface
+
+    def set(self, peers: list[dict]) -> dict[str, str]:
+        """
+        Add or update peers
+        @param peers: Peers with their id, allowed_ip and preshared_key
+        @return: Error message of every peer that could not be set, by public key
+        """
+        if len(peers) == 0:
+            return {}
+        # Preshared keys are passed as files, readable only by the dashboard and gone once applied
+        with tempfile.TemporaryDirectory(prefix="wgdashboard-") as directory:
+            arguments = []
+            for index, peer in enumerate(peers):
+                args = ["peer", peer['id'], "allowed-ips", peer['allowed_ip'].replace(" ", "")]
+                if len(peer.get('preshared_key') or "") > 0:
+                    path = os.path.join(directory, str(index))
+                    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+                        f.write(peer['preshared_key'])
+                    args += ["preshared-key", path]
+                arguments.append((peer['id'], args))
+            return self.__apply(arguments)
+
+    def remove(self, publicKeys: list[str]) -> dict[str, str]:
+        """
+        @param publicKeys: Public keys of the peers to remove
+        @return: Error message of every peer that could not be removed, by public key
+        """
+        return self.__apply([(publicKey, ["peer", publicKey, "remove"]) for publicKey in publicKeys])
+
+    @staticmethod
+    def summary(failed: dict[str, str], limit: int = 5) -> str:
+        """
+        @return: Errors of the first failed peers, on one line
+        """
+        errors = [f"{publicKey}: {error}" for publicKey, error in list(failed.items())[:limit]]
+        if len(failed) > limit:
+            errors.append(f"and {len(failed) - limit} more")
+        return "; ".join(errors)
+
+    def __apply(self, arguments: list[tuple[str, list[str]]]) -> dict[str, str]:
+        failed = {}
+        for chunk in self.__chunks(arguments):
+            self.__run(chunk, failed)
+        return failed
+
+    @staticmethod
+    def __chunks(arguments: list[tuple[str, list[str]]]):
+        chunk, size = [], 0
+        for publicKey, args in arguments:
+            length = sum(len(a) + 1 for a in args)
+            if len(chunk) > 0 and size + length > WireguardPeerBatch.MaxArgumentBytes:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append((publicKey, args))
+            size += length
+        if len(chunk) > 0:
+            yield chunk
+
+    def __run(self, chunk: list[tuple[str, list[str]]], failed: dict[str, str]):
+        error = self.__invoke(chunk)
+        if error is None:
+            return
+        if len(chunk) == 1:
+            failed[chunk[0][0]] = error
+            return
+        middle = len(chunk) // 2
+        self.__run(chunk[:middle], failed)
+        self.__run(chunk[middle:], failed)
+
+    def __invoke(self, chunk: list[tuple[str, list[str]]]) -> str | None:
+        command = [self.protocol, "set", self.interface]
+        for _, args in chunk:
+            command += args
+        try:
+            subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            return None
+        except subprocess.CalledProcessError as e:
+            return e.output.decode("UTF-8", errors="replace").strip() or str(e)
+        except OSError as e:
+            return str(e)
@@ -0,0 +1,298 @@
+"""
+WireGuard Statistics Backend
+"""
+import base64, errno, os, socket, struct, subprocess, time
+from abc import ABC, abstractmethod
+from flask import current_app
+
+from .WireguardDump import WireguardPeerDump, ParseWireguardDump
+
+NETLINK_GENERIC = 16
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_ACK = 0x04
+NLM_F_DUMP = 0x300
+NLA_TYPE_MASK = 0x3fff
+
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+WG_CMD_GET_DEVICE = 0
+WG_GENL_VERSION = 1
+WGDEVICE_A_IFNAME = 2
+WGDEVICE_A_PEERS = 8
+WGPEER_A_PUBLIC_KEY = 1
+WGPEER_A_PRESHARED_KEY = 2
+WGPEER_A_ENDPOINT = 4
+WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL = 5
+WGPEER_A_LAST_HANDSHAKE_TIME = 6
+WGPEER_A_RX_BYTES = 7
+WGPEER_A_TX_BYTES = 8
+WGPEER_A_ALLOWEDIPS = 9
+WGALLOWEDIP_A_FAMILY = 1
+WGALLOWEDIP_A_IPADDR = 2
+WGALLOWEDIP_A_CIDR_MASK = 3
+
+
+class WireguardStatsBackend(ABC):
+    """
+    Base class of a statistics backend. Reading the state of an interface is split into fetch (talking to the
+    kernel or the CLI) and parse (turning the raw response into peer records) so the two can be timed separately.
+    """
+    Name = ""
+
+    class InterfaceNotFoundException(Exception):
+        pass
+
+    @abstractmethod
+    def fetch(self, interface: str):
+        pass
+
+    @abstractmethod
+    def parse(self, raw) -> dict[str, WireguardPeerDump]:
+        pass
+
+    def collect(self, interface: str) -> dict[str, WireguardPeerDump] | None:
+        try:
+            return self.parse(self.fetch(interface))
+        except WireguardStatsBackend.InterfaceNotFoundException:
+            return None
+
+
+class CommandLineStatsBackend(WireguardStatsBackend):
+    Name = "cli"
+
+    def __init__(self, protocol: str):
+        self.protocol = protocol
+
+    def fetch(self, interface: str) -> str:
+        try:
+            dump = subprocess.check_output([self.protocol, "show", interface, "dump"], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            raise WireguardStatsBackend.InterfaceNotFoundException(interface)
+        return dump.decode("UTF-8")
+
+    def parse(self, raw: str) -> dict[str, WireguardPeerDump]:
+        return ParseWireguardDump(raw)
+
+
+class NetlinkStatsBackend(WireguardStatsBackend):
+    """
+    Reads the peer dump straight from the generic netlink family registered by the kernel module
+    (WG_CMD_GET_DEVICE with NLM_F_DUMP), without creating any process.
+    """
+    Name = "netlink"
+
+    def __init__(self, family: str = "wireguard"):
+        self.family = family
+        self.familyId = None
+        self.sequence = 0
+
+    def __request(self, sock: socket.socket, messageType: int, flags: int, command: int, version: int,
+                  attributes: bytes) -> list[bytes]:
+        self.sequence += 1
+        payload = struct.pack("=BBH", command, version, 0) + attributes
+        sock.send(struct.pack("=IHHII", 16 + len(payload), messageType, flags, self.sequence, 0) + payload)
+        messages = []
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + 16 <= len(data):
+                length, msgType, _, _, _ = struct.unpack_from("=IHHII", data, offset)
+                if length < 16:
+                    return messages
+                if msgType == NLMSG_DONE:
+                    return messages
+                if msgType == NLMSG_ERROR:
+                    error = struct.unpack_from("=i", data, offset + 16)[0]
+                    if error == 0:
+                        return messages
+                    if -error == errno.ENODEV:
+                        raise WireguardStatsBackend.InterfaceNotFoundException()
+                    raise OSError(-error, os.strerror(-error))
+                messages.append(data[offset + 20:offset + length])
+                offset += (length + 3) & ~3
+            if not flags & NLM_F_DUMP and len(messages) > 0:
+                return messages
+
+    @staticmethod
+    def __attribute(attributeType: int, value: bytes) -> bytes:
+        attribute = struct.pack("=HH", 4 + len(value), attributeType) + value
+        return attribute + b"\0" * (((len(attribute) + 3) & ~3) - len(attribute))
+
+    @staticmethod
+    def __attributes(data: bytes) -> list[tuple[int, bytes]]:
+        attributes = []
+        offset = 0
+        while offset + 4 <= len(data):
+            length, attributeType = struct.unpack_from("=HH", data, offset)
+            if length < 4:
+                break
+            attributes.append((attributeType & NLA_TYPE_MASK, data[offset + 4:offset + length]))
+            offset += (length + 3) & ~3
+        return attributes
+
+    def __resolveFamily(self, sock: socket.socket) -> int:
+        if self.familyId is None:
+            messages = self.__request(sock, GENL_ID_CTRL, NLM_F_REQUEST, CTRL_CMD_GETFAMILY, 1,
+                                      self.__attribute(CTRL_ATTR_FAMILY_NAME, self.family.encode() + b"\0"))
+            for message in messages:
+                for attributeType, value in self.__attributes(message):
+                    if attributeType == CTRL_ATTR_FAMILY_ID:
+                        self.familyId = struct.unpack("=H", value[:2])[0]
+            if self.familyId is None:
+                raise OSError(errno.ENOENT, f"Generic netlink family {self.family} is not available")
+        return self.familyId
+
+    def fetch(self, interface: str) -> list[bytes]:
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC) as sock:
+            sock.bind((0, 0))
+            familyId = self.__resolveFamily(sock)
+            return self.__request(sock, familyId, NLM_F_REQUEST | NLM_F_ACK | NLM_F_DUMP,
+                                  WG_CMD_GET_DEVICE, WG_GENL_VERSION,
+                                  self.__attribute(WGDEVICE_A_IFNAME, interface.encode() + b"\0"))
+
+    @staticmethod
+    def __endpoint(value: bytes) -> str:
+        family = struct.unpack_from("=H", value)[0]
+        port = struct.unpack_from("!H", value, 2)[0]
+        if family == socket.AF_INET:
+            return f"{socket.inet_ntop(socket.AF_INET, value[4:8])}:{port}"
+        if family == socket.AF_INET6:
+            return f"[{socket.inet_ntop(socket.AF_INET6, value[8:24])}]:{port}"
+        return "(none)"
+
+    def __allowedIP(self, value: bytes) -> str | None:
+        family = address = cidr = None
+        for attributeType, attributeValue in self.__attributes(value):
+            if attributeType == WGALLOWEDIP_A_FAMILY:
+                family = struct.unpack("=H", attributeValue[:2])[0]
+            elif attributeType == WGALLOWEDIP_A_IPADDR:
+                address = attributeValue
+            elif attributeType == WGALLOWEDIP_A_CIDR_MASK:
+                cidr = attributeValue[0]
+        if family is None or address is None or cidr is None:
+            return None
+        return f"{socket.inet_ntop(family, address)}/{cidr}"
+
+    def parse(self, raw: list[bytes]) -> dict[str, WireguardPeerDump]:
+        peers: dict[str, WireguardPeerDump] = {}
+        for message in raw:
+            for deviceAttributeType, deviceAttribute in self.__attributes(message):
+                if deviceAttributeType != WGDEVICE_A_PEERS:
+                    continue
+                for _, peerAttributes in self.__attributes(deviceAttribute):
+                    peer = {
+                        "PublicKey": None, "PresharedKey": "", "Endpoint": "(none)", "AllowedIPs": [],
+                        "LatestHandshake": 0, "TransferRx": 0, "TransferTx": 0, "PersistentKeepalive": None
+                    }
+                    for attributeType, value in self.__attributes(peerAttributes):
+                        if attributeType == WGPEER_A_PUBLIC_KEY:
+                            peer["PublicKey"] = base64.b64encode(value).decode()
+                        elif attributeType == WGPEER_A_PRESHARED_KEY:
+                            if any(value):
+                                peer["PresharedKey"] = base64.b64encode(value).decode()
+                        elif attributeType == WGPEER_A_ENDPOINT:
+                            peer["Endpoint"] = self.__endpoint(value)
+                        elif attributeType == WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL:
+                            keepalive = struct.unpack("=H", value[:2])[0]
+                            peer["PersistentKeepalive"] = keepalive if keepalive > 0 else None
+                        elif attributeType == WGPEER_A_LAST_HANDSHAKE_TIME:
+                            peer["LatestHandshake"] = struct.unpack("=q", value[:8])[0]
+                        elif attributeType == WGPEER_A_RX_BYTES:
+                            peer["TransferRx"] = struct.unpack("=Q", value[:8])[0]
+                        elif attributeType == WGPEER_A_TX_BYTES:
+                            peer["TransferTx"] = struct.unpack("=Q", value[:8])[0]
+                        elif attributeType == WGPEER_A_ALLOWEDIPS:
+                            for _, allowedIP in self.__attributes(value):
+                                allowedIP = self.__allowedIP(allowedIP)
+                                if allowedIP is not None:
+                                    peer["AllowedIPs"].append(allowedIP)
+                    if peer["PublicKey"] is None:
+                        continue
+                    # A peer with many allowed IPs is continued in the next message under the same public key
+                    if peer["PublicKey"] in peers:
+                        peers[peer["PublicKey"]].AllowedIPs += peer["AllowedIPs"]
+                    else:
+                        peers[peer["PublicKey"]] = WireguardPeerDump(**peer)
+        return peers
+
+
+class FakeStatsBackend(WireguardStatsBackend):
+    """
+    Serves `wg show <interface> dump` fixtures, either given directly or read from <fixturePath>/<interface>.dump
+    """
+    Name = "fake"
+
+    def __init__(self, fixtures: dict[str, str] = None, fixturePath: str = None):
+        self.fixtures = fixtures if fixtures is not None else {}
+        self.fixturePath = fixturePath
+
+    def fetch(self, interface: str) -> str:
+        if interface in self.fixtures.keys():
+            return self.fixtures[interface]
+        if self.fixturePath:
+            path = os.path.join(self.fixturePath, f"{interface}.dump")
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    return f.read()
+        raise WireguardStatsBackend.InterfaceNotFoundException(interface)
+
+    def parse(self, raw: str) -> dict[str, WireguardPeerDump]:
+        return ParseWireguardDump(raw)
+
+
+class AutoStatsBackend(WireguardStatsBackend):
+    """
+    Uses the netlink backend and falls back to the CLI backend while netlink is unusable. Netlink is tried again
+    every RetryInterval seconds, so a module loaded after the dashboard started is picked up.
+    """
+    Name = "auto"
+    RetryInterval = 300
+
+    def __init__(self, primary: WireguardStatsBackend, fallback: WireguardStatsBackend):
+        self.primary = primary
+        self.fallback = fallback
+        self.active = primary
+        self.retryAt = 0.0
+
+    def fetch(self, interface: str):
+        if self.active is self.fallback and time.monotonic() >= self.retryAt:
+            try:
+                raw = self.primary.fetch(interface)
+                current_app.logger.info(f"{self.primary.Name} statistics backend is available again")
+                self.active = self.primary
+                return raw
+            except WireguardStatsBackend.InterfaceNotFoundException:
+                raise
+            except Exception:
+                self.retryAt = time.monotonic() + self.RetryInterval
+        if self.active is self.primary:
+            try:
+                return self.primary.fetch(interface)
+            except WireguardStatsBackend.InterfaceNotFoundException:
+                raise
+            except Exception as e:
+                current_app.logger.warning(
+                    f"{self.primary.Name} statistics backend is unavailable, falling back to {self.fallback.Name} "
+                    f"for {self.RetryInterval} seconds. Reason: {str(e)}")
+                self.active = self.fallback
+                self.retryAt = time.monotonic() + self.RetryInterval
+        return self.fallback.fetch(interface)
+
+    def parse(self, raw) -> dict[str, WireguardPeerDump]:
+        return self.active.parse(raw)
+
+
+def CreateStatsBackend(protocol: str, backend: str = "auto", fixturePath: str = None) -> WireguardStatsBackend:
+    family = "wireguard" if protocol == "wg" else "amneziawg"
+    if backend == "cli":
+        return CommandLineStatsBackend(protocol)
+    if backend == "netlink":
+        return NetlinkStatsBackend(family)
+    if backend == "fake":
+        return FakeStatsBackend(fixturePath=fixturePath)
+    return AutoStatsBackend(NetlinkStatsBackend(family), CommandLineStatsBackend(protocol))
@@ -0,0 +1,107 @@
+import pytest, sqlalchemy, subprocess
+from modules.ConfigurationSaveScheduler import ConfigurationSaveScheduler
+from modules.Peer import Peer
+from modules.WireguardConfiguration import WireguardConfiguration
+from modules.WireguardConfigurationParser import WireguardConfigurationParsers
+
+PublicKey = "aJpG6Vw4oG4QDx9A9HCnlzTcI1xWh0EPfzD9cD3y7nE="
+Configuration = f"""[Interface]
+Address = 10.0.0.1/24
+ListenPort = 51820
+PostUp = iptables -A FORWARD -i wg0 -j ACCEPT
+
+[Peer]
+#Name# = Laptop
+PublicKey = {PublicKey}
+AllowedIPs = 10.0.0.2/32
+PersistentKeepalive = 25
+"""
+
+
+def peerColumns() -> list[sqlalchemy.Column]:
+    return [
+        sqlalchemy.Column('id', sqlalchemy.String(255), primary_key=True),
+        sqlalchemy.Column('private_key', sqlalchemy.String(255)),
+        sqlalchemy.Column('DNS', sqlalchemy.Text),
+        sqlalchemy.Column('endpoint_allowed_ip', sqlalchemy.Text),
+        sqlalchemy.Column('name', sqlalchemy.Text),
+        sqlalchemy.Column('allowed_ip', sqlalchemy.String(255)),
+        sqlalchemy.Column('mtu', sqlalchemy.Integer),
+        sqlalchemy.Column('keepalive', sqlalchemy.Integer),
+        sqlalchemy.Column('preshared_key', sqlalchemy.String(255)),
+    ]
+
+
+@pytest.fixture
+def configuration(tmp_path, monkeypatch):
+    path = tmp_path / "wg0.conf"
+    path.write_text(Configuration)
+    c = WireguardConfiguration.__new__(WireguardConfiguration)
+    c.Name = "wg0"
+    c.Protocol = "wg"
+    c.configPath = str(path)
+    c.engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'wgdashboard.db'}")
+    metadata = sqlalchemy.MetaData()
+    c.peersTable = sqlalchemy.Table("wg0", metadata, *peerColumns())
+    c.peersRestrictedTable = sqlalchemy.Table("wg0_restrict_access", metadata, *peerColumns())
+    metadata.create_all(c.engine)
+    with c.engine.begin() as conn:
+        conn.execute(c.peersTable.insert().values(
+            id=PublicKey, private_key="", DNS="", endpoint_allowed_ip="0.0.0.0/0", name="Laptop",
+            allowed_ip="10.0.0.2/32", mtu=1420, keepalive=25, preshared_key=""))
+    c._WireguardConfiguration__configFileModifiedTime = None
+    c.configurationFileChanged()
+    c.SaveScheduler = ConfigurationSaveScheduler(c.writeConfigurationFile, 0)
+    monkeypatch.setattr(c, "getStatus", lambda: True, raising=False)
+    monkeypatch.setattr(c, "getPeersList", lambda: [], raising=False)
+    monkeypatch.setattr(subprocess, "check_output", lambda *args, **kwargs: b"")
+    yield c
+    WireguardConfigurationParsers.invalidate(c.configPath)
+
+
+def test_updated_allowed_ips_are_written(configuration):
+    peer = Peer.__new__(Peer)
+    peer.configuration = configuration
+    peer.id = PublicKey
+    status, message = peer.updatePeer("Laptop", "", "", "", "10.0.0.3/32, fd00::3/128", "0.0.0.0/0", 1420, 25)
+    assert status, message
+    assert configuration.SaveScheduler.flush() == (True, None)
+
+    with open(configuration.configPath) as f:
+        content = f.read()
+    parsed = WireguardConfigurationParsers.parseText(content)
+    assert parsed.peers == [{
+        "name": "Laptop",
+        "PublicKey": PublicKey,
+        "AllowedIPs": "10.0.0.3/32,fd00::3/128",
+        "PersistentKeepalive": "25"
+    }]
+    assert "PostUp = iptables -A FORWARD -i wg0 -j ACCEPT" in content
+    with configuration.engine.connect() as conn:
+        assert conn.execute(
+            sqlalchemy.select(configuration.peersTable.c.allowed_ip)
+        ).scalar() == "10.0.0.3/32,fd00::3/128"
+    # The written file is already known, reading the peers again does not parse it
+    assert not configuration.configurationFileChanged(update=False)
+
+
+def test_peers_added_to_the_file_are_kept(configuration):
+    with open(configuration.configPath, "a") as f:
+        f.write("\n[Peer]\n#Name# = Phone\nPublicKey = HandAddedKey=\nAllowedIPs = 10.0.0.9/32\n")
+    assert configuration.writeConfigurationFile() == (True, None)
+
+    with open(configuration.configPath) as f:
+        parsed = WireguardConfigurationParsers.parseText(f.read())
+    assert [p["PublicKey"] for p in parsed.peers] == [PublicKey, "HandAddedKey="]
+    assert parsed.peers[1] == {"name": "Phone", "PublicKey": "HandAddedKey=", "AllowedIPs": "10.0.0.9/32"}
+    # Left unread, so reading the peers again imports the new one
+    assert configuration.configurationFileChanged(update=False)
+
+
+def test_deleted_peers_are_removed_from_the_file(configuration):
+    with configuration.engine.begin() as conn:
+        conn.execute(configuration.peersTable.delete())
+    assert configuration.writeConfigurationFile() == (True, None)
+
+    with open(configuration.configPath) as f:
+        assert WireguardConfigurationParsers.parseText(f.read()).peers == []
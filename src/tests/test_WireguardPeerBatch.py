@@ -0,0 +1,82 @@
+import pytest, sqlalchemy, subprocess
+from modules.WireguardPeerBatch import WireguardPeerBatch
+from test_WireguardConfigurationWriter import configuration, PublicKey
+
+
+class FakeWg:
+    """
+    Stands in for subprocess.run, records every command and rejects the peers in `rejected`
+    """
+    def __init__(self, rejected: set[str] = None, raiseOnCall: int = None):
+        self.rejected = rejected or set()
+        self.raiseOnCall = raiseOnCall
+        self.commands = []
+
+    def __call__(self, command, **kwargs):
+        self.commands.append(command)
+        if self.raiseOnCall == len(self.commands):
+            raise RuntimeError("wg crashed")
+        bad = [a for a in command if a in self.rejected]
+        if len(bad) > 0:
+            raise subprocess.CalledProcessError(1, command, output=f"Invalid peer {bad[0]}".encode())
+        return subprocess.CompletedProcess(command, 0, b"")
+
+    def peers(self, command) -> list[str]:
+        return [command[i + 1] for i, a in enumerate(command) if a == "peer"]
+
+
+def peerRows(count: int) -> list[dict]:
+    return [{
+        "id": f"peer{index:04d}", "private_key": "", "DNS": "", "endpoint_allowed_ip": "0.0.0.0/0",
+        "name": f"Peer {index}", "allowed_ip": f"10.0.1.{index}/32", "mtu": 1420, "keepalive": 0,
+        "preshared_key": ""
+    } for index in range(count)]
+
+
+def storedIds(configuration) -> set[str]:
+    with configuration.engine.connect() as conn:
+        return set(r.id for r in conn.execute(sqlalchemy.select(configuration.peersTable.c.id)))
+
+
+def test_peers_are_chunked_by_argument_size(monkeypatch):
+    wg = FakeWg()
+    monkeypatch.setattr(subprocess, "run", wg)
+    monkeypatch.setattr(WireguardPeerBatch, "MaxArgumentBytes", 200)
+    rows = peerRows(20)
+    assert WireguardPeerBatch("wg", "wg0").set(rows) == {}
+
+    assert len(wg.commands) > 1
+    for command in wg.commands:
+        assert command[:3] == ["wg", "set", "wg0"]
+        assert sum(len(a) + 1 for a in command[3:]) <= 200
+    assert [p for command in wg.commands for p in wg.peers(command)] == [r["id"] for r in rows]
+
+
+def test_errors_are_attributed_to_the_rejected_peers(monkeypatch):
+    wg = FakeWg(rejected={"peer0003", "peer0011"})
+    monkeypatch.setattr(subprocess, "run", wg)
+    failed = WireguardPeerBatch("wg", "wg0").remove([r["id"] for r in peerRows(16)])
+
+    assert failed == {"peer0003": "Invalid peer peer0003", "peer0011": "Invalid peer peer0011"}
+    assert WireguardPeerBatch.summary(failed, 1) == "peer0003: Invalid peer peer0003; and 1 more"
+
+
+def test_rejected_peers_are_not_inserted(configuration, monkeypatch):
+    wg = FakeWg(rejected={"peer0002"})
+    monkeypatch.setattr(subprocess, "run", wg)
+    failed = configuration.insertPeers(peerRows(4))
+
+    assert list(failed.keys()) == ["peer0002"]
+    assert storedIds(configuration) == {PublicKey, "peer0000", "peer0001", "peer0003"}
+
+
+def test_failed_batch_rolls_back_the_insert(configuration, monkeypatch):
+    wg = FakeWg(raiseOnCall=1)
+    monkeypatch.setattr(subprocess, "run", wg)
+    rows = peerRows(4)
+    with pytest.raises(RuntimeError):
+        configuration.insertPeers(rows)
+
+    assert storedIds(configuration) == {PublicKey}
+    assert wg.commands[-1][-2:] == [rows[-1]["id"], "remove"]
+    assert wg.peers(wg.commands[-1]) == [r["id"] for r in rows]
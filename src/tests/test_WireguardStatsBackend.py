@@ -0,0 +1,101 @@
+import base64, socket, struct
+import pytest
+from flask import Flask
+from modules import WireguardStatsBackend as Backends
+from modules.WireguardStatsBackend import (WireguardStatsBackend, NetlinkStatsBackend, FakeStatsBackend,
+                                           AutoStatsBackend)
+
+PublicKey = base64.b64encode(bytes(range(32))).decode()
+PresharedKey = base64.b64encode(bytes([7] * 32)).decode()
+Dump = "\t".join(["cHJpdmF0ZQ==", "cHVibGlj", "51820", "off"]) + "\n" + "\n".join([
+    "\t".join([PublicKey, PresharedKey, "203.0.113.5:51820", "10.0.0.2/32,fd00::2/128", "1700000000", "1024",
+               "2048", "25"]),
+    "\t".join(["b3RoZXI=", "(none)", "(none)", "(none)", "0", "0", "0", "off"]),
+])
+
+
+def attribute(attributeType: int, value: bytes) -> bytes:
+    data = struct.pack("=HH", 4 + len(value), attributeType) + value
+    return data + b"\0" * (-len(data) % 4)
+
+
+def allowedIP(family: int, address: str, cidr: int) -> bytes:
+    return attribute(0, attribute(Backends.WGALLOWEDIP_A_FAMILY, struct.pack("=H", family)) +
+                     attribute(Backends.WGALLOWEDIP_A_IPADDR, socket.inet_pton(family, address)) +
+                     attribute(Backends.WGALLOWEDIP_A_CIDR_MASK, bytes([cidr])))
+
+
+def peerMessage(allowedIPs: list[bytes], endpoint: bool = True) -> bytes:
+    peer = attribute(Backends.WGPEER_A_PUBLIC_KEY, base64.b64decode(PublicKey))
+    peer += attribute(Backends.WGPEER_A_PRESHARED_KEY, base64.b64decode(PresharedKey))
+    if endpoint:
+        peer += attribute(Backends.WGPEER_A_ENDPOINT, struct.pack("=H", socket.AF_INET) + struct.pack("!H", 51820) +
+                          socket.inet_pton(socket.AF_INET, "203.0.113.5") + b"\0" * 8)
+        peer += attribute(Backends.WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL, struct.pack("=H", 25))
+        peer += attribute(Backends.WGPEER_A_LAST_HANDSHAKE_TIME, struct.pack("=qq", 1700000000, 0))
+        peer += attribute(Backends.WGPEER_A_RX_BYTES, struct.pack("=Q", 1024))
+        peer += attribute(Backends.WGPEER_A_TX_BYTES, struct.pack("=Q", 2048))
+    peer += attribute(Backends.WGPEER_A_ALLOWEDIPS, b"".join(allowedIPs))
+    return attribute(Backends.WGDEVICE_A_IFNAME, b"wg0\0") + attribute(Backends.WGDEVICE_A_PEERS, attribute(0, peer))
+
+
+class UnavailableBackend(FakeStatsBackend):
+    Name = "unavailable"
+
+    def __init__(self, fixtures: dict[str, str]):
+        super().__init__(fixtures)
+        self.available = False
+        self.calls = 0
+
+    def fetch(self, interface: str) -> str:
+        self.calls += 1
+        if not self.available:
+            raise OSError("Generic netlink family wireguard is not available")
+        return super().fetch(interface)
+
+
+def test_base_backend_is_abstract():
+    with pytest.raises(TypeError):
+        WireguardStatsBackend()
+
+
+def test_dump_is_parsed():
+    peers = FakeStatsBackend({"wg0": Dump}).collect("wg0")
+    assert peers[PublicKey].toJson() == {
+        "PublicKey": PublicKey, "Endpoint": "203.0.113.5:51820", "AllowedIPs": ["10.0.0.2/32", "fd00::2/128"],
+        "LatestHandshake": 1700000000, "TransferRx": 1024, "TransferTx": 2048, "PersistentKeepalive": 25
+    }
+    assert peers[PublicKey].PresharedKey == PresharedKey
+    assert peers["b3RoZXI="].AllowedIPs == [] and peers["b3RoZXI="].PersistentKeepalive is None
+    assert FakeStatsBackend().collect("wg0") is None
+
+
+def test_netlink_matches_dump():
+    raw = [
+        peerMessage([allowedIP(socket.AF_INET, "10.0.0.2", 32)]),
+        # The allowed IPs that did not fit are continued in the next message
+        peerMessage([allowedIP(socket.AF_INET6, "fd00::2", 128)], endpoint=False),
+    ]
+    peers = NetlinkStatsBackend().parse(raw)
+    expected = FakeStatsBackend({"wg0": Dump}).collect("wg0")[PublicKey]
+    assert list(peers.keys()) == [PublicKey]
+    assert peers[PublicKey].toJson() == expected.toJson()
+    assert peers[PublicKey].PresharedKey == expected.PresharedKey
+
+
+def test_auto_retries_netlink(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(Backends.time, "monotonic", lambda: now[0])
+    primary = UnavailableBackend({"wg0": Dump})
+    backend = AutoStatsBackend(primary, FakeStatsBackend({"wg0": Dump}))
+    with Flask(__name__).app_context():
+        assert PublicKey in backend.collect("wg0")
+        assert backend.active is backend.fallback
+
+        primary.available = True
+        backend.collect("wg0")
+        assert primary.calls == 1 and backend.active is backend.fallback
+
+        now[0] += AutoStatsBackend.RetryInterval
+        assert PublicKey in backend.collect("wg0")
+        assert primary.calls == 2 and backend.active is primary